@@ -5,14 +5,27 @@ import uuid
 from werkzeug.utils import secure_filename
 import csv
 import io
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import traceback
 import json
 import sys
 import zipfile
+import gzip
+import hashlib
 import base64
 import time
 import re
+import bisect
+import tempfile
+from operator import itemgetter
+import codecs
+import itertools
+import threading
+import collections
+import queue
+import contextlib
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -122,117 +135,1010 @@ def initialize_database_tables():
     except Exception as e:
         print(f"⚠️ Database check warning: {e}")
 
-# ============ BACKUP FUNCTIONS ============
-def get_all_data_with_order():
-    data = {}
+# ============ PAGED READER ============
+# Must not exceed PostgREST's max-rows setting (1000 on Supabase by default)
+SUPABASE_PAGE_SIZE = int(os.environ.get('SUPABASE_PAGE_SIZE', 1000))
+
+def iter_table_rows(table_name, columns="*", apply_filters=None, chunk_size=None):
+    """
+    Yield every row of a table, paging by id (keyset) so results are never
+    truncated at max-rows and memory stays bounded by one chunk.
+    `apply_filters` receives the query and returns it with extra filters;
+    `columns` must include id.
+    """
+    chunk_size = chunk_size or SUPABASE_PAGE_SIZE
+    last_id = None
+    while True:
+        query = supabase.table(table_name).select(columns)
+        if apply_filters:
+            query = apply_filters(query)
+        if last_id is not None:
+            query = query.gt("id", last_id)
+        response = query.order("id").limit(chunk_size).execute()
+        rows = response.data or []
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            break
+        last_id = rows[-1]['id']
+
+def order_rows(rows, *orders):
+    """
+    Sort rows in place the way PostgREST's .order() does (NULLs last ascending,
+    first descending). Each order is a column name or a (column, desc) tuple.
+    """
+    for order in reversed(orders):
+        column, desc = order if isinstance(order, tuple) else (order, False)
+        rows.sort(key=lambda r: (r.get(column) is None, r.get(column) if r.get(column) is not None else 0), reverse=desc)
+    return rows
+
+def iter_ordered_rows(table_name, orders, columns="*", apply_filters=None, chunk_size=None):
+    """
+    Yield rows in a given order, paging with range() so callers can stream them.
+    Offset paging gets slower on deep pages, so prefer iter_table_rows when order
+    does not matter. id is appended as a tie-breaker so pages never overlap.
+    `orders` takes the same column / (column, desc) entries as order_rows.
+    """
+    chunk_size = chunk_size or SUPABASE_PAGE_SIZE
+    start = 0
+    while True:
+        query = supabase.table(table_name).select(columns)
+        if apply_filters:
+            query = apply_filters(query)
+        for order in orders:
+            column, desc = order if isinstance(order, tuple) else (order, False)
+            query = query.order(column, desc=desc)
+        response = query.order("id").range(start, start + chunk_size - 1).execute()
+        rows = response.data or []
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            break
+        start += chunk_size
+
+# ============ CONCURRENT QUERIES ============
+QUERY_TIMEOUT_SECONDS = float(os.environ.get('QUERY_TIMEOUT_SECONDS', 30))
+QUERY_MAX_WORKERS = int(os.environ.get('QUERY_MAX_WORKERS', 8))
+
+def run_concurrently(tasks, timeout=QUERY_TIMEOUT_SECONDS, max_workers=None):
+    """
+    Run independent queries in parallel and return {name: result}.
+    `tasks` maps a name to a zero-argument callable, or to (callable, timeout_seconds);
+    `timeout` is the call site's default. Each call gets its own pool, sized to the
+    call site (one thread per task, capped by max_workers/QUERY_MAX_WORKERS), so a
+    query abandoned on timeout never holds a slot another request is waiting for.
+    Re-raises the first failure; raises TimeoutError if a query overruns its timeout,
+    after cancelling any task that has not started yet.
+    """
+    start = time.time()
+    workers = max(1, min(len(tasks), max_workers or QUERY_MAX_WORKERS))
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='supabase-query')
+    futures = {}
+    for name, task in tasks.items():
+        fn, task_timeout = task if isinstance(task, tuple) else (task, timeout)
+        futures[name] = (pool.submit(fn), task_timeout)
+    results = {}
     try:
-        response = supabase.table("financial_years").select("*").order("start_year", desc=True).execute()
-        data['financial_years'] = response.data if response.data else []
-        
-        response = supabase.table("schools").select("*").execute()
-        schools = response.data if response.data else []
-        schools.sort(key=lambda x: (int(x.get('cluster_number', 999)) if x.get('cluster_number') else 999, x.get('id', 0)))
-        for school in schools:
-            if school.get('water_accounts') and isinstance(school['water_accounts'], str):
-                try:
-                    school['water_accounts'] = json.loads(school['water_accounts'])
-                except:
-                    pass
-            if school.get('electricity_accounts') and isinstance(school['electricity_accounts'], str):
-                try:
-                    school['electricity_accounts'] = json.loads(school['electricity_accounts'])
-                except:
-                    pass
-            if school.get('telephone_accounts') and isinstance(school['telephone_accounts'], str):
-                try:
-                    school['telephone_accounts'] = json.loads(school['telephone_accounts'])
-                except:
-                    pass
-        data['schools'] = schools
-        
-        response = supabase.table("departments").select("*").order("display_order").order("department_name").order("id").execute()
-        departments = response.data if response.data else []
-        for dept in departments:
-            if dept.get('water_accounts') and isinstance(dept['water_accounts'], str):
-                try:
-                    dept['water_accounts'] = json.loads(dept['water_accounts'])
-                except:
-                    pass
-            if dept.get('electricity_accounts') and isinstance(dept['electricity_accounts'], str):
-                try:
-                    dept['electricity_accounts'] = json.loads(dept['electricity_accounts'])
-                except:
-                    pass
-            if dept.get('telephone_accounts') and isinstance(dept['telephone_accounts'], str):
-                try:
-                    dept['telephone_accounts'] = json.loads(dept['telephone_accounts'])
-                except:
-                    pass
-        data['departments'] = departments
-        
-        response = supabase.table("utility_bills").select("*").order("year", desc=True).order("month", desc=True).order("entity_type").order("entity_name").execute()
-        bills = response.data if response.data else []
-        for bill in bills:
-            if bill.get('bill_image') and isinstance(bill['bill_image'], str):
-                try:
-                    bill['bill_image'] = json.loads(bill['bill_image']) if bill['bill_image'] else None
-                except:
-                    pass
-        data['utility_bills'] = bills
-        
+        for name, (future, task_timeout) in futures.items():
+            remaining = max(0, start + task_timeout - time.time())
+            try:
+                results[name] = future.result(timeout=remaining)
+            except Exception:
+                print(f"❌ Concurrent query '{name}' failed or timed out after {time.time() - start:.1f}s")
+                raise
+    finally:
+        # Never block on stragglers; queued tasks are dropped, running ones finish on their own
+        pool.shutdown(wait=False, cancel_futures=True)
+    return results
+
+# ============ ENTITY NAME REGISTRY ============
+# Process-wide id -> school/department lookup. Local writes invalidate it; the TTL
+# picks up edits made by other gunicorn workers. Writes that store an entity name look
+# a missing id up directly, since another worker may have created it within the TTL.
+ENTITY_CACHE_TTL_SECONDS = int(os.environ.get('ENTITY_CACHE_TTL_SECONDS', 300))
+ENTITY_REGISTRY_COLUMNS = {'school': ("schools", "id, name, cluster_number"),
+                           'department': ("departments", "id, name, unit_name, department_name")}
+_entity_registry = {'loaded_at': None, 'school': {}, 'department': {}}
+_entity_registry_lock = threading.Lock()
+
+def get_entity_registry():
+    with _entity_registry_lock:
+        loaded_at = _entity_registry['loaded_at']
+        if loaded_at is None or time.time() - loaded_at > ENTITY_CACHE_TTL_SECONDS:
+            # The two tables are independent, so read them in parallel
+            results = run_concurrently({
+                'schools': lambda: list(iter_table_rows(*ENTITY_REGISTRY_COLUMNS['school'])),
+                'departments': lambda: list(iter_table_rows(*ENTITY_REGISTRY_COLUMNS['department']))
+            })
+            schools = {int(school['id']): school for school in results['schools']}
+            departments = {int(dept['id']): dept for dept in results['departments']}
+            _entity_registry['school'] = schools
+            _entity_registry['department'] = departments
+            _entity_registry['loaded_at'] = time.time()
+            print(f"🗂️ Entity registry loaded: {len(schools)} schools, {len(departments)} departments")
+        return _entity_registry
+
+def invalidate_entity_registry():
+    with _entity_registry_lock:
+        _entity_registry['loaded_at'] = None
+
+def fetch_entity(entity_type, entity_id):
+    """Read one school/department row straight from its table and add it to the registry."""
+    table_name, columns = ENTITY_REGISTRY_COLUMNS[entity_type]
+    response = supabase.table(table_name).select(columns).eq("id", entity_id).limit(1).execute()
+    if not response.data:
+        return None
+    entity = response.data[0]
+    with _entity_registry_lock:
+        if _entity_registry['loaded_at'] is not None:
+            _entity_registry[entity_type][entity_id] = entity
+    return entity
+
+def get_entity(entity_type, entity_id, fetch_missing=False):
+    """
+    Return the cached school/department row, or None if unknown. With fetch_missing, an
+    id the registry lacks (or a registry that fails to load) is read from its table, and
+    errors from that read propagate.
+    """
+    try:
+        entity_id = int(entity_id)
+    except (ValueError, TypeError):
+        return None
+    try:
+        entity = get_entity_registry().get(entity_type, {}).get(entity_id)
+    except Exception as e:
+        if not fetch_missing:
+            # Callers warm the registry up front and report load failures there
+            return None
+        print(f"⚠️ Entity registry unavailable, reading {entity_type} {entity_id} directly: {e}")
+        entity = None
+    if entity is None and fetch_missing and entity_type in ENTITY_REGISTRY_COLUMNS:
+        entity = fetch_entity(entity_type, entity_id)
+    return entity
+
+def get_entity_name(entity_type, entity_id, fetch_missing=False):
+    """Display name: school name, or department unit_name falling back to name."""
+    entity = get_entity(entity_type, entity_id, fetch_missing)
+    if not entity:
+        return ''
+    if entity_type == 'department':
+        return entity.get('unit_name') or entity.get('name') or ''
+    return entity.get('name') or ''
+
+# ============ WRITE VERSIONS ============
+# Per-table counters that every mutation endpoint bumps. Caches remember the versions
+# they were built against and are discarded as soon as any of them has moved on.
+_write_versions = collections.Counter()
+_write_versions_lock = threading.Lock()
+
+def bump_write_version(*tables):
+    with _write_versions_lock:
+        for table in tables:
+            _write_versions[table] += 1
+
+def get_write_versions(*tables):
+    with _write_versions_lock:
+        return tuple(_write_versions[table] for table in tables)
+
+# ============ TELEPHONE NOTES ============
+# Telephone account and phone details live as JSON in utility_bills.notes. Parsed notes
+# are cached per (bill id, updated_at) so reports and exports decode each revision once;
+# every write path stamps updated_at, and the raw string is compared as a cheap guard.
+TELEPHONE_NOTES_CACHE_SIZE = int(os.environ.get('TELEPHONE_NOTES_CACHE_SIZE', 20000))
+_telephone_notes_cache = collections.OrderedDict()
+_telephone_notes_lock = threading.Lock()
+
+def decode_telephone_notes(notes):
+    """Parse a notes value into a dict; missing, malformed or non-object notes give {}."""
+    if isinstance(notes, dict):
+        return notes
+    if not notes or not isinstance(notes, str):
+        return {}
+    try:
+        parsed = json.loads(notes)
+    except ValueError:
+        return {}
+    return parsed if isinstance(parsed, dict) else {}
+
+def get_telephone_notes(bill):
+    """Cached decode of a stored bill's notes. The result is shared: do not mutate it."""
+    notes = bill.get('notes')
+    key = (bill.get('id'), bill.get('updated_at'))
+    if key[0] is None or not isinstance(notes, str):
+        return decode_telephone_notes(notes)
+    with _telephone_notes_lock:
+        cached = _telephone_notes_cache.get(key)
+        if cached is not None and cached[0] == notes:
+            _telephone_notes_cache.move_to_end(key)
+            return cached[1]
+    parsed = decode_telephone_notes(notes)
+    with _telephone_notes_lock:
+        _telephone_notes_cache[key] = (notes, parsed)
+        while len(_telephone_notes_cache) > TELEPHONE_NOTES_CACHE_SIZE:
+            _telephone_notes_cache.popitem(last=False)
+    return parsed
+
+def get_telephone_accounts(bill):
+    """The bill's notes 'accounts' mapping, or {} if absent or malformed."""
+    accounts = get_telephone_notes(bill).get('accounts')
+    return accounts if isinstance(accounts, dict) else {}
+
+def with_default_telephone_account(notes, account_number, bill_number, current_charges, unsettled_charges, amount_paid):
+    """Return notes as a JSON string that has an 'accounts' entry for account_number."""
+    notes_obj = dict(decode_telephone_notes(notes))
+    accounts = notes_obj.get('accounts')
+    accounts = dict(accounts) if isinstance(accounts, dict) else {}
+    if account_number not in accounts:
+        accounts[account_number] = {
+            'accountNumber': account_number,
+            'billNumber': bill_number,
+            'totalAccountCharges': current_charges,
+            'previousOutstanding': unsettled_charges,
+            'previousPayment': 0.0,
+            'totalCurrentCharges': current_charges + unsettled_charges,
+            'amountPaid': amount_paid,
+            'phones': [],
+            'notes': ''
+        }
+    notes_obj['accounts'] = accounts
+    return json.dumps(notes_obj)
+
+# ============ BACKUP FUNCTIONS ============
+BACKUP_TABLES = ['financial_years', 'schools', 'departments', 'utility_bills', 'sut_office_expenses']
+
+# Backup order per table, as (column, desc) entries for iter_ordered_rows / order_rows.
+# Schools sort on a computed cluster key the query builder can't express, so that
+# (small) table is the only one read whole and sorted here.
+BACKUP_TABLE_ORDERS = {
+    'financial_years': [('start_year', True)],
+    'departments': ['display_order', 'department_name'],
+    'utility_bills': [('year', True), ('month', True), 'entity_type', 'entity_name'],
+    'sut_office_expenses': [('year', True), ('month', True)]
+}
+BACKUP_JSON_COLUMNS = {
+    'schools': ('water_accounts', 'electricity_accounts', 'telephone_accounts'),
+    'departments': ('water_accounts', 'electricity_accounts', 'telephone_accounts'),
+    'utility_bills': ('bill_image',)
+}
+
+def decode_backup_row(table_name, row):
+    """Decode the row's JSON text columns in place (idempotent)."""
+    for column in BACKUP_JSON_COLUMNS.get(table_name, ()):
+        if row.get(column) and isinstance(row[column], str):
+            try:
+                row[column] = json.loads(row[column])
+            except:
+                pass
+    return row
+
+def sort_schools(schools):
+    schools.sort(key=lambda x: (int(x.get('cluster_number', 999)) if x.get('cluster_number') else 999, x.get('id', 0)))
+    return schools
+
+def iter_backup_table(table_name):
+    """
+    Yield one table's rows for backup, in backup order, with JSON columns decoded.
+    Rows are read a page at a time, so only schools are ever held whole.
+    """
+    if table_name == 'schools':
+        for school in sort_schools(list(iter_table_rows("schools"))):
+            yield decode_backup_row(table_name, school)
+        return
+    rows = iter_ordered_rows(table_name, BACKUP_TABLE_ORDERS[table_name])
+    if table_name == 'sut_office_expenses':
+        # The table is optional; an unreadable first page means it isn't there
         try:
-            response = supabase.table("sut_office_expenses").select("*").order("year", desc=True).order("month", desc=True).execute()
-            data['sut_office_expenses'] = response.data if response.data else []
+            first = next(rows, None)
         except:
-            data['sut_office_expenses'] = []
-        return data
+            return
+        if first is None:
+            return
+        rows = itertools.chain([first], rows)
+    for row in rows:
+        yield decode_backup_row(table_name, row)
+
+def prepare_backup_rows(table_name, rows):
+    """Sort rows into backup order and decode JSON columns (idempotent)."""
+    if table_name == 'schools':
+        sort_schools(rows)
+    else:
+        order_rows(rows, *BACKUP_TABLE_ORDERS.get(table_name, []), 'id')
+    for row in rows:
+        decode_backup_row(table_name, row)
+    return rows
+
+def iter_backup_tables():
+    """
+    Yield (table_name, rows) in BACKUP_TABLES order, where rows is an iterator that
+    reads the table page by page. Each table's rows must be consumed before the next
+    table is requested, so memory stays bounded by one page whatever the table size.
+    """
+    for table_name in BACKUP_TABLES:
+        yield table_name, iter_backup_table(table_name)
+
+def get_all_data_with_order():
+    try:
+        return {table_name: list(rows) for table_name, rows in iter_backup_tables()}
     except Exception as e:
         print(f"❌ Error fetching data for backup: {e}")
         raise
 
+BACKUP_WRITE_CHUNK_ROWS = 500
+
+def iter_backup_json(records_count):
+    """
+    Yield the backup document as text chunks, table by table and row by row,
+    instead of building it with json.dumps. `records_count` is filled in as
+    tables are written and emitted after the data.
+    """
+    header = {
+        'version': '1.0',
+        'created_at': datetime.now().isoformat(),
+        'description': 'UKA BILL System Backup',
+        'order_preserved': True
+    }
+    yield '{\n' + ''.join(f'  {json.dumps(k)}: {json.dumps(v)},\n' for k, v in header.items()) + '  "data": {'
+    for table_index, (table_name, rows) in enumerate(iter_backup_tables()):
+        parts = [(',' if table_index else '') + f'\n    {json.dumps(table_name)}: [']
+        count = 0
+        for row in rows:
+            parts.append((',' if count else '') + '\n      ' + json.dumps(row, default=str))
+            count += 1
+            if len(parts) >= BACKUP_WRITE_CHUNK_ROWS:
+                yield ''.join(parts)
+                parts = []
+        parts.append('\n    ]' if count else ']')
+        yield ''.join(parts)
+        records_count[table_name] = count
+    yield '\n  },\n  "records_count": ' + json.dumps(records_count) + '\n}\n'
+
+# ============ COMPRESSED BACKUP FORMAT ============
+# Saved backups are a .zip holding one gzip-compressed JSON-lines file per table
+# plus manifest.json (format version, creation time, record counts and the SHA-256
+# of each table's uncompressed lines). Legacy .json backups are still restorable.
+BACKUP_ARCHIVE_VERSION = '2.0'
+BACKUP_MANIFEST_NAME = 'manifest.json'
+BACKUP_IDS_NAME = 'ids.json.gz'
+
+_STAMP_FRACTION = re.compile(r'\.(\d+)')
+_STAMP_SHORT_OFFSET = re.compile(r'(T[^+-]*[+-]\d{2})$')
+
+def normalize_change_stamp(value):
+    """
+    UTC ISO-8601 text (microsecond precision) for an updated_at/created_at value, so
+    stamps compare correctly as strings. The app writes naive datetime.now() values
+    beside Postgres timestamptz text; naive values are read as UTC, as Postgres
+    stores them. Unparseable values are returned unchanged.
+    """
+    text = str(value).strip().replace(' ', 'T', 1)
+    if text.endswith(('Z', 'z')):
+        text = text[:-1] + '+00:00'
+    # Python 3.9's fromisoformat only takes 3 or 6 fraction digits and +HH:MM offsets
+    text = _STAMP_FRACTION.sub(lambda m: '.' + (m.group(1) + '000000')[:6], text, count=1)
+    text = _STAMP_SHORT_OFFSET.sub(r'\1:00', text)
+    try:
+        stamp = datetime.fromisoformat(text)
+    except ValueError:
+        return str(value)
+    if stamp.tzinfo is None:
+        stamp = stamp.replace(tzinfo=timezone.utc)
+    return stamp.astimezone(timezone.utc).isoformat(timespec='microseconds')
+
+def row_change_stamp(row):
+    stamps = [normalize_change_stamp(row[column]) for column in ('updated_at', 'created_at') if row.get(column)]
+    return max(stamps) if stamps else None
+
+def write_backup_archive(filepath, tables=None, manifest_extra=None, live_ids=None):
+    """
+    Stream backup tables into a compressed archive; returns its manifest.
+    Defaults to a full backup. Every archive also stores each table's live ids
+    and an updated_at/created_at watermark for incremental backups to diff against.
+    """
+    manifest = {
+        'format': 'uka-bill-backup',
+        'version': BACKUP_ARCHIVE_VERSION,
+        'type': 'full',
+        'created_at': datetime.now().isoformat(),
+        'description': 'UKA BILL System Backup',
+        'order_preserved': True,
+        'compression': 'gzip',
+        'records_count': {},
+        'tables': {},
+        'watermarks': {},
+        'restore_epoch': read_restore_epoch()
+    }
+    # manifest_extra values may be filled in while `tables` is consumed; the
+    # manifest is only serialized after the last table is written
+    manifest.update(manifest_extra or {})
+    written_ids = {}
+    tmp_path = filepath + '.tmp'
+    try:
+        with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_STORED) as archive:
+            for table_name, rows in (tables if tables is not None else iter_backup_tables()):
+                member_name = f"{table_name}.jsonl.gz"
+                digest = hashlib.sha256()
+                watermark = manifest['watermarks'].get(table_name)
+                table_ids = written_ids.setdefault(table_name, [])
+                count = 0
+                with archive.open(member_name, 'w', force_zip64=True) as member:
+                    with gzip.GzipFile(fileobj=member, mode='wb', mtime=0) as gz:
+                        for row in rows:
+                            line = (json.dumps(row, default=str, ensure_ascii=False) + '\n').encode('utf-8')
+                            digest.update(line)
+                            gz.write(line)
+                            table_ids.append(row.get('id'))
+                            count += 1
+                            stamp = row_change_stamp(row)
+                            if stamp and (watermark is None or stamp > watermark):
+                                watermark = stamp
+                if watermark:
+                    manifest['watermarks'][table_name] = watermark
+                manifest['records_count'][table_name] = count
+                manifest['tables'][table_name] = {
+                    'file': member_name,
+                    'records': count,
+                    'sha256': digest.hexdigest()
+                }
+            ids = live_ids if live_ids is not None else written_ids
+            archive.writestr(BACKUP_IDS_NAME, gzip.compress(json.dumps(ids).encode('utf-8')))
+            archive.writestr(BACKUP_MANIFEST_NAME, json.dumps(manifest, indent=2))
+        os.replace(tmp_path, filepath)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return manifest
+
+def is_backup_archive(fileobj):
+    position = fileobj.tell()
+    try:
+        return zipfile.is_zipfile(fileobj)
+    finally:
+        fileobj.seek(position)
+
+def read_backup_manifest(archive):
+    return json.loads(archive.read(BACKUP_MANIFEST_NAME).decode('utf-8'))
+
+def iter_archive_table(archive, manifest, table_name):
+    """Yield one table's rows; raises ValueError if its checksum does not match."""
+    info = manifest.get('tables', {}).get(table_name)
+    if not info:
+        return
+    digest = hashlib.sha256()
+    with archive.open(info['file']) as member:
+        with gzip.GzipFile(fileobj=member, mode='rb') as gz:
+            for line in gz:
+                digest.update(line)
+                if line.strip():
+                    yield json.loads(line)
+    if digest.hexdigest() != info.get('sha256'):
+        raise ValueError(f"Checksum mismatch for {table_name}")
+
+def read_backup_archive(fileobj):
+    """Load and verify every table of a compressed backup into the dict restore expects."""
+    with zipfile.ZipFile(fileobj) as archive:
+        manifest = read_backup_manifest(archive)
+        if manifest.get('type') == 'incremental':
+            raise ValueError("This is an incremental backup; restore it from the backup list so its full backup chain is replayed")
+        return {table_name: list(iter_archive_table(archive, manifest, table_name))
+                for table_name in manifest.get('tables', {})}
+
+# ============ BACKUP INDEX ============
+# One small summary per backup file, kept in a single index in the backup folder
+# so listing never has to open (or parse) the backups themselves. Gunicorn workers
+# and the flask CLI all update it, so writers hold an flock on a lock file beside it.
+BACKUP_INDEX_NAME = 'backup_index.json'
+BACKUP_INDEX_LOCK_NAME = 'backup_index.lock'
+_backup_index_lock = threading.Lock()
+try:
+    import fcntl
+except ImportError:  # Windows dev machines: the index lock is per process only
+    fcntl = None
+
+def backup_index_path():
+    return os.path.join(app.config['BACKUP_FOLDER'], BACKUP_INDEX_NAME)
+
+@contextlib.contextmanager
+def backup_index_locked():
+    """Hold the index lock across threads and, where flock exists, across processes."""
+    with _backup_index_lock:
+        if fcntl is None:
+            yield
+            return
+        backup_folder = app.config['BACKUP_FOLDER']
+        os.makedirs(backup_folder, exist_ok=True)
+        with open(os.path.join(backup_folder, BACKUP_INDEX_LOCK_NAME), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def read_backup_index():
+    try:
+        with open(backup_index_path(), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_backup_index(index):
+    """Atomically replace the index file so readers never see a partial write."""
+    index_path = backup_index_path()
+    # A private temp name per writer, so concurrent writers never share a file
+    fd, tmp_path = tempfile.mkstemp(prefix=BACKUP_INDEX_NAME + '.', suffix='.tmp', dir=os.path.dirname(index_path))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_path, index_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def summarize_backup_file(filepath):
+    """Read the manifest details of one backup file for the index."""
+    stat = os.stat(filepath)
+    summary = {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'records_count': {},
+        'type': 'full',
+        'parent': None,
+        'created_at': datetime.fromtimestamp(stat.st_mtime).isoformat(),
+        'chainable': False
+    }
+    try:
+        if filepath.endswith('.zip'):
+            with zipfile.ZipFile(filepath) as archive:
+                manifest = read_backup_manifest(archive)
+                summary.update({
+                    'records_count': manifest.get('records_count', {}),
+                    'type': manifest.get('type', 'full'),
+                    'parent': manifest.get('parent'),
+                    'created_at': manifest.get('created_at', summary['created_at']),
+                    'chainable': BACKUP_IDS_NAME in archive.namelist()
+                })
+        else:
+            # Legacy JSON backup: parsed once here, then served from the index
+            with open(filepath, 'r', encoding='utf-8') as f:
+                backup_data = json.load(f)
+            summary['records_count'] = backup_data.get('records_count', {})
+            summary['created_at'] = backup_data.get('created_at', summary['created_at'])
+    except Exception as e:
+        print(f"⚠️ Could not read backup manifest for {os.path.basename(filepath)}: {e}")
+    return summary
+
+def get_backup_index():
+    """Index entries for every backup on disk, summarizing new or changed files lazily."""
+    backup_folder = app.config['BACKUP_FOLDER']
+    if not os.path.exists(backup_folder):
+        return {}
+    with backup_index_locked():
+        index = read_backup_index()
+        entries = {}
+        changed = False
+        for filename in os.listdir(backup_folder):
+            if filename == BACKUP_INDEX_NAME or not filename.endswith(('.json', '.zip')):
+                continue
+            filepath = os.path.join(backup_folder, filename)
+            stat = os.stat(filepath)
+            entry = index.get(filename)
+            if not entry or entry.get('size') != stat.st_size or entry.get('mtime') != stat.st_mtime:
+                entry = summarize_backup_file(filepath)
+                changed = True
+            entries[filename] = entry
+        if changed or entries.keys() != index.keys():
+            write_backup_index(entries)
+        return entries
+
+def record_backup_in_index(filename):
+    with backup_index_locked():
+        index = read_backup_index()
+        index[filename] = summarize_backup_file(os.path.join(app.config['BACKUP_FOLDER'], filename))
+        write_backup_index(index)
+
+def remove_backup_from_index(filename):
+    with backup_index_locked():
+        index = read_backup_index()
+        if index.pop(filename, None) is not None:
+            write_backup_index(index)
+
+# ============ STREAMING JSON BACKUP READER ============
+# JSON backup uploads are walked record by record straight from the uploaded
+# stream, so a restore only ever holds one record plus a small read buffer.
+RESTORE_READ_CHUNK_BYTES = 64 * 1024
+_JSON_WHITESPACE = re.compile(r'[ \t\r\n]*')
+_json_decoder = json.JSONDecoder()
+
+def _json_reader(stream, encoding='utf-8-sig'):
+    return {
+        'stream': stream,
+        'decoder': codecs.getincrementaldecoder(encoding)(),
+        'buf': '',
+        'pos': 0,
+        'eof': False,
+        'bytes_read': stream.tell()
+    }
+
+def _json_fill(reader, size=RESTORE_READ_CHUNK_BYTES):
+    chunk = reader['stream'].read(size)
+    reader['bytes_read'] += len(chunk)
+    reader['buf'] = reader['buf'][reader['pos']:] + reader['decoder'].decode(chunk, final=not chunk)
+    reader['pos'] = 0
+    reader['eof'] = not chunk
+    return bool(chunk)
+
+def _json_peek(reader):
+    """Next non-whitespace character, or '' at the end of the stream."""
+    while True:
+        reader['pos'] = _JSON_WHITESPACE.match(reader['buf'], reader['pos']).end()
+        if reader['pos'] < len(reader['buf']):
+            return reader['buf'][reader['pos']]
+        if not _json_fill(reader):
+            return ''
+
+def _json_expect(reader, chars):
+    char = _json_peek(reader)
+    if not char:
+        raise ValueError("Unexpected end of backup file")
+    if char not in chars:
+        raise ValueError(f"Expected {' or '.join(repr(c) for c in chars)} but found {char!r}")
+    reader['pos'] += 1
+    return char
+
+def _json_value(reader):
+    """Decode the next complete JSON value, reading more of the stream as needed."""
+    _json_peek(reader)
+    read_size = RESTORE_READ_CHUNK_BYTES
+    while True:
+        try:
+            value, end = _json_decoder.raw_decode(reader['buf'], reader['pos'])
+            # A number ending exactly at the buffer edge may continue in the next chunk
+            if end < len(reader['buf']) or reader['eof']:
+                reader['pos'] = end
+                return value
+        except json.JSONDecodeError:
+            if reader['eof']:
+                raise
+        _json_fill(reader, read_size)
+        read_size *= 2
+
+def _json_byte_offset(reader):
+    """Stream offset of the reader's current position (the buffer is decoded UTF-8)."""
+    pending = reader['decoder'].getstate()[0]
+    return reader['bytes_read'] - len(pending) - len(reader['buf'][reader['pos']:].encode('utf-8'))
+
+def _iter_json_array(reader):
+    if _json_peek(reader) == ']':
+        reader['pos'] += 1
+        return
+    while True:
+        yield _json_value(reader)
+        if _json_expect(reader, ',]') == ']':
+            return
+
+def _iter_json_object_tables(reader, top_level):
+    if _json_peek(reader) == '}':
+        reader['pos'] += 1
+        return
+    while True:
+        key = _json_value(reader)
+        if not isinstance(key, str):
+            raise ValueError("Backup file is not a JSON object")
+        _json_expect(reader, ':')
+        if top_level and key == 'data' and _json_peek(reader) == '{':
+            reader['pos'] += 1
+            yield from _iter_json_object_tables(reader, top_level=False)
+        elif key in BACKUP_TABLES and _json_peek(reader) == '[':
+            reader['pos'] += 1
+            records = _iter_json_array(reader)
+            yield key, records, _json_byte_offset(reader)
+            for _ in records:
+                pass
+        else:
+            _json_value(reader)
+        if _json_expect(reader, ',}') == '}':
+            return
+
+def iter_json_backup_tables(stream):
+    """
+    Yield (table_name, records, offset) for each table array of a JSON backup, in file
+    order, where offset is the byte just past the array's '['. Accepts both
+    {"data": {table: [...]}} and bare {table: [...]} documents; each records iterator
+    must be consumed before advancing to the next table.
+    """
+    stream.seek(0)
+    reader = _json_reader(stream)
+    _json_expect(reader, '{')
+    yield from _iter_json_object_tables(reader, top_level=True)
+    if _json_peek(reader):
+        raise ValueError("Unexpected data after the end of the backup")
+
+def scan_json_backup(stream):
+    """
+    Validate a whole JSON backup without keeping it. Returns (record counts, array
+    offsets) per table; the first array wins when a table appears twice.
+    """
+    counts, offsets = {}, {}
+    for table_name, records, offset in iter_json_backup_tables(stream):
+        count = sum(1 for _ in records)
+        if table_name not in counts:
+            counts[table_name] = count
+            offsets[table_name] = offset
+    return counts, offsets
+
+def iter_json_backup_table(stream, offset):
+    """Records of the table array starting at `offset`, seeking straight to it."""
+    stream.seek(offset)
+    yield from _iter_json_array(_json_reader(stream, 'utf-8'))
+
+def open_json_backup(stream):
+    """
+    Return (data, record_counts) for restore_all_data_stream, reading records lazily.
+    One pass validates the upload and notes where each table starts; each table is
+    then read from its own offset, so the file is read twice whatever the table order.
+    """
+    record_counts, offsets = scan_json_backup(stream)
+    data = {table_name: iter_json_backup_table(stream, offsets[table_name]) for table_name in record_counts}
+    return data, record_counts
+
+# ============ INCREMENTAL BACKUPS ============
+# Tables stamped with updated_at/created_at are exported as the rows changed since
+# the parent backup's watermark plus tombstones for deleted ids. The small
+# financial_years and sut_office_expenses tables are copied whole every time.
+# A restore rewrites rows with new ids but their old stamps, so every archive
+# records the restore epoch it was taken in and a restore forces a new full base.
+INCREMENTAL_TABLES = ['schools', 'departments', 'utility_bills']
+RESTORE_EPOCH_NAME = 'restore_epoch.txt'
+# Below this share of the parent's ids still live, a table is copied whole
+INCREMENTAL_MIN_ID_OVERLAP = 0.5
+
+def read_restore_epoch():
+    try:
+        with open(os.path.join(app.config['BACKUP_FOLDER'], RESTORE_EPOCH_NAME), 'r', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def record_restore_epoch():
+    """Mark that data was restored; the next incremental backup becomes a full one."""
+    try:
+        backup_folder = app.config['BACKUP_FOLDER']
+        os.makedirs(backup_folder, exist_ok=True)
+        with open(os.path.join(backup_folder, RESTORE_EPOCH_NAME), 'w', encoding='utf-8') as f:
+            f.write(datetime.now(timezone.utc).isoformat())
+    except OSError as e:
+        print(f"⚠️ Could not record restore epoch: {e}")
+
+def read_backup_ids(archive):
+    try:
+        return json.loads(gzip.decompress(archive.read(BACKUP_IDS_NAME)).decode('utf-8'))
+    except KeyError:
+        return None
+
+def find_latest_backup_archive():
+    """Newest saved archive that can parent an incremental, as (filename, manifest)."""
+    candidates = [(entry['created_at'], filename) for filename, entry in get_backup_index().items()
+                  if entry.get('chainable')]
+    if not candidates:
+        return None
+    filename = max(candidates)[1]
+    with zipfile.ZipFile(os.path.join(app.config['BACKUP_FOLDER'], filename)) as archive:
+        manifest = read_backup_manifest(archive)
+    if manifest.get('restore_epoch') != read_restore_epoch():
+        print(f"🔁 Data was restored after {filename}; taking a full backup instead")
+        return None
+    return filename, manifest
+
+def fetch_changed_rows(table_name, since):
+    changed = {}
+    for column in ('updated_at', 'created_at'):
+        for row in iter_table_rows(table_name, apply_filters=lambda q, column=column: q.gte(column, since)):
+            changed[row['id']] = row
+    return prepare_backup_rows(table_name, list(changed.values()))
+
+def fetch_live_ids(table_name):
+    try:
+        return [row['id'] for row in iter_table_rows(table_name, "id")]
+    except Exception as e:
+        print(f"⚠️ Could not list ids for {table_name}: {e}")
+        return []
+
+def write_incremental_backup(filepath, parent_filename, parent_manifest):
+    """Write the changes since `parent_filename` as an incremental archive; returns its manifest."""
+    with zipfile.ZipFile(os.path.join(app.config['BACKUP_FOLDER'], parent_filename)) as archive:
+        parent_ids = read_backup_ids(archive) or {}
+    since = {table_name: normalize_change_stamp(stamp) for table_name, stamp in parent_manifest.get('watermarks', {}).items()}
+    live_ids = {}
+    deleted = {}
+    full_tables = []
+
+    def changed_tables():
+        for table_name in BACKUP_TABLES:
+            live_ids[table_name] = fetch_live_ids(table_name)
+            current_ids = set(live_ids[table_name])
+            previous_ids = parent_ids.get(table_name, [])
+            incremental = table_name in INCREMENTAL_TABLES and since.get(table_name)
+            if incremental and previous_ids:
+                # Ids replaced wholesale (e.g. by a restore) can't be diffed by stamp
+                overlap = sum(1 for i in previous_ids if i in current_ids)
+                if overlap < INCREMENTAL_MIN_ID_OVERLAP * len(previous_ids):
+                    print(f"🔁 Only {overlap} of {len(previous_ids)} {table_name} ids survive from the parent; copying the table whole")
+                    incremental = False
+            if incremental:
+                deleted[table_name] = [i for i in previous_ids if i not in current_ids]
+                yield table_name, fetch_changed_rows(table_name, since[table_name])
+            else:
+                full_tables.append(table_name)
+                yield table_name, iter_backup_table(table_name)
+
+    return write_backup_archive(filepath, tables=changed_tables(), live_ids=live_ids, manifest_extra={
+        'type': 'incremental',
+        'parent': parent_filename,
+        'base': parent_filename if parent_manifest.get('type') != 'incremental' else parent_manifest.get('base'),
+        'since': dict(since),
+        'watermarks': since,
+        'deleted': deleted,
+        'full_tables': full_tables
+    })
+
+def load_backup_chain(filename):
+    """Replay a saved backup: its full base, then every incremental up to `filename`."""
+    backup_folder = app.config['BACKUP_FOLDER']
+    chain = []
+    name = filename
+    while True:
+        filepath = os.path.join(backup_folder, secure_filename(name))
+        if not os.path.exists(filepath):
+            raise ValueError(f"Backup {name} in the chain is missing")
+        with zipfile.ZipFile(filepath) as archive:
+            manifest = read_backup_manifest(archive)
+        chain.append((filepath, manifest))
+        if manifest.get('type') != 'incremental':
+            break
+        name = manifest.get('parent')
+        if not name or len(chain) > 1000:
+            raise ValueError(f"Backup chain for {filename} is broken")
+    chain.reverse()
+    print(f"🔗 Replaying backup chain: {[os.path.basename(p) for p, _ in chain]}")
+
+    data = {}
+    for filepath, manifest in chain:
+        with zipfile.ZipFile(filepath) as archive:
+            for table_name in manifest.get('tables', {}):
+                rows_by_id = data.setdefault(table_name, {})
+                if manifest.get('type') != 'incremental' or table_name in manifest.get('full_tables', []):
+                    rows_by_id.clear()
+                for row in iter_archive_table(archive, manifest, table_name):
+                    rows_by_id[row.get('id')] = row
+        for table_name, ids in manifest.get('deleted', {}).items():
+            rows_by_id = data.get(table_name, {})
+            for deleted_id in ids:
+                rows_by_id.pop(deleted_id, None)
+    return {table_name: prepare_backup_rows(table_name, list(rows_by_id.values()))
+            for table_name, rows_by_id in data.items()}
+
+# ============ MERGE RESTORE ============
+# Merge restores compare a digest of each backup row with the live row and only
+# write the differences. Rows keep their ids, so the id sequences must be moved
+# past the restored ids afterwards. That needs this function, created once:
+#
+#   create or replace function sync_id_sequences() returns void
+#   language plpgsql security definer as $$
+#   declare t text;
+#   begin
+#     foreach t in array array['financial_years', 'schools', 'departments',
+#                              'utility_bills', 'sut_office_expenses'] loop
+#       execute format('select setval(pg_get_serial_sequence(%L, ''id''), '
+#                      'coalesce((select max(id) from %I), 0) + 1, false)', t, t);
+#     end loop;
+#   end $$;
+SYNC_ID_SEQUENCES_RPC = 'sync_id_sequences'
+MERGE_HASH_TIMEOUT_SECONDS = float(os.environ.get('MERGE_HASH_TIMEOUT_SECONDS', 300))
+
+def normalize_for_hash(value):
+    """Make JSON-text columns and int/float numbers compare equal to their decoded forms."""
+    if isinstance(value, dict):
+        return {k: normalize_for_hash(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [normalize_for_hash(v) for v in value]
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(value, str) and value.startswith(('[', '{')):
+        try:
+            return normalize_for_hash(json.loads(value))
+        except ValueError:
+            return value
+    return value
+
+def content_hash(row):
+    canonical = json.dumps(normalize_for_hash(row), sort_keys=True, default=str)
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).digest()
+
+def load_row_hashes(table_name):
+    """{id: content_hash} for every live row of a table."""
+    try:
+        return {row['id']: content_hash(row) for row in iter_table_rows(table_name)}
+    except Exception as e:
+        print(f"⚠️ Could not read {table_name} for merge: {e}")
+        return {}
+
+def sync_id_sequences():
+    try:
+        supabase.rpc(SYNC_ID_SEQUENCES_RPC, {}).execute()
+    except Exception as e:
+        print(f"⚠️ Could not sync id sequences via {SYNC_ID_SEQUENCES_RPC} ({e}); new rows may collide with restored ids")
+
 # ============ STREAMING RESTORE GENERATOR ============
-def restore_all_data_stream(backup_data):
+# Restore insert chunks double after each successful insert (up to the row cap)
+# and halve after a failure, never exceeding the payload byte budget.
+RESTORE_MAX_CHUNK_ROWS = 1000
+RESTORE_MAX_CHUNK_BYTES = int(os.environ.get('RESTORE_MAX_CHUNK_BYTES', 1024 * 1024))
+
+# Chunks are written on a dedicated pool (separate from the query pool so restores
+# never starve page loads). Tables only wait on the tables listed here.
+RESTORE_WORKERS = int(os.environ.get('RESTORE_WORKERS', 4))
+RESTORE_MAX_IN_FLIGHT = RESTORE_WORKERS * 2
+RESTORE_DEPENDENCIES = {'utility_bills': ('schools', 'departments')}
+_restore_pool = ThreadPoolExecutor(max_workers=RESTORE_WORKERS, thread_name_prefix='restore')
+
+def restore_all_data_stream(backup_data, record_counts=None, mode='replace'):
     """
     Generator that yields progress messages as it restores data.
-    Each yield is a JSON string like {"progress": 10, "message": "Clearing tables..."}
+    Each yield is a dict like {"progress": 10, "message": "Clearing tables..."}
+    backup_data maps table names to record lists, or to one-shot iterables when
+    record_counts gives the table sizes (streamed JSON uploads).
+    mode='replace' clears every table and re-inserts rows with new ids;
+    mode='merge' keeps ids, upserts only changed rows and deletes rows missing
+    from the backup (see MERGE RESTORE).
     """
     errors = []
+    merge = mode == 'merge'
+    # Restored rows keep their old stamps, so the incremental chain must start over
+    record_restore_epoch()
     try:
-        print("🗑️ Clearing existing data...")
-        # Clear in reverse dependency order
-        yield {"progress": 5, "message": "Clearing utility bills..."}
-        try:
-            supabase.table("utility_bills").delete().neq("id", 0).execute()
-        except Exception as e:
-            errors.append(f"Failed to clear utility_bills: {str(e)}")
-            print(f"⚠️ Error clearing utility_bills: {e}")
+        if merge:
+            print("🔀 Merge restore: comparing backup with current data...")
+            yield {"progress": 5, "message": "Comparing backup with current data..."}
+            live_hashes = run_concurrently({table_name: (lambda table_name=table_name: load_row_hashes(table_name))
+                                            for table_name in BACKUP_TABLES}, timeout=MERGE_HASH_TIMEOUT_SECONDS)
+            seen_ids = {table_name: set() for table_name in BACKUP_TABLES}
+            merge_stats = {'written': 0, 'unchanged': 0, 'removed': 0}
+            yield {"progress": 25, "message": "Current data loaded, applying differences..."}
+        else:
+            print("🗑️ Clearing existing data...")
+            # Clear in reverse dependency order
+            yield {"progress": 5, "message": "Clearing utility bills..."}
+            try:
+                supabase.table("utility_bills").delete().neq("id", 0).execute()
+            except Exception as e:
+                errors.append(f"Failed to clear utility_bills: {str(e)}")
+                print(f"⚠️ Error clearing utility_bills: {e}")
         
-        yield {"progress": 10, "message": "Clearing SUT expenses..."}
-        try:
-            supabase.table("sut_office_expenses").delete().neq("id", 0).execute()
-        except Exception as e:
-            print(f"⚠️ Error clearing sut_office_expenses: {e}")
+            yield {"progress": 10, "message": "Clearing SUT expenses..."}
+            try:
+                supabase.table("sut_office_expenses").delete().neq("id", 0).execute()
+            except Exception as e:
+                print(f"⚠️ Error clearing sut_office_expenses: {e}")
         
-        yield {"progress": 15, "message": "Clearing departments..."}
-        try:
-            supabase.table("departments").delete().neq("id", 0).execute()
-        except Exception as e:
-            errors.append(f"Failed to clear departments: {str(e)}")
-            print(f"⚠️ Error clearing departments: {e}")
+            yield {"progress": 15, "message": "Clearing departments..."}
+            try:
+                supabase.table("departments").delete().neq("id", 0).execute()
+            except Exception as e:
+                errors.append(f"Failed to clear departments: {str(e)}")
+                print(f"⚠️ Error clearing departments: {e}")
         
-        yield {"progress": 20, "message": "Clearing schools..."}
-        try:
-            supabase.table("schools").delete().neq("id", 0).execute()
-        except Exception as e:
-            errors.append(f"Failed to clear schools: {str(e)}")
-            print(f"⚠️ Error clearing schools: {e}")
+            yield {"progress": 20, "message": "Clearing schools..."}
+            try:
+                supabase.table("schools").delete().neq("id", 0).execute()
+            except Exception as e:
+                errors.append(f"Failed to clear schools: {str(e)}")
+                print(f"⚠️ Error clearing schools: {e}")
         
-        yield {"progress": 25, "message": "Clearing financial years..."}
-        try:
-            supabase.table("financial_years").delete().neq("id", 0).execute()
-        except Exception as e:
-            errors.append(f"Failed to clear financial_years: {str(e)}")
-            print(f"⚠️ Error clearing financial_years: {e}")
+            yield {"progress": 25, "message": "Clearing financial years..."}
+            try:
+                supabase.table("financial_years").delete().neq("id", 0).execute()
+            except Exception as e:
+                errors.append(f"Failed to clear financial_years: {str(e)}")
+                print(f"⚠️ Error clearing financial_years: {e}")
 
         # Prepare data
         financial_years = backup_data.get('financial_years', [])
@@ -240,29 +1146,40 @@ def restore_all_data_stream(backup_data):
         departments = backup_data.get('departments', [])
         bills = backup_data.get('utility_bills', [])
         sut_expenses = backup_data.get('sut_office_expenses', [])
+        if record_counts is None:
+            record_counts = {table_name: len(records) for table_name, records in backup_data.items()}
+        counts = {table_name: record_counts.get(table_name, 0) for table_name in BACKUP_TABLES}
 
-        print(f"📊 Data counts: FY={len(financial_years)}, Schools={len(schools)}, Depts={len(departments)}, Bills={len(bills)}, SUT={len(sut_expenses)}")
+        print(f"📊 Data counts: FY={counts['financial_years']}, Schools={counts['schools']}, Depts={counts['departments']}, Bills={counts['utility_bills']}, SUT={counts['sut_office_expenses']}")
 
+        # Merge restores keep ids so entity references stay valid
         def remove_id(records):
-            return [{k: v for k, v in r.items() if k != 'id'} for r in records]
+            return ({k: v for k, v in r.items() if k != 'id' or merge} for r in records)
 
         # Prepare functions for nested JSON
         def prepare_school(school):
-            school_copy = {k: v for k, v in school.items() if k != 'id'}
+            school_copy = {k: v for k, v in school.items() if k != 'id' or merge}
             for field in ['water_accounts', 'electricity_accounts', 'telephone_accounts']:
                 if field in school_copy and isinstance(school_copy[field], (list, dict)):
                     school_copy[field] = json.dumps(school_copy[field])
             return school_copy
 
         def prepare_department(dept):
-            dept_copy = {k: v for k, v in dept.items() if k != 'id'}
+            dept_copy = {k: v for k, v in dept.items() if k != 'id' or merge}
             for field in ['water_accounts', 'electricity_accounts', 'telephone_accounts']:
                 if field in dept_copy and isinstance(dept_copy[field], (list, dict)):
                     dept_copy[field] = json.dumps(dept_copy[field])
             return dept_copy
 
         def prepare_bill(bill):
-            bill_copy = {k: v for k, v in bill.items() if k != 'id'}
+            bill_copy = {k: v for k, v in bill.items() if k != 'id' or merge}
+            if merge:
+                # Keep backup values as they are (NULL stays NULL) so unchanged rows hash
+                # equal to the live ones; JSON columns only need encoding for the write
+                for field in ('notes', 'bill_image'):
+                    if isinstance(bill_copy.get(field), (list, dict)):
+                        bill_copy[field] = json.dumps(bill_copy[field])
+                return bill_copy
             # Ensure numeric fields are floats
             numeric_fields = ['current_charges', 'late_charges', 'unsettled_charges', 
                               'amount_paid', 'consumption_m3', 'consumption_kwh']
@@ -277,117 +1194,172 @@ def restore_all_data_stream(backup_data):
                     bill_copy[field] = 0.0
             # Handle telephone notes
             if bill.get('utility_type') == 'telephone':
-                account_number = bill_copy.get('account_number', '')
-                current_charges = bill_copy.get('current_charges', 0.0)
-                unsettled_charges = bill_copy.get('unsettled_charges', 0.0)
-                amount_paid = bill_copy.get('amount_paid', 0.0)
-                bill_number = bill_copy.get('bill_number', '')
-                notes_obj = {}
-                try:
-                    if bill_copy.get('notes'):
-                        notes_obj = json.loads(bill_copy['notes'])
-                    if not isinstance(notes_obj, dict):
-                        notes_obj = {}
-                except:
-                    notes_obj = {}
-                if 'accounts' not in notes_obj:
-                    notes_obj['accounts'] = {}
-                if account_number not in notes_obj['accounts']:
-                    notes_obj['accounts'][account_number] = {
-                        'accountNumber': account_number,
-                        'billNumber': bill_number,
-                        'totalAccountCharges': current_charges,
-                        'previousOutstanding': unsettled_charges,
-                        'previousPayment': 0.0,
-                        'totalCurrentCharges': current_charges + unsettled_charges,
-                        'amountPaid': amount_paid,
-                        'phones': [],
-                        'notes': ''
-                    }
-                bill_copy['notes'] = json.dumps(notes_obj)
+                bill_copy['notes'] = with_default_telephone_account(
+                    bill_copy.get('notes'), bill_copy.get('account_number', ''), bill_copy.get('bill_number', ''),
+                    bill_copy.get('current_charges', 0.0), bill_copy.get('unsettled_charges', 0.0),
+                    bill_copy.get('amount_paid', 0.0))
             else:
                 if 'bill_image' in bill_copy and isinstance(bill_copy['bill_image'], (list, dict)):
                     bill_copy['bill_image'] = json.dumps(bill_copy['bill_image'])
             return bill_copy
 
-        # Helper to batch insert with progress
-        def batch_insert(table_name, records, chunk_size=20, progress_start=0, progress_step=0):
-            if not records:
-                return
-            total = len(records)
-            for i in range(0, total, chunk_size):
-                chunk = records[i:i+chunk_size]
-                try:
+        def write_chunk(table_name, chunk, offset, split=False):
+            """
+            Insert (or upsert) one chunk on the restore pool. A failing chunk is halved
+            until the bad rows are isolated. Returns (ok, progress_points, row_errors)
+            where progress_points are (rows_done, message_suffix) pairs.
+            """
+            try:
+                if merge:
+                    supabase.table(table_name).upsert(chunk, on_conflict="id").execute()
+                else:
                     supabase.table(table_name).insert(chunk).execute()
-                    current_progress = progress_start + (i / total) * progress_step
-                    yield {"progress": int(current_progress), "message": f"Inserting {table_name} ({i+len(chunk)}/{total})"}
-                except Exception as e:
-                    # If chunk fails, try individual inserts
-                    for idx, record in enumerate(chunk):
-                        try:
-                            supabase.table(table_name).insert(record).execute()
-                            current_progress = progress_start + ((i+idx+1) / total) * progress_step
-                            yield {"progress": int(current_progress), "message": f"Inserting {table_name} ({i+idx+1}/{total}) - individual"}
-                        except Exception as ind_e:
-                            errors.append(f"Failed to insert row {i+idx+1} in {table_name}: {ind_e}")
-                            print(f"   ❌ Row {i+idx+1} failed: {ind_e}")
-            yield {"progress": int(progress_start + progress_step), "message": f"Finished {table_name}"}
-
-        # Insert in order with progress tracking
-        total_steps = 100
-        current_progress = 30
-
-        if financial_years:
-            yield from batch_insert('financial_years', remove_id(financial_years), chunk_size=10,
-                                    progress_start=current_progress, progress_step=10)
-            current_progress += 10
-        else:
-            current_progress += 10
-            yield {"progress": current_progress, "message": "No financial years to insert"}
-
-        if schools:
-            prepared_schools = [prepare_school(s) for s in schools]
-            yield from batch_insert('schools', prepared_schools, chunk_size=10,
-                                    progress_start=current_progress, progress_step=15)
-            current_progress += 15
-        else:
-            current_progress += 15
-            yield {"progress": current_progress, "message": "No schools to insert"}
-
-        if departments:
-            prepared_depts = [prepare_department(d) for d in departments]
-            yield from batch_insert('departments', prepared_depts, chunk_size=10,
-                                    progress_start=current_progress, progress_step=15)
-            current_progress += 15
-        else:
-            current_progress += 15
-            yield {"progress": current_progress, "message": "No departments to insert"}
-
-        if bills:
-            prepared_bills = [prepare_bill(b) for b in bills]
-            yield from batch_insert('utility_bills', prepared_bills, chunk_size=10,
-                                    progress_start=current_progress, progress_step=20)
-            current_progress += 20
-        else:
-            current_progress += 20
-            yield {"progress": current_progress, "message": "No bills to insert"}
-
-        if sut_expenses:
-            yield from batch_insert('sut_office_expenses', remove_id(sut_expenses), chunk_size=10,
-                                    progress_start=current_progress, progress_step=10)
-            current_progress += 10
-        else:
-            current_progress += 10
-            yield {"progress": current_progress, "message": "No SUT expenses to insert"}
+            except Exception as e:
+                if len(chunk) == 1:
+                    if merge:
+                        print(f"   ❌ Id {chunk[0].get('id')} failed: {e}")
+                        return False, [], [f"Failed to upsert id {chunk[0].get('id')} in {table_name}: {e}"]
+                    print(f"   ❌ Row {offset+1} failed: {e}")
+                    return False, [], [f"Failed to insert row {offset+1} in {table_name}: {e}"]
+                print(f"⚠️ Insert of {len(chunk)} {table_name} rows failed ({e}), splitting")
+                mid = len(chunk) // 2
+                _, first_points, first_errors = write_chunk(table_name, chunk[:mid], offset, split=True)
+                _, second_points, second_errors = write_chunk(table_name, chunk[mid:], offset + mid, split=True)
+                return False, first_points + second_points, first_errors + second_errors
+            suffix = (" - individual" if len(chunk) == 1 else " - split") if split else ""
+            return True, [(offset + len(chunk), suffix)], []
+
+        def changed_records(table_name, records):
+            """Yield only the backup rows whose content differs from the live row."""
+            hashes = live_hashes[table_name]
+            for record in records:
+                seen_ids[table_name].add(record.get('id'))
+                if record.get('id') in hashes and hashes[record['id']] == content_hash(record):
+                    merge_stats['unchanged'] += 1
+                    continue
+                yield record
+
+        def iter_chunks(records, state):
+            """Group records into chunks of state['chunk_size'] rows within the byte budget."""
+            chunk, chunk_bytes = [], 0
+            for record in records:
+                size = len(json.dumps(record, default=str))
+                if chunk and (len(chunk) >= state['chunk_size'] or chunk_bytes + size > RESTORE_MAX_CHUNK_BYTES):
+                    yield chunk
+                    chunk, chunk_bytes = [], 0
+                chunk.append(record)
+                chunk_bytes += size
+            if chunk:
+                yield chunk
+
+        def restore_tables(plan):
+            """
+            Insert the plan's tables through the restore pool. Records are read in plan
+            order (streamed uploads can only be read once, front to back) while chunks of
+            independent tables are written concurrently; a table's first chunk waits for
+            the tables it depends on. Progress is yielded in submission order.
+            """
+            in_flight = collections.deque()
+            finished = set()
+            states = {}
+
+            def drain_one():
+                kind, table_name, payload = in_flight.popleft()
+                state = states[table_name]
+                if kind == 'chunk':
+                    future, chunk_len = payload
+                    ok, points, row_errors = future.result()
+                    errors.extend(row_errors)
+                    if merge:
+                        # write_chunk reports one error per row it could not write
+                        merge_stats['written'] += chunk_len - len(row_errors)
+                    state['chunk_size'] = min(state['chunk_size'] * 2, RESTORE_MAX_CHUNK_ROWS) if ok else max(state['chunk_size'] // 2, 1)
+                    for done, suffix in points:
+                        progress = state['progress_start'] + (done / max(state['total'], done)) * state['progress_step']
+                        yield {"progress": int(progress), "message": f"Inserting {table_name} ({done}/{state['total']}){suffix}"}
+                else:
+                    finished.add(table_name)
+                    yield payload
+
+            for table_name, records, chunk_size, progress_start, progress_step, empty_message in plan:
+                states[table_name] = {'chunk_size': chunk_size, 'total': counts[table_name],
+                                      'progress_start': progress_start, 'progress_step': progress_step}
+                if not counts[table_name]:
+                    in_flight.append(('done', table_name, {"progress": progress_start + progress_step, "message": empty_message}))
+                    continue
+                records = iter(records)
+                if merge:
+                    records = changed_records(table_name, records)
+                waiting_on_dependencies = True
+                offset = 0
+                for chunk in iter_chunks(records, states[table_name]):
+                    while waiting_on_dependencies and not finished.issuperset(RESTORE_DEPENDENCIES.get(table_name, ())):
+                        if not in_flight:
+                            break
+                        yield from drain_one()
+                    waiting_on_dependencies = False
+                    while len(in_flight) >= RESTORE_MAX_IN_FLIGHT:
+                        yield from drain_one()
+                    future = _restore_pool.submit(write_chunk, table_name, chunk, offset)
+                    in_flight.append(('chunk', table_name, (future, len(chunk))))
+                    offset += len(chunk)
+                in_flight.append(('done', table_name, {"progress": int(progress_start + progress_step), "message": f"Finished {table_name}"}))
+
+            while in_flight:
+                yield from drain_one()
+
+        # Insert in dependency order with progress tracking
+        yield from restore_tables([
+            ('financial_years', remove_id(financial_years), 10, 30, 10, "No financial years to insert"),
+            ('schools', (prepare_school(s) for s in schools), 10, 40, 15, "No schools to insert"),
+            ('departments', (prepare_department(d) for d in departments), 10, 55, 15, "No departments to insert"),
+            ('utility_bills', (prepare_bill(b) for b in bills), 10, 70, 20, "No bills to insert"),
+            ('sut_office_expenses', remove_id(sut_expenses), 10, 90, 10, "No SUT expenses to insert"),
+        ])
 
+        if merge:
+            # Children first; tables absent from the backup are left untouched
+            for table_name in reversed(BACKUP_TABLES):
+                if table_name not in backup_data:
+                    continue
+                stale_ids = [row_id for row_id in live_hashes[table_name] if row_id not in seen_ids[table_name]]
+                for i in range(0, len(stale_ids), BATCH_UPSERT_CHUNK_SIZE):
+                    chunk = stale_ids[i:i + BATCH_UPSERT_CHUNK_SIZE]
+                    try:
+                        supabase.table(table_name).delete().in_("id", chunk).execute()
+                        merge_stats['removed'] += len(chunk)
+                    except Exception as e:
+                        errors.append(f"Failed to delete {len(chunk)} stale rows in {table_name}: {e}")
+                        print(f"⚠️ Error deleting stale {table_name} rows: {e}")
+                if stale_ids:
+                    yield {"progress": 99, "message": f"Removed {len(stale_ids)} {table_name} rows missing from the backup"}
+            sync_id_sequences()
+
+        invalidate_entity_registry()
+        bump_write_version(*BACKUP_TABLES)
+        if not merge or 'utility_bills' in backup_data:
+            # Bills were rewritten wholesale, so regenerate rather than re-sum per key
+            rebuild_rollup_after_bulk_write("restore")
         if errors:
-            yield {"progress": 100, "message": "Restore completed with errors", "errors": errors}
+            summary = {"progress": 100, "message": "Restore completed with errors", "errors": errors}
+            if merge:
+                print(f"⚠️ Merge restore with errors: {merge_stats}")
+                summary["stats"] = merge_stats
+            yield summary
+        elif merge:
+            print(f"✅ Merge restore: {merge_stats}")
+            yield {"progress": 100, "message": f"Merge completed successfully! {merge_stats['written']} rows written, "
+                                               f"{merge_stats['unchanged']} unchanged, {merge_stats['removed']} removed.",
+                   "stats": merge_stats}
         else:
             yield {"progress": 100, "message": "Restore completed successfully!"}
 
     except Exception as e:
         print(f"❌ Fatal error in restore_all_data_stream: {e}")
         traceback.print_exc()
+        invalidate_entity_registry()
+        bump_write_version(*BACKUP_TABLES)
+        mark_rollup_stale("restore aborted")
         yield {"progress": 100, "message": f"Fatal error: {str(e)}", "errors": [str(e)]}
 
 # ============ BACKUP API ROUTES ============
@@ -400,34 +1372,30 @@ def backup_all_data():
         backup_path = app.config['BACKUP_FOLDER']
         if not os.path.exists(backup_path):
             os.makedirs(backup_path, exist_ok=True)
-        data = get_all_data_with_order()
-        backup_data = {
-            'version': '1.0',
-            'created_at': datetime.now().isoformat(),
-            'description': 'UKA BILL System Backup',
-            'order_preserved': True,
-            'records_count': {
-                'financial_years': len(data.get('financial_years', [])),
-                'schools': len(data.get('schools', [])),
-                'departments': len(data.get('departments', [])),
-                'utility_bills': len(data.get('utility_bills', [])),
-                'sut_office_expenses': len(data.get('sut_office_expenses', []))
-            },
-            'data': data
-        }
-        backup_json = json.dumps(backup_data, indent=2, default=str)
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"uka_bill_backup_{timestamp}.json"
-        backup_filepath = os.path.join(backup_path, filename)
-        with open(backup_filepath, 'w', encoding='utf-8') as f:
-            f.write(backup_json)
-        print(f"✅ Backup created and saved to: {backup_filepath}")
+        parent = find_latest_backup_archive() if request.args.get('mode') == 'incremental' else None
+        if parent:
+            filename = f"uka_bill_backup_{timestamp}_incr.zip"
+            backup_filepath = os.path.join(backup_path, filename)
+            print(f"🧩 Incremental backup on top of {parent[0]}")
+            manifest = write_incremental_backup(backup_filepath, *parent)
+        else:
+            filename = f"uka_bill_backup_{timestamp}.zip"
+            backup_filepath = os.path.join(backup_path, filename)
+            manifest = write_backup_archive(backup_filepath)
+        records_count = manifest['records_count']
+        record_backup_in_index(filename)
+        size = os.path.getsize(backup_filepath)
+        print(f"✅ Backup created and saved to: {backup_filepath} ({format_file_size(size)})")
         return jsonify({
             'success': True,
             'message': 'Backup created successfully! Order preserved.',
             'backup_filename': filename,
-            'backup_content': backup_json,
-            'records_count': backup_data['records_count']
+            'type': manifest['type'],
+            'parent': manifest.get('parent'),
+            'size': size,
+            'size_formatted': format_file_size(size),
+            'records_count': records_count
         })
     except Exception as e:
         print(f"❌ Backup error: {e}")
@@ -440,26 +1408,14 @@ def download_backup_direct():
         print("💾 GET /api/backup/download-direct called")
         if not supabase:
             return jsonify({'error': 'Database not connected'}), 500
-        data = get_all_data_with_order()
-        backup_data = {
-            'version': '1.0',
-            'created_at': datetime.now().isoformat(),
-            'description': 'UKA BILL System Backup',
-            'order_preserved': True,
-            'records_count': {
-                'financial_years': len(data.get('financial_years', [])),
-                'schools': len(data.get('schools', [])),
-                'departments': len(data.get('departments', [])),
-                'utility_bills': len(data.get('utility_bills', [])),
-                'sut_office_expenses': len(data.get('sut_office_expenses', []))
-            },
-            'data': data
-        }
-        backup_json = json.dumps(backup_data, indent=2, default=str)
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         filename = f"uka_bill_backup_{timestamp}.json"
-        response = make_response(backup_json)
-        response.headers['Content-Type'] = 'application/json'
+
+        def generate():
+            for chunk in iter_backup_json({}):
+                yield chunk.encode('utf-8')
+
+        response = Response(stream_with_context(generate()), mimetype='application/json')
         response.headers['Content-Disposition'] = f'attachment; filename={filename}'
         return response
     except Exception as e:
@@ -474,25 +1430,16 @@ def list_backups():
         backups = []
         if not os.path.exists(backup_folder):
             os.makedirs(backup_folder, exist_ok=True)
-        if os.path.exists(backup_folder):
-            for filename in os.listdir(backup_folder):
-                if filename.endswith('.json'):
-                    filepath = os.path.join(backup_folder, filename)
-                    stat = os.stat(filepath)
-                    records_count = {}
-                    try:
-                        with open(filepath, 'r', encoding='utf-8') as f:
-                            backup_data = json.load(f)
-                            records_count = backup_data.get('records_count', {})
-                    except:
-                        pass
-                    backups.append({
-                        'filename': filename,
-                        'created': datetime.fromtimestamp(stat.st_mtime).isoformat(),
-                        'size': stat.st_size,
-                        'size_formatted': format_file_size(stat.st_size),
-                        'records_count': records_count
-                    })
+        for filename, entry in get_backup_index().items():
+            backups.append({
+                'filename': filename,
+                'created': datetime.fromtimestamp(entry['mtime']).isoformat(),
+                'size': entry['size'],
+                'size_formatted': format_file_size(entry['size']),
+                'records_count': entry.get('records_count', {}),
+                'type': entry.get('type', 'full'),
+                'parent': entry.get('parent')
+            })
         backups.sort(key=lambda x: x['created'], reverse=True)
         return jsonify({
             'success': True,
@@ -515,7 +1462,7 @@ def download_backup(filename):
             filepath,
             as_attachment=True,
             download_name=filename,
-            mimetype='application/json'
+            mimetype='application/zip' if filename.endswith('.zip') else 'application/json'
         )
     except Exception as e:
         print(f"❌ Download backup error: {e}")
@@ -529,7 +1476,16 @@ def delete_backup(filename):
         filepath = os.path.join(app.config['BACKUP_FOLDER'], filename)
         if not os.path.exists(filepath):
             return jsonify({'error': 'Backup file not found'}), 404
+        # Incremental backups built on this file can't be restored without it
+        dependents = sorted(name for name, entry in get_backup_index().items() if entry.get('parent') == filename)
+        if dependents and request.args.get('force') != 'true':
+            return jsonify({
+                'error': f"Backup {filename} is the parent of incremental backup(s) {', '.join(dependents)}; "
+                         f"delete those first (or pass force=true)",
+                'dependents': dependents
+            }), 409
         os.remove(filepath)
+        remove_backup_from_index(filename)
         return jsonify({
             'success': True,
             'message': f'Backup file {filename} deleted successfully'
@@ -539,6 +1495,72 @@ def delete_backup(filename):
         return jsonify({'error': f'Delete failed: {str(e)}'}), 500
 
 # ============ STREAMING RESTORE ENDPOINT ============
+RESTORE_MODES = ('replace', 'merge')
+
+def get_restore_mode():
+    """Restore mode from the form or query string; None if it is not recognised."""
+    mode = request.form.get('mode') or request.args.get('mode') or 'replace'
+    return mode if mode in RESTORE_MODES else None
+
+# Progress lines are coalesced to at most this many per second (the newest wins);
+# a heartbeat line keeps proxies from closing the stream during long gaps.
+RESTORE_PROGRESS_MAX_PER_SECOND = int(os.environ.get('RESTORE_PROGRESS_MAX_PER_SECOND', 5))
+RESTORE_HEARTBEAT_SECONDS = int(os.environ.get('RESTORE_HEARTBEAT_SECONDS', 10))
+
+def stream_restore_progress(data_to_restore, record_counts=None, mode='replace'):
+    """
+    Run a restore on a background thread and stream its progress as JSON lines.
+    Messages carrying errors and the final 100% message are never dropped.
+    """
+    messages = queue.Queue()
+    stop = threading.Event()
+    finished = object()
+
+    def run():
+        restore = restore_all_data_stream(data_to_restore, record_counts, mode)
+        try:
+            for progress_msg in restore:
+                messages.put(progress_msg)
+                if stop.is_set():
+                    print("⚠️ Restore stream closed by client, stopping restore")
+                    break
+        finally:
+            restore.close()
+            messages.put(finished)
+
+    def generate():
+        threading.Thread(target=run, name='restore-stream', daemon=True).start()
+        min_interval = 1.0 / RESTORE_PROGRESS_MAX_PER_SECOND
+        last_sent = time.time()
+        held = None
+        try:
+            while True:
+                if held is None:
+                    timeout = last_sent + RESTORE_HEARTBEAT_SECONDS - time.time()
+                else:
+                    timeout = last_sent + min_interval - time.time()
+                try:
+                    progress_msg = messages.get(timeout=max(0, timeout))
+                except queue.Empty:
+                    yield json.dumps(held if held is not None else {"heartbeat": True}) + '\n'
+                    held = None
+                    last_sent = time.time()
+                    continue
+                if progress_msg is finished:
+                    if held is not None:
+                        yield json.dumps(held) + '\n'
+                    break
+                if progress_msg.get('errors') or progress_msg.get('progress') == 100 or time.time() - last_sent >= min_interval:
+                    yield json.dumps(progress_msg) + '\n'
+                    held = None
+                    last_sent = time.time()
+                else:
+                    held = progress_msg
+        finally:
+            stop.set()
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
 @app.route('/api/restore/stream', methods=['POST'])
 def restore_backup_stream():
     try:
@@ -553,42 +1575,67 @@ def restore_backup_stream():
         if file.filename == '':
             return jsonify({'error': 'No file selected'}), 400
 
-        if not file.filename.endswith('.json'):
-            return jsonify({'error': 'Only JSON backup files are supported'}), 400
+        if not file.filename.endswith(('.json', '.zip')):
+            return jsonify({'error': 'Only JSON or compressed (.zip) backup files are supported'}), 400
 
-        try:
-            backup_content = file.read().decode('utf-8')
-        except UnicodeDecodeError:
-            return jsonify({'error': 'File is not valid UTF-8'}), 400
+        mode = get_restore_mode()
+        if not mode:
+            return jsonify({'error': 'Restore mode must be "replace" or "merge"'}), 400
 
-        file_size = len(backup_content)
-        print(f"📄 File size: {file_size} bytes")
+        if is_backup_archive(file.stream):
+            print("📦 Compressed backup archive detected")
+            try:
+                data_to_restore = read_backup_archive(file.stream)
+            except (ValueError, KeyError, zipfile.BadZipFile, OSError) as e:
+                return jsonify({'error': f'Invalid backup archive: {str(e)}'}), 400
+            record_counts = None
+        else:
+            file_size = file.stream.seek(0, os.SEEK_END)
+            print(f"📄 File size: {file_size} bytes")
 
-        if file_size == 0 or backup_content.strip() == '':
-            return jsonify({'error': 'Backup file is empty'}), 400
+            if file_size == 0:
+                return jsonify({'error': 'Backup file is empty'}), 400
 
-        if backup_content.startswith('\ufeff'):
-            backup_content = backup_content[1:]
-            print("🔍 Removed UTF-8 BOM")
+            # Validate the whole upload first, then restore it record by record
+            try:
+                data_to_restore, record_counts = open_json_backup(file.stream)
+            except UnicodeDecodeError:
+                return jsonify({'error': 'File is not valid UTF-8'}), 400
+            except ValueError as e:
+                return jsonify({'error': f'Invalid JSON: {str(e)}'}), 400
 
-        try:
-            backup_data = json.loads(backup_content)
-        except json.JSONDecodeError as e:
-            return jsonify({'error': f'Invalid JSON: {str(e)}'}), 400
+        return stream_restore_progress(data_to_restore, record_counts, mode)
 
-        # Extract the actual data
-        data_to_restore = backup_data.get('data', backup_data)
+    except Exception as e:
+        print(f"❌ Restore stream error: {e}")
+        print(traceback.format_exc())
+        return jsonify({'error': f'Restore failed: {str(e)}'}), 500
 
-        # Define generator that yields progress messages
-        def generate():
-            for progress_msg in restore_all_data_stream(data_to_restore):
-                yield json.dumps(progress_msg) + '\n'
-                time.sleep(0.1)  # small delay to allow client to read
+@app.route('/api/backup/restore-chain/<path:filename>', methods=['POST'])
+def restore_backup_chain(filename):
+    """Restore a saved backup, replaying incremental backups on top of their full base."""
+    try:
+        print(f"💾 POST /api/backup/restore-chain/{filename} called")
+        if not supabase:
+            return jsonify({'error': 'Database not connected'}), 500
+
+        filepath = os.path.join(app.config['BACKUP_FOLDER'], secure_filename(filename))
+        if not filename.endswith('.zip') or not os.path.exists(filepath):
+            return jsonify({'error': 'Backup archive not found'}), 404
 
-        return Response(stream_with_context(generate()), mimetype='application/json')
+        mode = get_restore_mode()
+        if not mode:
+            return jsonify({'error': 'Restore mode must be "replace" or "merge"'}), 400
+
+        try:
+            data_to_restore = load_backup_chain(filename)
+        except (ValueError, KeyError, zipfile.BadZipFile, OSError) as e:
+            return jsonify({'error': f'Invalid backup archive: {str(e)}'}), 400
+
+        return stream_restore_progress(data_to_restore, mode=mode)
 
     except Exception as e:
-        print(f"❌ Restore stream error: {e}")
+        print(f"❌ Restore chain error: {e}")
         print(traceback.format_exc())
         return jsonify({'error': f'Restore failed: {str(e)}'}), 500
 
@@ -607,24 +1654,27 @@ def restore_backup():
         if file.filename == '':
             return jsonify({'error': 'No file selected'}), 400
 
-        if not file.filename.endswith('.json'):
-            return jsonify({'error': 'Only JSON backup files are supported'}), 400
+        if not file.filename.endswith(('.json', '.zip')):
+            return jsonify({'error': 'Only JSON or compressed (.zip) backup files are supported'}), 400
 
-        try:
-            backup_content = file.read().decode('utf-8')
-        except UnicodeDecodeError:
-            return jsonify({'error': 'File is not valid UTF-8'}), 400
-
-        if backup_content.startswith('\ufeff'):
-            backup_content = backup_content[1:]
+        mode = get_restore_mode()
+        if not mode:
+            return jsonify({'error': 'Restore mode must be "replace" or "merge"'}), 400
 
-        try:
-            backup_data = json.loads(backup_content)
-        except json.JSONDecodeError as e:
-            return jsonify({'error': f'Invalid JSON: {str(e)}'}), 400
-
-        data_to_restore = backup_data.get('data', backup_data)
-        result = restore_all_data(data_to_restore)
+        if is_backup_archive(file.stream):
+            try:
+                data_to_restore = read_backup_archive(file.stream)
+            except (ValueError, KeyError, zipfile.BadZipFile, OSError) as e:
+                return jsonify({'error': f'Invalid backup archive: {str(e)}'}), 400
+            record_counts = None
+        else:
+            try:
+                data_to_restore, record_counts = open_json_backup(file.stream)
+            except UnicodeDecodeError:
+                return jsonify({'error': 'File is not valid UTF-8'}), 400
+            except ValueError as e:
+                return jsonify({'error': f'Invalid JSON: {str(e)}'}), 400
+        result = restore_all_data(data_to_restore, record_counts, mode)
 
         if result['success']:
             return jsonify({'success': True, 'message': 'Data restored successfully!'})
@@ -635,10 +1685,10 @@ def restore_backup():
         print(f"❌ Restore backup error: {e}")
         return jsonify({'error': f'Restore failed: {str(e)}'}), 500
 
-def restore_all_data(backup_data):
+def restore_all_data(backup_data, record_counts=None, mode='replace'):
     errors = []
     try:
-        for msg in restore_all_data_stream(backup_data):
+        for msg in restore_all_data_stream(backup_data, record_counts, mode):
             if msg.get('errors'):
                 errors.extend(msg['errors'])
         return {'success': len(errors) == 0, 'errors': errors}
@@ -652,62 +1702,40 @@ def migrate_all_bills():
         if not supabase:
             return jsonify({'error': 'Database not connected'}), 500
 
-        # Fetch all bills
-        response = supabase.table("utility_bills").select("*").execute()
-        bills = response.data if response.data else []
-        print(f"📊 Found {len(bills)} bills to migrate")
-
+        # Page through all bills by id; updating rows mid-scan is safe with keyset paging
         updated = 0
-        for bill in bills:
-            bill_id = bill['id']
-            utility_type = bill.get('utility_type')
-            update_data = {}
-
-            numeric_fields = ['current_charges', 'late_charges', 'unsettled_charges', 
-                              'amount_paid', 'consumption_m3', 'consumption_kwh']
-            for field in numeric_fields:
-                if field in bill:
-                    try:
-                        val = float(bill[field]) if bill[field] is not None else 0.0
-                        update_data[field] = val
-                    except (ValueError, TypeError):
+        try:
+            for bill in iter_table_rows("utility_bills"):
+                bill_id = bill['id']
+                utility_type = bill.get('utility_type')
+                update_data = {}
+
+                numeric_fields = ['current_charges', 'late_charges', 'unsettled_charges', 
+                                  'amount_paid', 'consumption_m3', 'consumption_kwh']
+                for field in numeric_fields:
+                    if field in bill:
+                        try:
+                            val = float(bill[field]) if bill[field] is not None else 0.0
+                            update_data[field] = val
+                        except (ValueError, TypeError):
+                            update_data[field] = 0.0
+                    else:
                         update_data[field] = 0.0
-                else:
-                    update_data[field] = 0.0
-
-            if utility_type == 'telephone':
-                account_number = bill.get('account_number', '')
-                current_charges = update_data.get('current_charges', 0.0)
-                unsettled_charges = update_data.get('unsettled_charges', 0.0)
-                amount_paid = update_data.get('amount_paid', 0.0)
-                bill_number = bill.get('bill_number', '')
-                notes_obj = {}
-                try:
-                    if bill.get('notes'):
-                        notes_obj = json.loads(bill['notes'])
-                    if not isinstance(notes_obj, dict):
-                        notes_obj = {}
-                except:
-                    notes_obj = {}
-                if 'accounts' not in notes_obj:
-                    notes_obj['accounts'] = {}
-                if account_number not in notes_obj['accounts']:
-                    notes_obj['accounts'][account_number] = {
-                        'accountNumber': account_number,
-                        'billNumber': bill_number,
-                        'totalAccountCharges': current_charges,
-                        'previousOutstanding': unsettled_charges,
-                        'previousPayment': 0.0,
-                        'totalCurrentCharges': current_charges + unsettled_charges,
-                        'amountPaid': amount_paid,
-                        'phones': [],
-                        'notes': ''
-                    }
-                update_data['notes'] = json.dumps(notes_obj)
 
-            if update_data:
-                supabase.table("utility_bills").update(update_data).eq("id", bill_id).execute()
-                updated += 1
+                if utility_type == 'telephone':
+                    update_data['notes'] = with_default_telephone_account(
+                        bill.get('notes'), bill.get('account_number', ''), bill.get('bill_number', ''),
+                        update_data.get('current_charges', 0.0), update_data.get('unsettled_charges', 0.0),
+                        update_data.get('amount_paid', 0.0))
+
+                if update_data:
+                    update_data['updated_at'] = datetime.now().isoformat()
+                    supabase.table("utility_bills").update(update_data).eq("id", bill_id).execute()
+                    bump_write_version("utility_bills")
+                    updated += 1
+        finally:
+            # Money fields were rewritten, so regenerate the rollup rather than re-sum per key
+            rebuild_rollup_after_bulk_write("migration")
 
         return jsonify({
             'success': True,
@@ -718,6 +1746,26 @@ def migrate_all_bills():
         print(f"❌ Migration error: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/rollup/rebuild', methods=['POST'])
+def rebuild_rollup():
+    try:
+        if not supabase:
+            return jsonify({'error': 'Database not connected'}), 500
+        stats = rebuild_monthly_rollup()
+        return jsonify({
+            'success': True,
+            'message': f"Rebuilt {stats['rows']} rollup rows from {stats['bills']} bills",
+            'stats': stats
+        })
+    except Exception as e:
+        print(f"❌ Rollup rebuild error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.cli.command('rebuild-rollup')
+def rebuild_rollup_command():
+    """Regenerate bill_monthly_rollup from utility_bills."""
+    rebuild_monthly_rollup()
+
 # ============ EXPORT FUNCTIONS ============
 @app.route('/api/export-data', methods=['GET'])
 def export_data_single():
@@ -725,18 +1773,16 @@ def export_data_single():
         export_type = request.args.get('type', '')
         if not export_type:
             return jsonify({'error': 'No export type specified'}), 400
-        if export_type == 'schools':
-            return export_schools_csv()
-        elif export_type == 'departments':
-            return export_departments_csv()
-        elif export_type == 'water_bills':
-            return export_water_bills_csv()
-        elif export_type == 'electricity_bills':
-            return export_electricity_bills_csv()
-        elif export_type == 'telephone_bills':
-            return export_telephone_bills_csv()
-        else:
+        dataset = EXPORT_DATASETS.get(export_type)
+        if not dataset and export_type != 'utility_bills_parquet':
             return jsonify({'error': 'Invalid export type'}), 400
+        try:
+            filters = parse_export_filters(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if export_type == 'utility_bills_parquet':
+            return export_bills_parquet(filters, request.args.get('utility_type'))
+        return csv_download_response(dataset['header'], dataset['rows'](filters), dataset['filename'])
     except Exception as e:
         print(f"❌ Export error: {e}")
         return jsonify({'error': str(e)}), 500
@@ -747,556 +1793,528 @@ def export_multiple():
         data = request.get_json()
         exports = data.get('exports', [])
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            for export in exports:
-                export_type = export.get('type')
-                if export_type == 'schools':
-                    csv_content = export_schools_csv_to_string()
-                    zip_file.writestr(f"schools_{timestamp}.csv", csv_content)
-                elif export_type == 'departments':
-                    csv_content = export_departments_csv_to_string()
-                    zip_file.writestr(f"departments_{timestamp}.csv", csv_content)
-                elif export_type == 'water_bills':
-                    csv_content = export_water_bills_csv_to_string()
-                    zip_file.writestr(f"water_bills_{timestamp}.csv", csv_content)
-                elif export_type == 'electricity_bills':
-                    csv_content = export_electricity_bills_csv_to_string()
-                    zip_file.writestr(f"electricity_bills_{timestamp}.csv", csv_content)
-                elif export_type == 'telephone_bills':
-                    csv_content = export_telephone_bills_csv_to_string()
-                    zip_file.writestr(f"telephone_bills_{timestamp}.csv", csv_content)
-        zip_buffer.seek(0)
-        response = make_response(zip_buffer.getvalue())
-        response.headers['Content-Type'] = 'application/zip'
+        # Each entry may carry the same filters as /api/export-data
+        export_filters = {}
+        for export in exports:
+            export_type = export.get('type')
+            if export_type in EXPORT_DATASETS and export_type not in export_filters:
+                try:
+                    export_filters[export_type] = parse_export_filters(export)
+                except ValueError as e:
+                    return jsonify({'error': f'{export_type}: {str(e)}'}), 400
+
+        # Fetch every dataset concurrently; the zip is written in request order
+        stop = threading.Event()
+        pool = ThreadPoolExecutor(max_workers=max(1, len(export_filters)), thread_name_prefix='export')
+        entries = []
+        for export_type, filters in export_filters.items():
+            chunk_queue = queue.Queue(maxsize=EXPORT_QUEUE_CHUNKS)
+            worker = pool.submit(produce_csv_chunks, EXPORT_DATASETS[export_type], filters, chunk_queue, stop)
+            entries.append((f"{export_type}_{timestamp}.csv", iter_queued_chunks(chunk_queue, worker, stop)))
+
+        def finish():
+            stop.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        # Start the archive before responding so a failing first dataset is still a 500
+        zip_chunks = iter_zip_stream(entries)
+        try:
+            first_chunk = next(zip_chunks)
+        except Exception:
+            finish()
+            raise
+
+        def generate():
+            try:
+                yield first_chunk
+                yield from zip_chunks
+            finally:
+                finish()
+
+        response = Response(stream_with_context(generate()), mimetype='application/zip')
         response.headers['Content-Disposition'] = f'attachment; filename=export_{timestamp}.zip'
         return response
     except Exception as e:
         print(f"❌ Multiple export error: {e}")
         return jsonify({'error': str(e)}), 500
 
-# ============ EXPORT SCHOOLS CSV ============
-def export_schools_csv():
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow([
-        'ID', 'Name', 'Cluster Number', 'School Number', 'BMO Name', 'BMO Phone', 'Address',
-        'Water Account', 'Water Meter', 'Electricity Account', 'Electricity Meter',
-        'Telephone Account', 'Telephone Number', 'Notes',
-        'Water Accounts (JSON)', 'Electricity Accounts (JSON)', 'Telephone Accounts (JSON)',
-        'Display Order', 'Created At', 'Updated At'
-    ])
-    response = supabase.table("schools").select("*").execute()
-    schools = response.data if response.data else []
-    schools.sort(key=lambda x: (x.get('display_order', x.get('id', 0)), int(x.get('cluster_number', 999)) if x.get('cluster_number') else 999, x.get('id', 0)))
-    for school in schools:
-        water_accounts_str = json.dumps(school.get('water_accounts', []), ensure_ascii=False) if school.get('water_accounts') else '[]'
-        electricity_accounts_str = json.dumps(school.get('electricity_accounts', []), ensure_ascii=False) if school.get('electricity_accounts') else '[]'
-        telephone_accounts_str = json.dumps(school.get('telephone_accounts', []), ensure_ascii=False) if school.get('telephone_accounts') else '[]'
-        writer.writerow([
-            school.get('id', ''),
-            school.get('name', ''),
-            school.get('cluster_number', ''),
-            school.get('school_number', ''),
-            school.get('bmo_name', ''),
-            school.get('bmo_phone', ''),
-            school.get('address', ''),
-            school.get('water_account', ''),
-            school.get('water_meter', ''),
-            school.get('electricity_account', ''),
-            school.get('electricity_meter', ''),
-            school.get('telephone_account', ''),
-            school.get('telephone_number', ''),
-            school.get('notes', ''),
-            water_accounts_str,
-            electricity_accounts_str,
-            telephone_accounts_str,
-            school.get('display_order', ''),
-            school.get('created_at', ''),
-            school.get('updated_at', '')
-        ])
-    output.seek(0)
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    filename = f"schools_export_{timestamp}.csv"
-    response = make_response(output.getvalue())
-    response.headers['Content-Type'] = 'text/csv; charset=utf-8'
-    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
-    return response
+# ============ STREAMING CSV EXPORT ============
+EXPORT_CSV_FLUSH_ROWS = 500
 
-def export_schools_csv_to_string():
+def iter_csv_chunks(header, rows):
+    """Yield CSV text in chunks of EXPORT_CSV_FLUSH_ROWS rows; the header goes out with the first chunk."""
     output = io.StringIO()
     writer = csv.writer(output)
-    writer.writerow([
-        'ID', 'Name', 'Cluster Number', 'School Number', 'BMO Name', 'BMO Phone', 'Address',
-        'Water Account', 'Water Meter', 'Electricity Account', 'Electricity Meter',
-        'Telephone Account', 'Telephone Number', 'Notes',
-        'Water Accounts (JSON)', 'Electricity Accounts (JSON)', 'Telephone Accounts (JSON)',
-        'Display Order', 'Created At', 'Updated At'
-    ])
-    response = supabase.table("schools").select("*").execute()
-    schools = response.data if response.data else []
-    schools.sort(key=lambda x: (x.get('display_order', x.get('id', 0)), int(x.get('cluster_number', 999)) if x.get('cluster_number') else 999, x.get('id', 0)))
-    for school in schools:
-        water_accounts_str = json.dumps(school.get('water_accounts', []), ensure_ascii=False) if school.get('water_accounts') else '[]'
-        electricity_accounts_str = json.dumps(school.get('electricity_accounts', []), ensure_ascii=False) if school.get('electricity_accounts') else '[]'
-        telephone_accounts_str = json.dumps(school.get('telephone_accounts', []), ensure_ascii=False) if school.get('telephone_accounts') else '[]'
-        writer.writerow([
-            school.get('id', ''),
-            school.get('name', ''),
-            school.get('cluster_number', ''),
-            school.get('school_number', ''),
-            school.get('bmo_name', ''),
-            school.get('bmo_phone', ''),
-            school.get('address', ''),
-            school.get('water_account', ''),
-            school.get('water_meter', ''),
-            school.get('electricity_account', ''),
-            school.get('electricity_meter', ''),
-            school.get('telephone_account', ''),
-            school.get('telephone_number', ''),
-            school.get('notes', ''),
-            water_accounts_str,
-            electricity_accounts_str,
-            telephone_accounts_str,
-            school.get('display_order', ''),
-            school.get('created_at', ''),
-            school.get('updated_at', '')
-        ])
-    return output.getvalue()
-
-# ============ EXPORT DEPARTMENTS CSV ============
-def export_departments_csv():
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow([
-        'ID', 'Name', 'Unit Name', 'Division Name', 'Department Name', 'Hotline Numbers', 'Address',
-        'Notes', 'Created At', 'Updated At',
-        'Water Account', 'Water Meter', 'Electricity Account', 'Electricity Meter',
-        'Telephone Account', 'Telephone Number',
-        'Water Accounts (JSON)', 'Water Meters (JSON)', 'Electricity Accounts (JSON)',
-        'Electricity Meters (JSON)', 'Telephone Accounts (JSON)', 'Telephone Numbers (JSON)',
-        'Display Order'
-    ])
-    response = supabase.table("departments").select("*").execute()
-    departments = response.data if response.data else []
-    grouped = {}
-    for dept in departments:
-        key = dept.get('department_name') or 'Other'
-        if key not in grouped:
-            grouped[key] = []
-        grouped[key].append(dept)
-    group_order = sorted(grouped.keys(), key=lambda k: min(d.get('display_order', d.get('id', 999999)) for d in grouped[k]))
-    sorted_departments = []
-    for key in group_order:
-        depts = grouped[key]
-        depts.sort(key=lambda d: d.get('display_order', d.get('id', 0)))
-        sorted_departments.extend(depts)
-    for dept in sorted_departments:
-        writer.writerow([
-            dept.get('id', ''),
-            dept.get('name', ''),
-            dept.get('unit_name', ''),
-            dept.get('division_name', ''),
-            dept.get('department_name', ''),
-            dept.get('hotline_numbers', ''),
-            dept.get('address', ''),
-            dept.get('notes', ''),
-            dept.get('created_at', ''),
-            dept.get('updated_at', ''),
-            dept.get('water_account', ''),
-            dept.get('water_meter', ''),
-            dept.get('electricity_account', ''),
-            dept.get('electricity_meter', ''),
-            dept.get('telephone_account', ''),
-            dept.get('telephone_number', ''),
-            json.dumps(dept.get('water_accounts', []), ensure_ascii=False) if dept.get('water_accounts') else '[]',
-            json.dumps(dept.get('water_meters', []), ensure_ascii=False) if dept.get('water_meters') else '[]',
-            json.dumps(dept.get('electricity_accounts', []), ensure_ascii=False) if dept.get('electricity_accounts') else '[]',
-            json.dumps(dept.get('electricity_meters', []), ensure_ascii=False) if dept.get('electricity_meters') else '[]',
-            json.dumps(dept.get('telephone_accounts', []), ensure_ascii=False) if dept.get('telephone_accounts') else '[]',
-            json.dumps(dept.get('telephone_numbers', []), ensure_ascii=False) if dept.get('telephone_numbers') else '[]',
-            dept.get('display_order', '')
-        ])
-    output.seek(0)
+    writer.writerow(header)
+    pending = 0
+    for row in rows:
+        writer.writerow(row)
+        pending += 1
+        if pending >= EXPORT_CSV_FLUSH_ROWS:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+            pending = 0
+    yield output.getvalue()
+
+def csv_download_response(header, rows, filename_prefix):
+    """
+    Stream a CSV attachment. The first chunk (and so the first page of rows) is
+    produced before the response starts, so query errors still surface as a 500.
+    """
+    chunks = iter_csv_chunks(header, rows)
+    first_chunk = next(chunks)
+
+    def generate():
+        yield first_chunk.encode('utf-8')
+        for chunk in chunks:
+            yield chunk.encode('utf-8')
+
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    filename = f"departments_export_{timestamp}.csv"
-    response = make_response(output.getvalue())
+    response = Response(stream_with_context(generate()), mimetype='text/csv')
     response.headers['Content-Type'] = 'text/csv; charset=utf-8'
-    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    response.headers['Content-Disposition'] = f'attachment; filename={filename_prefix}_{timestamp}.csv'
     return response
 
-def export_departments_csv_to_string():
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow([
-        'ID', 'Name', 'Unit Name', 'Division Name', 'Department Name', 'Hotline Numbers', 'Address',
-        'Notes', 'Created At', 'Updated At',
-        'Water Account', 'Water Meter', 'Electricity Account', 'Electricity Meter',
-        'Telephone Account', 'Telephone Number',
-        'Water Accounts (JSON)', 'Water Meters (JSON)', 'Electricity Accounts (JSON)',
-        'Electricity Meters (JSON)', 'Telephone Accounts (JSON)', 'Telephone Numbers (JSON)',
-        'Display Order'
-    ])
-    response = supabase.table("departments").select("*").execute()
-    departments = response.data if response.data else []
+# ============ EXPORT COLUMN SPECS ============
+# Every CSV dataset is declared as a row source plus column specs:
+#   (header, key)            -> row.get(key, '')
+#   (header, key, default)   -> row.get(key, default)
+#   (header, callable)       -> callable(row)
+# compile_row_extractor turns the plain key columns into a single itemgetter, which reads
+# selected columns directly; a row missing one of them takes a per-key .get instead.
+_export_json_encoder = json.JSONEncoder(ensure_ascii=False)
+
+def json_column(key):
+    """Account/meter list columns: JSON text, '[]' when empty."""
+    encode = _export_json_encoder.encode
+    return lambda row: encode(row[key]) if row.get(key) else '[]'
+
+def fallback_column(key, fallback_key):
+    return lambda row: row.get(key, row.get(fallback_key, ''))
+
+def compile_row_extractor(columns):
+    """Build one row -> list-of-cells function from column specs."""
+    keys, computed = [], []
+    for position, (header, source, *default) in enumerate(columns):
+        if callable(source):
+            computed.append((position, source))
+        elif default:
+            computed.append((position, lambda row, key=source, value=default[0]: row.get(key, value)))
+        else:
+            keys.append(source)
+    getter = itemgetter(*keys) if len(keys) > 1 else (lambda row, key=keys[0]: (row[key],))
+
+    def extract(row):
+        try:
+            cells = list(getter(row))
+        except KeyError:
+            cells = [row.get(key, '') for key in keys]
+        for position, source in computed:
+            cells.insert(position, source(row))
+        return cells
+    return extract
+
+def export_dataset(filename_prefix, source, columns):
+    """`source(filters)` yields row dicts; see parse_export_filters."""
+    extract = compile_row_extractor(columns)
+    return {
+        'filename': filename_prefix,
+        'header': [column[0] for column in columns],
+        'rows': lambda filters=None: map(extract, source(filters or {}))
+    }
+
+# ============ EXPORT FILTERS ============
+def parse_export_filters(params):
+    """
+    Read the optional export filters (year, month_from, month_to, financial_year,
+    entity_type, entity_ids) from request args or an export-multiple entry.
+    Raises ValueError with a user-facing message for malformed values.
+    """
+    def read_int(name, low=None, high=None):
+        value = params.get(name)
+        if value is None or value == '':
+            return None
+        try:
+            number = int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"{name} must be a number")
+        if low is not None and not low <= number <= high:
+            raise ValueError(f"{name} must be between {low} and {high}")
+        return number
+
+    filters = {
+        'year': read_int('year'),
+        'month_from': read_int('month_from', 1, 12),
+        'month_to': read_int('month_to', 1, 12)
+    }
+
+    financial_year = params.get('financial_year')
+    if financial_year:
+        match = re.match(r'^\s*(\d{4})\s*(?:[-/]\s*(\d{2}|\d{4}))?\s*$', str(financial_year))
+        if not match or (match.group(2) and int(match.group(2)) % 100 != (int(match.group(1)) + 1) % 100):
+            raise ValueError("financial_year must look like 2025-26 or 2025-2026")
+        filters['financial_year'] = int(match.group(1))
+
+    entity_type = params.get('entity_type')
+    if entity_type:
+        if entity_type not in ('school', 'department'):
+            raise ValueError("entity_type must be 'school' or 'department'")
+        filters['entity_type'] = entity_type
+
+    raw_ids = params.getlist('entity_ids') if hasattr(params, 'getlist') else params.get('entity_ids')
+    if isinstance(raw_ids, (str, int)):
+        raw_ids = [raw_ids]
+    entity_ids = [part.strip() for value in (raw_ids or []) for part in str(value).split(',') if part.strip()]
+    if entity_ids:
+        try:
+            filters['entity_ids'] = [int(entity_id) for entity_id in entity_ids]
+        except ValueError:
+            raise ValueError("entity_ids must be a comma-separated list of ids")
+
+    return {name: value for name, value in filters.items() if value is not None}
+
+def bill_period_segments(filters):
+    """
+    Turn the period filters into (year, month_from, month_to) ranges, newest first.
+    An April–March financial year spans two calendar years, so it becomes two
+    ranges; each range is a single query with every filter pushed down.
+    """
+    if 'financial_year' in filters:
+        start_year = filters['financial_year']
+        segments = [(start_year + 1, 1, 3), (start_year, 4, 12)]
+    else:
+        segments = [(filters.get('year'), 1, 12)]
+    result = []
+    for year, month_from, month_to in segments:
+        if year is not None and filters.get('year', year) != year:
+            continue
+        month_from = max(month_from, filters.get('month_from', 1))
+        month_to = min(month_to, filters.get('month_to', 12))
+        if month_from <= month_to:
+            result.append((year, month_from, month_to))
+    return result
+
+def iter_filtered_bills(utility_type, filters, ordered=True):
+    """
+    Bills matching the export filters, newest first. utility_type None means all
+    types; ordered=False pages by id instead, which is cheaper on deep pages.
+    """
+    for year, month_from, month_to in bill_period_segments(filters):
+        def apply_filters(q, year=year, month_from=month_from, month_to=month_to):
+            if utility_type:
+                q = q.eq("utility_type", utility_type)
+            if year is not None:
+                q = q.eq("year", year)
+            # A full 1-12 range is left off so bills without a month are still exported
+            if month_from > 1:
+                q = q.gte("month", month_from)
+            if month_to < 12:
+                q = q.lte("month", month_to)
+            if 'entity_type' in filters:
+                q = q.eq("entity_type", filters['entity_type'])
+            if 'entity_ids' in filters:
+                q = q.in_("entity_id", filters['entity_ids'])
+            return q
+        if ordered:
+            yield from iter_ordered_rows("utility_bills", [('year', True), ('month', True)], apply_filters=apply_filters)
+        else:
+            yield from iter_table_rows("utility_bills", apply_filters=apply_filters)
+
+def iter_filtered_entities(table_name, entity_type, filters):
+    """Schools or departments for export; period filters do not apply to them."""
+    if filters.get('entity_type', entity_type) != entity_type:
+        return iter(())
+    if 'entity_ids' in filters:
+        return iter_table_rows(table_name, apply_filters=lambda q: q.in_("id", filters['entity_ids']))
+    return iter_table_rows(table_name)
+
+def iter_school_export_source(filters):
+    # Schools are few and their order key is computed, so they are sorted in memory
+    schools = list(iter_filtered_entities("schools", "school", filters))
+    schools.sort(key=lambda x: (x.get('display_order', x.get('id', 0)), int(x.get('cluster_number', 999)) if x.get('cluster_number') else 999, x.get('id', 0)))
+    return schools
+
+def iter_department_export_source(filters):
     grouped = {}
-    for dept in departments:
+    for dept in iter_filtered_entities("departments", "department", filters):
         key = dept.get('department_name') or 'Other'
         if key not in grouped:
             grouped[key] = []
         grouped[key].append(dept)
     group_order = sorted(grouped.keys(), key=lambda k: min(d.get('display_order', d.get('id', 999999)) for d in grouped[k]))
-    sorted_departments = []
     for key in group_order:
         depts = grouped[key]
         depts.sort(key=lambda d: d.get('display_order', d.get('id', 0)))
-        sorted_departments.extend(depts)
-    for dept in sorted_departments:
-        writer.writerow([
-            dept.get('id', ''),
-            dept.get('name', ''),
-            dept.get('unit_name', ''),
-            dept.get('division_name', ''),
-            dept.get('department_name', ''),
-            dept.get('hotline_numbers', ''),
-            dept.get('address', ''),
-            dept.get('notes', ''),
-            dept.get('created_at', ''),
-            dept.get('updated_at', ''),
-            dept.get('water_account', ''),
-            dept.get('water_meter', ''),
-            dept.get('electricity_account', ''),
-            dept.get('electricity_meter', ''),
-            dept.get('telephone_account', ''),
-            dept.get('telephone_number', ''),
-            json.dumps(dept.get('water_accounts', []), ensure_ascii=False) if dept.get('water_accounts') else '[]',
-            json.dumps(dept.get('water_meters', []), ensure_ascii=False) if dept.get('water_meters') else '[]',
-            json.dumps(dept.get('electricity_accounts', []), ensure_ascii=False) if dept.get('electricity_accounts') else '[]',
-            json.dumps(dept.get('electricity_meters', []), ensure_ascii=False) if dept.get('electricity_meters') else '[]',
-            json.dumps(dept.get('telephone_accounts', []), ensure_ascii=False) if dept.get('telephone_accounts') else '[]',
-            json.dumps(dept.get('telephone_numbers', []), ensure_ascii=False) if dept.get('telephone_numbers') else '[]',
-            dept.get('display_order', '')
-        ])
-    return output.getvalue()
-
-# ============ EXPORT WATER BILLS CSV ============
-def export_water_bills_csv():
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow([
-        'ID', 'Entity Type', 'Entity Name', 'Account Number', 'Meter Number',
-        'Consumption (m³)', 'Current Charges', 'Unsettled Charges', 'Late Charges',
-        'Amount Paid', 'Month', 'Year', 'Bill Month', 'Bill Year', 'Notes'
-    ])
-    response = supabase.table("utility_bills").select("*").eq("utility_type", "water").order("year", desc=True).order("month", desc=True).execute()
-    bills = response.data if response.data else []
-    for bill in bills:
-        writer.writerow([
-            bill.get('id', ''),
-            bill.get('entity_type', ''),
-            bill.get('entity_name', ''),
-            bill.get('account_number', ''),
-            bill.get('meter_number', ''),
-            bill.get('consumption_m3', 0),
-            bill.get('current_charges', 0),
-            bill.get('unsettled_charges', 0),
-            bill.get('late_charges', 0),
-            bill.get('amount_paid', 0),
-            bill.get('month', ''),
-            bill.get('year', ''),
-            bill.get('bill_month', bill.get('month', '')),
-            bill.get('bill_year', bill.get('year', '')),
-            bill.get('notes', '')
-        ])
-    output.seek(0)
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    filename = f"water_bills_export_{timestamp}.csv"
-    response = make_response(output.getvalue())
-    response.headers['Content-Type'] = 'text/csv; charset=utf-8'
-    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
-    return response
+        yield from depts
 
-def export_water_bills_csv_to_string():
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow([
-        'ID', 'Entity Type', 'Entity Name', 'Account Number', 'Meter Number',
-        'Consumption (m³)', 'Current Charges', 'Unsettled Charges', 'Late Charges',
-        'Amount Paid', 'Month', 'Year', 'Bill Month', 'Bill Year', 'Notes'
+def iter_telephone_export_source(filters):
+    """One row per phone: the bill merged with export_phone_* fields."""
+    for bill in iter_filtered_bills("telephone", filters):
+        phone_rows = []
+        for acc_data in get_telephone_accounts(bill).values():
+            phones = acc_data.get('phones') if isinstance(acc_data, dict) else None
+            if phones:
+                for phone in phones:
+                    if isinstance(phone, dict):
+                        phone_rows.append((phone.get('phoneNumber', ''), phone.get('rentalAmount', 0), phone.get('totalAmount', 0)))
+            else:
+                phone_rows.append(('', 0, 0))
+        if not phone_rows:
+            phone_rows.append((bill.get('phone_number', ''), 0, 0))
+
+        for number, rental, total in phone_rows:
+            yield dict(bill, export_phone_number=number, export_phone_rental=rental, export_phone_total=total)
+
+def bill_columns(consumption_label, consumption_field):
+    return [
+        ('ID', 'id'),
+        ('Entity Type', 'entity_type'),
+        ('Entity Name', 'entity_name'),
+        ('Account Number', 'account_number'),
+        ('Meter Number', 'meter_number'),
+        (consumption_label, consumption_field, 0),
+        ('Current Charges', 'current_charges', 0),
+        ('Unsettled Charges', 'unsettled_charges', 0),
+        ('Late Charges', 'late_charges', 0),
+        ('Amount Paid', 'amount_paid', 0),
+        ('Month', 'month'),
+        ('Year', 'year'),
+        ('Bill Month', fallback_column('bill_month', 'month')),
+        ('Bill Year', fallback_column('bill_year', 'year')),
+        ('Notes', 'notes')
+    ]
+
+EXPORT_DATASETS = {
+    'schools': export_dataset('schools_export', iter_school_export_source, [
+        ('ID', 'id'),
+        ('Name', 'name'),
+        ('Cluster Number', 'cluster_number'),
+        ('School Number', 'school_number'),
+        ('BMO Name', 'bmo_name'),
+        ('BMO Phone', 'bmo_phone'),
+        ('Address', 'address'),
+        ('Water Account', 'water_account'),
+        ('Water Meter', 'water_meter'),
+        ('Electricity Account', 'electricity_account'),
+        ('Electricity Meter', 'electricity_meter'),
+        ('Telephone Account', 'telephone_account'),
+        ('Telephone Number', 'telephone_number'),
+        ('Notes', 'notes'),
+        ('Water Accounts (JSON)', json_column('water_accounts')),
+        ('Electricity Accounts (JSON)', json_column('electricity_accounts')),
+        ('Telephone Accounts (JSON)', json_column('telephone_accounts')),
+        ('Display Order', 'display_order'),
+        ('Created At', 'created_at'),
+        ('Updated At', 'updated_at')
+    ]),
+    'departments': export_dataset('departments_export', iter_department_export_source, [
+        ('ID', 'id'),
+        ('Name', 'name'),
+        ('Unit Name', 'unit_name'),
+        ('Division Name', 'division_name'),
+        ('Department Name', 'department_name'),
+        ('Hotline Numbers', 'hotline_numbers'),
+        ('Address', 'address'),
+        ('Notes', 'notes'),
+        ('Created At', 'created_at'),
+        ('Updated At', 'updated_at'),
+        ('Water Account', 'water_account'),
+        ('Water Meter', 'water_meter'),
+        ('Electricity Account', 'electricity_account'),
+        ('Electricity Meter', 'electricity_meter'),
+        ('Telephone Account', 'telephone_account'),
+        ('Telephone Number', 'telephone_number'),
+        ('Water Accounts (JSON)', json_column('water_accounts')),
+        ('Water Meters (JSON)', json_column('water_meters')),
+        ('Electricity Accounts (JSON)', json_column('electricity_accounts')),
+        ('Electricity Meters (JSON)', json_column('electricity_meters')),
+        ('Telephone Accounts (JSON)', json_column('telephone_accounts')),
+        ('Telephone Numbers (JSON)', json_column('telephone_numbers')),
+        ('Display Order', 'display_order')
+    ]),
+    'water_bills': export_dataset('water_bills_export', lambda filters: iter_filtered_bills('water', filters),
+                                  bill_columns('Consumption (m³)', 'consumption_m3')),
+    'electricity_bills': export_dataset('electricity_bills_export', lambda filters: iter_filtered_bills('electricity', filters),
+                                        bill_columns('Consumption (kWh)', 'consumption_kwh')),
+    # Flattened by phone
+    'telephone_bills': export_dataset('telephone_bills_export', iter_telephone_export_source, [
+        ('ID', 'id'),
+        ('Entity Type', 'entity_type'),
+        ('Entity Name', 'entity_name'),
+        ('Account Number', 'account_number'),
+        ('Bill Number', 'bill_number'),
+        ('Phone Number', 'export_phone_number'),
+        ('Rental Amount', 'export_phone_rental'),
+        ('Total Amount', 'export_phone_total'),
+        ('Total Account Charges', 'current_charges', 0),
+        ('Previous Outstanding', 'unsettled_charges', 0),
+        ('Previous Payment', lambda row: 0),
+        ('Total Current Charges', lambda row: (row.get('current_charges') or 0) + (row.get('unsettled_charges') or 0)),
+        ('Amount Paid', 'amount_paid', 0),
+        ('Month', 'month'),
+        ('Year', 'year'),
+        ('Bill Month', fallback_column('bill_month', 'month')),
+        ('Bill Year', fallback_column('bill_year', 'year')),
+        ('Notes (JSON)', lambda row: row.get('notes') or '')
     ])
-    response = supabase.table("utility_bills").select("*").eq("utility_type", "water").order("year", desc=True).order("month", desc=True).execute()
-    bills = response.data if response.data else []
-    for bill in bills:
-        writer.writerow([
-            bill.get('id', ''),
-            bill.get('entity_type', ''),
-            bill.get('entity_name', ''),
-            bill.get('account_number', ''),
-            bill.get('meter_number', ''),
-            bill.get('consumption_m3', 0),
-            bill.get('current_charges', 0),
-            bill.get('unsettled_charges', 0),
-            bill.get('late_charges', 0),
-            bill.get('amount_paid', 0),
-            bill.get('month', ''),
-            bill.get('year', ''),
-            bill.get('bill_month', bill.get('month', '')),
-            bill.get('bill_year', bill.get('year', '')),
-            bill.get('notes', '')
-        ])
-    return output.getvalue()
+}
 
-# ============ EXPORT ELECTRICITY BILLS CSV ============
-def export_electricity_bills_csv():
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow([
-        'ID', 'Entity Type', 'Entity Name', 'Account Number', 'Meter Number',
-        'Consumption (kWh)', 'Current Charges', 'Unsettled Charges', 'Late Charges',
-        'Amount Paid', 'Month', 'Year', 'Bill Month', 'Bill Year', 'Notes'
-    ])
-    response = supabase.table("utility_bills").select("*").eq("utility_type", "electricity").order("year", desc=True).order("month", desc=True).execute()
-    bills = response.data if response.data else []
-    for bill in bills:
-        writer.writerow([
-            bill.get('id', ''),
-            bill.get('entity_type', ''),
-            bill.get('entity_name', ''),
-            bill.get('account_number', ''),
-            bill.get('meter_number', ''),
-            bill.get('consumption_kwh', 0),
-            bill.get('current_charges', 0),
-            bill.get('unsettled_charges', 0),
-            bill.get('late_charges', 0),
-            bill.get('amount_paid', 0),
-            bill.get('month', ''),
-            bill.get('year', ''),
-            bill.get('bill_month', bill.get('month', '')),
-            bill.get('bill_year', bill.get('year', '')),
-            bill.get('notes', '')
-        ])
-    output.seek(0)
+# ============ COLUMNAR EXPORT ============
+# Typed Parquet export of utility_bills for analysts. pyarrow is pinned in
+# requirements.txt; an install without it answers 501 for this export.
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+PARQUET_ROW_GROUP_ROWS = 50000
+# (column, arrow type); bill_year/bill_month fall back to year/month like the CSV export.
+# Timestamps stay ISO strings because rows mix naive and UTC-offset values.
+BILL_PARQUET_COLUMNS = [
+    ('id', 'int64'), ('utility_type', 'string'), ('entity_type', 'string'), ('entity_id', 'int64'),
+    ('entity_name', 'string'), ('account_number', 'string'), ('meter_number', 'string'),
+    ('bill_number', 'string'), ('phone_number', 'string'),
+    ('year', 'int32'), ('month', 'int32'), ('bill_year', 'int32'), ('bill_month', 'int32'),
+    ('consumption_m3', 'float64'), ('consumption_kwh', 'float64'),
+    ('current_charges', 'float64'), ('unsettled_charges', 'float64'),
+    ('late_charges', 'float64'), ('amount_paid', 'float64'),
+    ('notes', 'string'), ('created_at', 'string'), ('updated_at', 'string')
+]
+PARQUET_COLUMN_FALLBACKS = {'bill_year': 'year', 'bill_month': 'month'}
+
+def _parquet_number(cast):
+    def convert(value):
+        if value is None or value == '':
+            return None
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            return None
+    return convert
+
+PARQUET_CONVERTERS = {
+    'int64': _parquet_number(int),
+    'int32': _parquet_number(int),
+    'float64': _parquet_number(float),
+    'string': lambda value: None if value is None else (value if isinstance(value, str) else json.dumps(value, default=str))
+}
+
+def write_bills_parquet(fileobj, bills):
+    """Write bills to fileobj as Parquet, one row group per PARQUET_ROW_GROUP_ROWS rows. Returns the row count."""
+    schema = pa.schema([(name, getattr(pa, type_name)()) for name, type_name in BILL_PARQUET_COLUMNS])
+    converters = [(name, PARQUET_COLUMN_FALLBACKS.get(name), PARQUET_CONVERTERS[type_name])
+                  for name, type_name in BILL_PARQUET_COLUMNS]
+    total = 0
+    with pq.ParquetWriter(fileobj, schema, compression='snappy') as writer:
+        batch = {name: [] for name, _ in BILL_PARQUET_COLUMNS}
+        pending = 0
+        for bill in bills:
+            for name, fallback, convert in converters:
+                value = bill.get(name, bill.get(fallback)) if fallback else bill.get(name)
+                batch[name].append(convert(value))
+            pending += 1
+            if pending >= PARQUET_ROW_GROUP_ROWS:
+                writer.write_table(pa.Table.from_pydict(batch, schema=schema))
+                total += pending
+                batch = {name: [] for name, _ in BILL_PARQUET_COLUMNS}
+                pending = 0
+        if pending:
+            writer.write_table(pa.Table.from_pydict(batch, schema=schema))
+            total += pending
+    return total
+
+def export_bills_parquet(filters, utility_type=None):
+    if pa is None:
+        return jsonify({'error': 'Parquet export is not available: pyarrow is not installed on the server'}), 501
+    if utility_type and utility_type not in ('water', 'electricity', 'telephone'):
+        return jsonify({'error': "utility_type must be 'water', 'electricity' or 'telephone'"}), 400
+    # Parquet needs its footer written last, so row groups go to a temp file first
+    parquet_file = tempfile.TemporaryFile()
+    try:
+        rows = write_bills_parquet(parquet_file, iter_filtered_bills(utility_type, filters, ordered=False))
+    except Exception:
+        parquet_file.close()
+        raise
+    print(f"📦 Parquet export: {rows} bills")
+    parquet_file.seek(0)
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    filename = f"electricity_bills_export_{timestamp}.csv"
-    response = make_response(output.getvalue())
-    response.headers['Content-Type'] = 'text/csv; charset=utf-8'
-    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
-    return response
-
-def export_electricity_bills_csv_to_string():
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow([
-        'ID', 'Entity Type', 'Entity Name', 'Account Number', 'Meter Number',
-        'Consumption (kWh)', 'Current Charges', 'Unsettled Charges', 'Late Charges',
-        'Amount Paid', 'Month', 'Year', 'Bill Month', 'Bill Year', 'Notes'
-    ])
-    response = supabase.table("utility_bills").select("*").eq("utility_type", "electricity").order("year", desc=True).order("month", desc=True).execute()
-    bills = response.data if response.data else []
-    for bill in bills:
-        writer.writerow([
-            bill.get('id', ''),
-            bill.get('entity_type', ''),
-            bill.get('entity_name', ''),
-            bill.get('account_number', ''),
-            bill.get('meter_number', ''),
-            bill.get('consumption_kwh', 0),
-            bill.get('current_charges', 0),
-            bill.get('unsettled_charges', 0),
-            bill.get('late_charges', 0),
-            bill.get('amount_paid', 0),
-            bill.get('month', ''),
-            bill.get('year', ''),
-            bill.get('bill_month', bill.get('month', '')),
-            bill.get('bill_year', bill.get('year', '')),
-            bill.get('notes', '')
-        ])
-    return output.getvalue()
-
-# ============ EXPORT TELEPHONE BILLS CSV (flattened by phone) ============
-def export_telephone_bills_csv():
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow([
-        'ID', 'Entity Type', 'Entity Name', 'Account Number', 'Bill Number',
-        'Phone Number', 'Rental Amount', 'Total Amount',
-        'Total Account Charges', 'Previous Outstanding', 'Previous Payment',
-        'Total Current Charges', 'Amount Paid',
-        'Month', 'Year', 'Bill Month', 'Bill Year', 'Notes (JSON)'
-    ])
-    response = supabase.table("utility_bills").select("*").eq("utility_type", "telephone").order("year", desc=True).order("month", desc=True).execute()
-    bills = response.data if response.data else []
-
-    for bill in bills:
-        notes = bill.get('notes')
-        phone_rows = []
-
-        if notes and isinstance(notes, str):
+    return send_file(parquet_file, mimetype='application/vnd.apache.parquet', as_attachment=True,
+                     download_name=f"utility_bills_{timestamp}.parquet")
+
+# ============ STREAMING ZIP EXPORT ============
+# Each dataset is rendered on its own worker into a bounded queue of CSV chunks,
+# so at most EXPORT_QUEUE_CHUNKS * EXPORT_CSV_FLUSH_ROWS rows per dataset wait in memory.
+# Every request gets its own workers, and the response gives up on a worker that has
+# produced nothing for EXPORT_IDLE_TIMEOUT_SECONDS instead of holding the gunicorn worker.
+EXPORT_QUEUE_CHUNKS = 16
+EXPORT_POLL_SECONDS = 1
+EXPORT_IDLE_TIMEOUT_SECONDS = int(os.environ.get('EXPORT_IDLE_TIMEOUT_SECONDS', 120))
+_EXPORT_DONE = object()
+
+def produce_csv_chunks(dataset, filters, chunk_queue, stop):
+    """Worker: render one dataset into chunk_queue, ending with _EXPORT_DONE or the exception."""
+    def put(item):
+        while not stop.is_set():
             try:
-                parsed = json.loads(notes)
-                accounts = parsed.get('accounts', {})
-                if accounts:
-                    for acc_key, acc_data in accounts.items():
-                        phones = acc_data.get('phones', [])
-                        if phones:
-                            for phone in phones:
-                                phone_rows.append({
-                                    'number': phone.get('phoneNumber', ''),
-                                    'rental': phone.get('rentalAmount', 0),
-                                    'total': phone.get('totalAmount', 0)
-                                })
-                        else:
-                            phone_rows.append({
-                                'number': '',
-                                'rental': 0,
-                                'total': 0
-                            })
-                else:
-                    phone_rows.append({
-                        'number': bill.get('phone_number', ''),
-                        'rental': 0,
-                        'total': 0
-                    })
-            except:
-                phone_rows.append({
-                    'number': bill.get('phone_number', ''),
-                    'rental': 0,
-                    'total': 0
-                })
-        else:
-            phone_rows.append({
-                'number': bill.get('phone_number', ''),
-                'rental': 0,
-                'total': 0
-            })
-
-        if not phone_rows:
-            phone_rows.append({'number': '', 'rental': 0, 'total': 0})
-
-        for phone in phone_rows:
-            total_account_charges = bill.get('current_charges', 0)
-            previous_outstanding = bill.get('unsettled_charges', 0)
-            previous_payment = 0
-            total_current_charges = total_account_charges + previous_outstanding
-            amount_paid = bill.get('amount_paid', 0)
-
-            writer.writerow([
-                bill.get('id', ''),
-                bill.get('entity_type', ''),
-                bill.get('entity_name', ''),
-                bill.get('account_number', ''),
-                bill.get('bill_number', ''),
-                phone.get('number', ''),
-                phone.get('rental', 0),
-                phone.get('total', 0),
-                total_account_charges,
-                previous_outstanding,
-                previous_payment,
-                total_current_charges,
-                amount_paid,
-                bill.get('month', ''),
-                bill.get('year', ''),
-                bill.get('bill_month', bill.get('month', '')),
-                bill.get('bill_year', bill.get('year', '')),
-                notes if notes else ''
-            ])
-
-    output.seek(0)
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    filename = f"telephone_bills_export_{timestamp}.csv"
-    response = make_response(output.getvalue())
-    response.headers['Content-Type'] = 'text/csv; charset=utf-8'
-    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
-    return response
-
-def export_telephone_bills_csv_to_string():
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow([
-        'ID', 'Entity Type', 'Entity Name', 'Account Number', 'Bill Number',
-        'Phone Number', 'Rental Amount', 'Total Amount',
-        'Total Account Charges', 'Previous Outstanding', 'Previous Payment',
-        'Total Current Charges', 'Amount Paid',
-        'Month', 'Year', 'Bill Month', 'Bill Year', 'Notes (JSON)'
-    ])
-    response = supabase.table("utility_bills").select("*").eq("utility_type", "telephone").order("year", desc=True).order("month", desc=True).execute()
-    bills = response.data if response.data else []
+                chunk_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-    for bill in bills:
-        notes = bill.get('notes')
-        phone_rows = []
+    try:
+        for chunk in iter_csv_chunks(dataset['header'], dataset['rows'](filters)):
+            if not put(chunk):
+                return
+        put(_EXPORT_DONE)
+    except Exception as e:
+        print(f"❌ Export worker failed: {e}")
+        put(e)
 
-        if notes and isinstance(notes, str):
-            try:
-                parsed = json.loads(notes)
-                accounts = parsed.get('accounts', {})
-                if accounts:
-                    for acc_key, acc_data in accounts.items():
-                        phones = acc_data.get('phones', [])
-                        if phones:
-                            for phone in phones:
-                                phone_rows.append({
-                                    'number': phone.get('phoneNumber', ''),
-                                    'rental': phone.get('rentalAmount', 0),
-                                    'total': phone.get('totalAmount', 0)
-                                })
-                        else:
-                            phone_rows.append({
-                                'number': '',
-                                'rental': 0,
-                                'total': 0
-                            })
-                else:
-                    phone_rows.append({
-                        'number': bill.get('phone_number', ''),
-                        'rental': 0,
-                        'total': 0
-                    })
-            except:
-                phone_rows.append({
-                    'number': bill.get('phone_number', ''),
-                    'rental': 0,
-                    'total': 0
-                })
-        else:
-            phone_rows.append({
-                'number': bill.get('phone_number', ''),
-                'rental': 0,
-                'total': 0
-            })
+def iter_queued_chunks(chunk_queue, worker, stop):
+    """Yield a worker's chunks; raises if it dies without finishing or stalls too long."""
+    last_item = time.time()
+    while not stop.is_set():
+        try:
+            item = chunk_queue.get(timeout=EXPORT_POLL_SECONDS)
+        except queue.Empty:
+            if worker.done() and chunk_queue.empty():
+                raise RuntimeError("Export worker stopped without finishing its dataset")
+            if time.time() - last_item > EXPORT_IDLE_TIMEOUT_SECONDS:
+                stop.set()
+                worker.cancel()
+                raise TimeoutError(f"Export worker produced nothing for {EXPORT_IDLE_TIMEOUT_SECONDS}s")
+            continue
+        last_item = time.time()
+        if item is _EXPORT_DONE:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
 
-        if not phone_rows:
-            phone_rows.append({'number': '', 'rental': 0, 'total': 0})
-
-        for phone in phone_rows:
-            total_account_charges = bill.get('current_charges', 0)
-            previous_outstanding = bill.get('unsettled_charges', 0)
-            previous_payment = 0
-            total_current_charges = total_account_charges + previous_outstanding
-            amount_paid = bill.get('amount_paid', 0)
-
-            writer.writerow([
-                bill.get('id', ''),
-                bill.get('entity_type', ''),
-                bill.get('entity_name', ''),
-                bill.get('account_number', ''),
-                bill.get('bill_number', ''),
-                phone.get('number', ''),
-                phone.get('rental', 0),
-                phone.get('total', 0),
-                total_account_charges,
-                previous_outstanding,
-                previous_payment,
-                total_current_charges,
-                amount_paid,
-                bill.get('month', ''),
-                bill.get('year', ''),
-                bill.get('bill_month', bill.get('month', '')),
-                bill.get('bill_year', bill.get('year', '')),
-                notes if notes else ''
-            ])
-
-    return output.getvalue()
+def iter_zip_stream(entries):
+    """
+    Yield a deflated zip built from (arcname, text chunks) entries. zipfile writes
+    to an unseekable sink here, so it uses data descriptors and never needs sizes upfront.
+    """
+    buffer = []
+
+    def write(data):
+        buffer.append(bytes(data))
+        return len(data)
+
+    with zipfile.ZipFile(SimpleNamespace(write=write, flush=lambda: None), 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for arcname, chunks in entries:
+            # The sink can't seek back to patch headers, so allow members over 2 GiB upfront
+            with zip_file.open(arcname, 'w', force_zip64=True) as member:
+                for chunk in chunks:
+                    member.write(chunk.encode('utf-8'))
+                    if buffer:
+                        yield b''.join(buffer)
+                        buffer.clear()
+    yield b''.join(buffer)
 
 def format_file_size(size):
     for unit in ['B', 'KB', 'MB', 'GB']:
@@ -1305,7 +2323,169 @@ def format_file_size(size):
         size /= 1024.0
     return f"{size:.1f} TB"
 
-# ============ BATCH UPDATE API (FIXED – handles water, electricity, and telephone) ============
+# ============ BATCH UPSERT ENGINE ============
+BATCH_UPSERT_CHUNK_SIZE = 200
+
+# Helpers to normalise (remove spaces, dashes, parentheses) for matching
+def normalize_account(acc):
+    if not acc:
+        return ''
+    return re.sub(r'[()\s\-]', '', acc).strip()
+
+def normalize_meter(mtr):
+    if not mtr:
+        return ''
+    return re.sub(r'[()\s\-]', '', mtr).strip()
+
+def prefetch_batch_bills(bills):
+    """
+    Load every existing bill a batch payload could touch in one query.
+    Returns two indexes keyed by (utility_type, entity_type, entity_id, month, year):
+    one on month/year and one on bill_month/bill_year (telephone fallback).
+    """
+    utility_types = set()
+    entity_ids = set()
+    months = set()
+    years = set()
+    has_telephone = False
+    for bill in bills:
+        try:
+            entity_id = int(bill.get('entity_id'))
+            month_val = int(bill.get('month'))
+            year_val = int(bill.get('year'))
+        except (ValueError, TypeError):
+            continue
+        if not bill.get('utility_type'):
+            continue
+        utility_types.add(bill.get('utility_type'))
+        entity_ids.add(entity_id)
+        months.add(month_val)
+        years.add(year_val)
+        if bill.get('utility_type') == 'telephone':
+            has_telephone = True
+    by_period = {}
+    by_bill_period = {}
+    if not entity_ids:
+        return by_period, by_bill_period
+
+    rows = iter_table_rows("utility_bills", apply_filters=lambda q: q
+                           .in_("utility_type", list(utility_types))
+                           .in_("entity_id", list(entity_ids))
+                           .in_("month", list(months))
+                           .in_("year", list(years)))
+    for row in rows:
+        key = (row.get('utility_type'), row.get('entity_type'), row.get('entity_id'), row.get('month'), row.get('year'))
+        by_period.setdefault(key, []).append(row)
+
+    if has_telephone:
+        rows = iter_table_rows("utility_bills", apply_filters=lambda q: q
+                               .eq("utility_type", "telephone")
+                               .in_("entity_id", list(entity_ids))
+                               .in_("bill_month", list(months))
+                               .in_("bill_year", list(years)))
+        for row in rows:
+            key = ('telephone', row.get('entity_type'), row.get('entity_id'), row.get('bill_month'), row.get('bill_year'))
+            by_bill_period.setdefault(key, []).append(row)
+
+    print(f"📥 Prefetched {sum(len(v) for v in by_period.values())} existing bills for batch matching")
+    return by_period, by_bill_period
+
+def load_batch_period(key, by_period, by_bill_period):
+    """Per-row fallback when the batch prefetch failed: load the bills for one key."""
+    utility_type, entity_type, entity_id, month_val, year_val = key
+    response = supabase.table("utility_bills") \
+        .select("*") \
+        .eq("utility_type", utility_type) \
+        .eq("entity_type", entity_type) \
+        .eq("entity_id", entity_id) \
+        .eq("month", month_val) \
+        .eq("year", year_val) \
+        .execute()
+    by_period.setdefault(key, []).extend(response.data or [])
+    if utility_type == 'telephone':
+        response = supabase.table("utility_bills") \
+            .select("*") \
+            .eq("utility_type", "telephone") \
+            .eq("entity_type", entity_type) \
+            .eq("entity_id", entity_id) \
+            .eq("bill_month", month_val) \
+            .eq("bill_year", year_val) \
+            .execute()
+        by_bill_period.setdefault(key, []).extend(response.data or [])
+
+def match_existing_bill(candidates, acc_norm, meter_norm):
+    """Same matching rules as the old per-row lookup, applied in memory."""
+    if not candidates:
+        return None
+    # Try exact match on account + meter (normalised)
+    for b in candidates:
+        if normalize_account(b.get('account_number', '')) == acc_norm and normalize_meter(b.get('meter_number', '')) == meter_norm:
+            return b
+    # If meter is empty, try account-only
+    if not meter_norm:
+        for b in candidates:
+            if normalize_account(b.get('account_number', '')) == acc_norm:
+                return b
+    # If still not found and there's exactly one bill, use it
+    if len(candidates) == 1:
+        return candidates[0]
+    return None
+
+def write_batch_plans(plans):
+    """
+    Write staged bills with chunked bulk upsert/insert calls.
+    Each plan is {'id': existing id or None, 'record': dict, 'rows': payload rows merged into it}.
+    Plans flagged 'unverified' carry a client-supplied id that matched no stored bill; they
+    keep the old update-by-id semantics (a no-op) instead of upserting a new bill.
+    Returns (success_count, error_count) in payload rows.
+    """
+    success_count = 0
+    error_count = 0
+
+    for plan in plans:
+        if plan.get('unverified'):
+            try:
+                supabase.table("utility_bills").update(plan['record']).eq("id", plan['id']).execute()
+                success_count += plan['rows']
+            except Exception as e:
+                error_count += plan['rows']
+                print(f"❌ Error writing bill {plan['id']}: {e}")
+
+    # PostgREST bulk writes need identical keys in every object, so group by key set
+    groups = {}
+    for plan in plans:
+        if plan.get('unverified'):
+            continue
+        row = dict(plan['record'], id=plan['id']) if plan['id'] else plan['record']
+        groups.setdefault((bool(plan['id']), tuple(sorted(row.keys()))), []).append((plan, row))
+
+    for (is_update, _), entries in groups.items():
+        for i in range(0, len(entries), BATCH_UPSERT_CHUNK_SIZE):
+            chunk = entries[i:i + BATCH_UPSERT_CHUNK_SIZE]
+            rows = [row for _, row in chunk]
+            try:
+                if is_update:
+                    supabase.table("utility_bills").upsert(rows, on_conflict="id").execute()
+                else:
+                    supabase.table("utility_bills").insert(rows).execute()
+                success_count += sum(plan['rows'] for plan, _ in chunk)
+                print(f"   ✅ {'Upserted' if is_update else 'Inserted'} {len(rows)} bills")
+            except Exception as e:
+                # If chunk fails, fall back to individual writes so counts stay per row
+                print(f"⚠️ Bulk write failed ({e}), retrying {len(chunk)} bills individually")
+                for plan, row in chunk:
+                    try:
+                        if is_update:
+                            supabase.table("utility_bills").update(plan['record']).eq("id", plan['id']).execute()
+                        else:
+                            supabase.table("utility_bills").insert(row).execute()
+                        success_count += plan['rows']
+                    except Exception as row_e:
+                        error_count += plan['rows']
+                        print(f"❌ Error writing bill {plan['id'] or 'new'}: {row_e}")
+    return success_count, error_count
+
+# ============ BATCH UPDATE API (set-based – handles water, electricity, and telephone) ============
 @app.route('/api/utility-bills/batch-update', methods=['POST'])
 def batch_update_utility_bills():
     try:
@@ -1318,30 +2498,45 @@ def batch_update_utility_bills():
             return jsonify({'error': 'No bills provided'}), 400
         print(f"📦 Batch updating {len(bills)} bills")
         start_time = time.time()
-        success_count = 0
         error_count = 0
         
-        school_ids = set()
-        dept_ids = set()
-        for bill in bills:
-            if bill.get('entity_type') == 'school':
-                school_ids.add(int(bill.get('entity_id')))
-            elif bill.get('entity_type') == 'department':
-                dept_ids.add(int(bill.get('entity_id')))
+        try:
+            by_period, by_bill_period = prefetch_batch_bills(bills)
+            prefetched = True
+        except Exception as e:
+            print(f"⚠️ Batch prefetch failed ({e}), falling back to per-row lookups")
+            by_period, by_bill_period = {}, {}
+            prefetched = False
+        loaded_keys = set()
+        # Staging mutates matched rows in place, so note their rollup keys first
+        previous_keys = {row['id']: rollup_key(row) for rows in itertools.chain(by_period.values(), by_bill_period.values()) for row in rows}
         
-        school_names = {}
-        if school_ids:
-            school_resp = supabase.table("schools").select("id, name").in_("id", list(school_ids)).execute()
-            if school_resp.data:
-                for school in school_resp.data:
-                    school_names[school['id']] = school['name']
+        # Stage every row in memory first. Rows that resolve to the same bill are merged
+        # (last write wins), and new bills are indexed so later rows match them, exactly
+        # as the old one-request-per-row loop behaved.
+        update_plans = {}
+        insert_plans = []
+        pending = {}
         
-        dept_names = {}
-        if dept_ids:
-            dept_resp = supabase.table("departments").select("id, unit_name").in_("id", list(dept_ids)).execute()
-            if dept_resp.data:
-                for dept in dept_resp.data:
-                    dept_names[dept['id']] = dept.get('unit_name', '')
+        def stage(key, target, record):
+            if target is None:
+                record["created_at"] = datetime.now().isoformat()
+                plan = {'id': None, 'record': record, 'rows': 1}
+                insert_plans.append(plan)
+                pending[id(record)] = plan
+                by_period.setdefault(key, []).append(record)
+            elif target.get('id'):
+                plan = update_plans.get(target['id'])
+                if plan:
+                    plan['record'].update(record)
+                    plan['rows'] += 1
+                else:
+                    update_plans[target['id']] = {'id': target['id'], 'record': record, 'rows': 1}
+                target.update(record)
+            else:
+                plan = pending[id(target)]
+                target.update(record)
+                plan['rows'] += 1
         
         for bill_data in bills:
             try:
@@ -1350,69 +2545,31 @@ def batch_update_utility_bills():
                 entity_id = int(bill_data.get('entity_id'))
                 month_val = int(bill_data.get('month'))
                 year_val = int(bill_data.get('year'))
+                key = (utility_type, entity_type, entity_id, month_val, year_val)
+                if not prefetched and key not in loaded_keys:
+                    load_batch_period(key, by_period, by_bill_period)
+                    loaded_keys.add(key)
+                    for row in itertools.chain(by_period.get(key, []), by_bill_period.get(key, [])):
+                        if row.get('id'):
+                            previous_keys.setdefault(row['id'], rollup_key(row))
                 
-                entity_name = ""
-                if entity_type == 'school':
-                    entity_name = school_names.get(entity_id, '')
-                elif entity_type == 'department':
-                    entity_name = dept_names.get(entity_id, '')
+                entity_name = get_entity_name(entity_type, entity_id, fetch_missing=True)
+                if not entity_name and entity_type in ENTITY_REGISTRY_COLUMNS:
+                    raise ValueError(f"Unknown {entity_type} {entity_id}")
                 
-                # ========== HANDLE TELEPHONE (original logic – unchanged) ==========
+                # ========== HANDLE TELEPHONE ==========
                 if utility_type == 'telephone':
-                    # ... (telephone logic as before – omitted for brevity, but it's the same as original)
-                    # I'll include the full telephone logic below.
                     account_number = bill_data.get('account_number', '')
                     bill_number = bill_data.get('bill_number', '')
-                    existing_id = None
-                    existing_record = None
-                    print(f"🔍 Looking for telephone bill: entity_id={entity_id}, entity={entity_name}, month={month_val}, year={year_val}")
-                    
-                    try:
-                        query = supabase.table("utility_bills").select("id, *")\
-                            .eq("utility_type", "telephone")\
-                            .eq("entity_type", entity_type)\
-                            .eq("entity_id", entity_id)\
-                            .eq("month", month_val)\
-                            .eq("year", year_val)
-                        check_response = query.execute()
-                        if check_response.data and len(check_response.data) > 0:
-                            existing_id = check_response.data[0]['id']
-                            existing_record = check_response.data[0]
-                            print(f"📍 Found by month + year: {existing_id}")
-                    except Exception as e:
-                        print(f"⚠️ Error in exact match: {e}")
                     
-                    if not existing_id:
-                        try:
-                            query = supabase.table("utility_bills").select("id, *")\
-                                .eq("utility_type", "telephone")\
-                                .eq("entity_type", entity_type)\
-                                .eq("entity_id", entity_id)\
-                                .eq("bill_month", month_val)\
-                                .eq("bill_year", year_val)
-                            check_response = query.execute()
-                            if check_response.data and len(check_response.data) > 0:
-                                existing_id = check_response.data[0]['id']
-                                existing_record = check_response.data[0]
-                                print(f"📍 Found by bill_month + bill_year: {existing_id}")
-                        except Exception as e:
-                            print(f"⚠️ Error in bill_month match: {e}")
-                    
-                    if not existing_id:
-                        print(f"📝 No existing telephone bill for month={month_val}, year={year_val}. Will insert new.")
+                    # Match by month + year first, then by bill_month + bill_year
+                    candidates = by_period.get(key) or by_bill_period.get(key)
+                    existing_bill = candidates[0] if candidates else None
                     
-                    notes_data = {}
-                    try:
-                        if bill_data.get('notes'):
-                            notes_data = json.loads(bill_data.get('notes'))
-                    except Exception as e:
-                        print(f"⚠️ Error parsing notes: {e}")
+                    notes_data = dict(decode_telephone_notes(bill_data.get('notes')))
                     if not notes_data.get('phones'):
                         notes_data['phones'] = []
                     
-                    final_month = month_val
-                    final_year = year_val
-                    
                     record = {
                         "utility_type": "telephone",
                         "entity_type": entity_type,
@@ -1425,89 +2582,28 @@ def batch_update_utility_bills():
                         "unsettled_charges": float(bill_data.get('unsettled_charges', 0)),
                         "current_charges": float(bill_data.get('current_charges', 0)),
                         "amount_paid": float(bill_data.get('amount_paid', 0)),
-                        "month": final_month,
-                        "year": final_year,
-                        "bill_month": final_month,
-                        "bill_year": final_year,
+                        "month": month_val,
+                        "year": year_val,
+                        "bill_month": month_val,
+                        "bill_year": year_val,
                         "notes": json.dumps(notes_data),
                         "updated_at": datetime.now().isoformat()
                     }
-                    
-                    if existing_id:
-                        print(f"🔄 UPDATING telephone bill ID {existing_id} for {entity_name} (month={final_month}, year={final_year})")
-                        supabase.table("utility_bills").update(record).eq("id", existing_id).execute()
-                        print(f"✅ Updated telephone bill ID {existing_id}")
-                    else:
-                        print(f"📝 INSERTING NEW telephone bill for {entity_name} (month={final_month}, year={final_year})")
-                        record["created_at"] = datetime.now().isoformat()
-                        result = supabase.table("utility_bills").insert(record).execute()
-                        print(f"✅ Created NEW telephone bill for {entity_name}")
-                        if result.data:
-                            print(f"   📊 New bill ID: {result.data[0]['id']}")
-                    success_count += 1
+                    stage(key, existing_bill, record)
                     continue  # skip water/electricity handling
                 
-                # ========== HANDLE WATER & ELECTRICITY (improved with ID & normalisation) ==========
-                # Normalize account and meter for matching
+                # ========== HANDLE WATER & ELECTRICITY (ID & normalisation) ==========
                 account_number = (bill_data.get('account_number', '') or '').strip()
                 meter_number = (bill_data.get('meter_number', '') or '').strip()
                 
-                # Helper to normalise (remove spaces, dashes, parentheses)
-                def normalize_account(acc):
-                    if not acc:
-                        return ''
-                    return re.sub(r'[()\s\-]', '', acc).strip()
-                
-                def normalize_meter(mtr):
-                    if not mtr:
-                        return ''
-                    return re.sub(r'[()\s\-]', '', mtr).strip()
-                
-                acc_norm = normalize_account(account_number)
-                meter_norm = normalize_meter(meter_number)
-                
-                # Try to find existing bill:
                 # 1. If bill_data has an id, use that directly
                 if bill_data.get('id'):
-                    existing_id = bill_data['id']
-                    print(f"📌 Using provided bill ID: {existing_id}")
+                    existing_bill = {'id': bill_data['id']}
                 else:
-                    # Fetch all bills for this entity/month/year to filter in Python
-                    all_bills_resp = supabase.table("utility_bills") \
-                        .select("*") \
-                        .eq("utility_type", utility_type) \
-                        .eq("entity_type", entity_type) \
-                        .eq("entity_id", entity_id) \
-                        .eq("month", month_val) \
-                        .eq("year", year_val) \
-                        .execute()
-                    
-                    existing_bill = None
-                    if all_bills_resp.data:
-                        # Try exact match on account + meter (normalised)
-                        for b in all_bills_resp.data:
-                            b_acc = normalize_account(b.get('account_number', ''))
-                            b_meter = normalize_meter(b.get('meter_number', ''))
-                            if b_acc == acc_norm and b_meter == meter_norm:
-                                existing_bill = b
-                                break
-                        # If meter is empty, try account-only
-                        if not existing_bill and not meter_norm:
-                            for b in all_bills_resp.data:
-                                b_acc = normalize_account(b.get('account_number', ''))
-                                if b_acc == acc_norm:
-                                    existing_bill = b
-                                    break
-                        # If still not found and there's exactly one bill, use it
-                        if not existing_bill and len(all_bills_resp.data) == 1:
-                            existing_bill = all_bills_resp.data[0]
-                    
-                    if existing_bill:
-                        existing_id = existing_bill['id']
-                    else:
-                        existing_id = None
+                    existing_bill = match_existing_bill(by_period.get(key),
+                                                        normalize_account(account_number),
+                                                        normalize_meter(meter_number))
                 
-                # Prepare record
                 record = {
                     "utility_type": utility_type,
                     "entity_type": entity_type,
@@ -1531,21 +2627,38 @@ def batch_update_utility_bills():
                 elif utility_type == 'electricity':
                     record["consumption_kwh"] = float(bill_data.get('consumption_kwh', 0))
                 
-                if existing_id:
-                    print(f"   ✅ UPDATING {utility_type} bill ID {existing_id} for entity {entity_name} (month={month_val}, year={year_val})")
-                    supabase.table("utility_bills").update(record).eq("id", existing_id).execute()
-                else:
-                    print(f"   📝 INSERTING new {utility_type} bill for entity {entity_name} (month={month_val}, year={year_val})")
-                    record["created_at"] = datetime.now().isoformat()
-                    supabase.table("utility_bills").insert(record).execute()
-                
-                success_count += 1
+                stage(key, existing_bill, record)
                 
             except Exception as e:
                 error_count += 1
                 print(f"❌ Error processing bill: {e}")
                 print(traceback.format_exc())
         
+        plans = list(update_plans.values()) + insert_plans
+        print(f"📝 Writing {len(update_plans)} updates and {len(insert_plans)} inserts")
+        # Client-supplied ids that the prefetch did not see must be confirmed before they
+        # are upserted, otherwise a stale id would insert a fresh bill
+        unknown_ids = [plan['id'] for plan in plans if plan['id'] and plan['id'] not in previous_keys]
+        found_ids = set()
+        for i in range(0, len(unknown_ids), BATCH_UPSERT_CHUNK_SIZE):
+            id_chunk = unknown_ids[i:i + BATCH_UPSERT_CHUNK_SIZE]
+            try:
+                for row in iter_table_rows("utility_bills", "id, entity_type, entity_id, utility_type, year, month",
+                                           apply_filters=lambda q: q.in_("id", id_chunk)):
+                    previous_keys[row['id']] = rollup_key(row)
+                    found_ids.add(str(row['id']))
+            except Exception as e:
+                print(f"⚠️ Could not verify {len(id_chunk)} bill ids ({e}), updating them by id")
+        for plan in plans:
+            if plan['id'] and plan['id'] not in previous_keys and str(plan['id']) not in found_ids:
+                plan['unverified'] = True
+        success_count, write_errors = write_batch_plans(plans)
+        error_count += write_errors
+        bump_write_version("utility_bills")
+
+        # Re-sum both the target period and, for bills matched by bill_month, the one they left
+        refresh_rollup_keys([rollup_key(plan['record']) for plan in plans] + [previous_keys.get(plan['id']) for plan in plans if plan['id']])
+        
         elapsed_ms = (time.time() - start_time) * 1000
         print(f"📊 Batch update result: {success_count} success, {error_count} failed in {elapsed_ms:.0f}ms")
         return jsonify({
@@ -1611,29 +2724,17 @@ def api_utility_bills():
             response = query.execute()
             all_bills = response.data if response.data else []
         print(f"📊 Total bills found: {len(all_bills)}")
-        school_dict = {}
-        dept_dict = {}
-        try:
-            schools_resp = supabase.table("schools").select("id, name").execute()
-            if schools_resp.data:
-                for school in schools_resp.data:
-                    school_dict[school['id']] = school['name']
-        except Exception as e:
-            print(f"⚠️ Error fetching schools: {e}")
         try:
-            depts_resp = supabase.table("departments").select("id, name, unit_name").execute()
-            if depts_resp.data:
-                for dept in depts_resp.data:
-                    dept_dict[dept['id']] = dept.get('unit_name') or dept.get('name') or 'Unknown Department'
+            get_entity_registry()
         except Exception as e:
-            print(f"⚠️ Error fetching departments: {e}")
+            print(f"⚠️ Error loading entity registry: {e}")
         bills = []
         for bill in all_bills:
             bill_data = dict(bill)
             if bill_data['entity_type'] == 'school':
-                bill_data['entity_name'] = school_dict.get(bill_data['entity_id'], 'Unknown School')
+                bill_data['entity_name'] = get_entity_name('school', bill_data['entity_id']) or 'Unknown School'
             elif bill_data['entity_type'] == 'department':
-                bill_data['entity_name'] = dept_dict.get(bill_data['entity_id'], 'Unknown Department')
+                bill_data['entity_name'] = get_entity_name('department', bill_data['entity_id']) or 'Unknown Department'
             else:
                 bill_data['entity_name'] = 'Unknown'
             if bill_data['utility_type'] == 'telephone' and not bill_data.get('phone_number'):
@@ -1783,20 +2884,17 @@ def get_payment_summary():
             end_year = current_year
         budget_response = supabase.table("financial_years").select("*").eq("start_year", start_year).eq("end_year", end_year).execute()
         budget = budget_response.data[0] if budget_response.data else None
-        payments_response = supabase.table("utility_bills").select("*").execute()
-        total_paid_water = 0
-        total_paid_electricity = 0
-        total_paid_telephone = 0
-        if payments_response.data:
-            for bill in payments_response.data:
-                bill_year = bill.get('year')
-                if bill_year == start_year or bill_year == end_year:
-                    if bill.get('utility_type') == 'water':
-                        total_paid_water += float(bill.get('amount_paid', 0) or 0)
-                    elif bill.get('utility_type') == 'electricity':
-                        total_paid_electricity += float(bill.get('amount_paid', 0) or 0)
-                    elif bill.get('utility_type') == 'telephone':
-                        total_paid_telephone += float(bill.get('amount_paid', 0) or 0)
+        rollup_rows = get_rollup_rows([start_year, end_year])
+        if rollup_rows is not None:
+            paid_field = 'paid_total'
+            paid = sum_bills_by_utility(rollup_rows, (paid_field,))
+        else:
+            paid_field = 'amount_paid'
+            paid = sum_bills_by_utility(iter_table_rows("utility_bills", "id, year, utility_type, amount_paid",
+                                                        apply_filters=lambda q: q.in_("year", [start_year, end_year])), (paid_field,))
+        total_paid_water = paid.get('water', {}).get(paid_field, 0)
+        total_paid_electricity = paid.get('electricity', {}).get(paid_field, 0)
+        total_paid_telephone = paid.get('telephone', {}).get(paid_field, 0)
         sut_response = supabase.table("sut_office_expenses").select("*").eq("year", start_year).execute()
         sut_total = 0
         if sut_response.data:
@@ -1898,191 +2996,354 @@ def get_entities():
         print(f"❌ Entities GET error: {e}")
         return jsonify([]), 500
 
+# ============ REPORT CACHE ============
+# Serialized /api/generate-report bodies keyed by a canonical hash of the request JSON.
+# Entries die when a source table's write version moves; the TTL bounds staleness from
+# writes handled by other gunicorn workers, whose counters this process can't see.
+REPORT_CACHE_TABLES = ('utility_bills', 'schools', 'departments')
+REPORT_CACHE_SIZE = int(os.environ.get('REPORT_CACHE_SIZE', 32))
+REPORT_CACHE_MAX_BYTES = int(os.environ.get('REPORT_CACHE_MAX_BYTES', 8 * 1024 * 1024))
+REPORT_CACHE_TTL_SECONDS = int(os.environ.get('REPORT_CACHE_TTL_SECONDS', 300))
+_report_cache = collections.OrderedDict()
+_report_cache_lock = threading.Lock()
+
+def report_cache_key(params, body_format='json'):
+    """Key for one request in one response format (the JSON array/page or the NDJSON stream)."""
+    canonical = json.dumps([body_format, params], sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def get_cached_report(key):
+    """Cached body for key, or None if missing, expired or built before a write."""
+    with _report_cache_lock:
+        entry = _report_cache.get(key)
+        if entry is None:
+            return None
+        versions, cached_at, body = entry
+        if versions != get_write_versions(*REPORT_CACHE_TABLES) or time.time() - cached_at > REPORT_CACHE_TTL_SECONDS:
+            del _report_cache[key]
+            return None
+        _report_cache.move_to_end(key)
+        return body
+
+def store_cached_report(key, versions, body):
+    """Cache body under the write versions read before the report's queries ran."""
+    if len(body) > REPORT_CACHE_MAX_BYTES:
+        return
+    with _report_cache_lock:
+        _report_cache[key] = (versions, time.time(), body)
+        _report_cache.move_to_end(key)
+        while len(_report_cache) > REPORT_CACHE_SIZE:
+            _report_cache.popitem(last=False)
+
 # ============ GENERATE REPORT API ============
-@app.route('/api/generate-report', methods=['POST'])
-def generate_report():
+# Reports run in two passes: a light query collects the sort keys (entity name, scope, id)
+# for every matching bill, then full rows are fetched REPORT_HYDRATE_CHUNK ids per query in
+# key order. A page only hydrates its own rows, and a whole report never holds more than one
+# chunk of full rows, so a stream starts sending once its first chunk is read.
+REPORT_HYDRATE_CHUNK = 200
+REPORT_QUERY_TIMEOUT_SECONDS = float(os.environ.get('REPORT_QUERY_TIMEOUT_SECONDS', 60))
+REPORT_DEFAULT_PAGE_SIZE = 100
+REPORT_MAX_PAGE_SIZE = 1000
+REPORT_UNKNOWN_NAMES = {'school': 'Unknown School', 'department': 'Unknown Department'}
+
+def parse_report_entity_ids(data, name):
+    """Sorted unique integer ids from a selection list; ValueError if any entry is malformed."""
+    ids = data.get(name) or []
+    if not isinstance(ids, list):
+        raise ValueError(f'{name} must be a list of ids')
     try:
-        print("📊 POST /api/generate-report called")
-        if not supabase:
-            return jsonify({'error': 'Database not connected'}), 500
-        data = request.get_json()
-        print(f"📊 Report request data: {data}")
-        selection_type = data.get('selection_type', 'entityType')
-        utility_type = data.get('utility_type', 'all')
-        month = data.get('month', 'all')
-        year = data.get('year')
-        query = supabase.table("utility_bills").select("*")
-        if utility_type != 'all':
-            query = query.eq("utility_type", utility_type)
-        bills = []
-        if month != 'all' and month and year and year != 'all':
-            query_month_year = query.eq("month", int(month)).eq("year", int(year))
-            response = query_month_year.execute()
-            if response.data:
-                bills = response.data
-                print(f"📊 Found {len(bills)} bills with month={month}, year={year}")
-            else:
-                query_bill_month = supabase.table("utility_bills").select("*")
-                if utility_type != 'all':
-                    query_bill_month = query_bill_month.eq("utility_type", utility_type)
-                query_bill_month = query_bill_month.eq("bill_month", int(month)).eq("bill_year", int(year))
-                response2 = query_bill_month.execute()
-                if response2.data:
-                    bills = response2.data
-                    print(f"📊 Found {len(bills)} bills with bill_month={month}, bill_year={year} (fallback)")
-        else:
-            response = query.execute()
-            bills = response.data if response.data else []
+        return sorted({int(entity_id) for entity_id in ids})
+    except (ValueError, TypeError):
+        raise ValueError(f'{name} must contain only integer ids')
 
-        # ====== Parse telephone notes to populate missing fields ======
-        for idx, bill in enumerate(bills):
-            if bill.get('utility_type') == 'telephone':
-                # Initialize defaults from top-level fields
-                bill['billNumber'] = bill.get('bill_number', '')
-                bill['totalAccountCharges'] = float(bill.get('current_charges', 0))
-                bill['previousOutstanding'] = float(bill.get('unsettled_charges', 0))
-                bill['previousPayment'] = 0.0
-                bill['totalCurrentCharges'] = float(bill.get('current_charges', 0)) + float(bill.get('unsettled_charges', 0))
-                bill['amountPaid'] = float(bill.get('amount_paid', 0))
-                bill['phoneNumber'] = bill.get('phone_number', '') or bill.get('meter_number', '')
-                bill['rentalAmount'] = 0.0
-                bill['totalAmount'] = 0.0
-
-                notes = bill.get('notes')
-                if notes and isinstance(notes, str):
-                    try:
-                        notes_data = json.loads(notes)
-                        accounts = notes_data.get('accounts', {})
-                        if not accounts:
-                            continue
+def report_entity_scopes(data):
+    """
+    Entity selections as query clauses. Picking schools and departments is an OR across
+    entity types, which the query builder can't express, so each type gets its own query
+    (schools first); None means no entity clause at all.
+    """
+    selection_type = data.get('selection_type', 'entityType')
+    if selection_type == 'entityType':
+        entity_type_filter = data.get('entity_type', 'all')
+        if entity_type_filter != 'all':
+            return [(entity_type_filter, None)]
+    elif selection_type == 'specificEntities':
+        school_ids = parse_report_entity_ids(data, 'school_ids')
+        department_ids = parse_report_entity_ids(data, 'department_ids')
+        selected = [(entity_type, ids) for entity_type, ids in (('school', school_ids), ('department', department_ids)) if ids]
+        if selected:
+            print(f"📊 Specific entity filter: {len(school_ids)} schools, {len(department_ids)} departments")
+            return selected
+    return [None]
+
+def iter_report_scope_rows(data, scopes, columns, apply_period):
+    """Yield (scope index, bill) for each scope in turn, paging by id within a scope."""
+    utility_type = data.get('utility_type', 'all')
+    for scope_index, scope in enumerate(scopes):
+        # Consumed before the next scope, so the closure sees this iteration's scope
+        def apply_filters(query):
+            if utility_type != 'all':
+                query = query.eq("utility_type", utility_type)
+            if scope:
+                entity_type, entity_ids = scope
+                query = query.eq("entity_type", entity_type)
+                if entity_ids is not None:
+                    query = query.in_("entity_id", entity_ids)
+            return apply_period(query)
+        for row in iter_table_rows("utility_bills", columns, apply_filters=apply_filters):
+            yield scope_index, row
+
+REPORT_KEY_COLUMNS = "id, entity_type, entity_id, entity_name"
+
+def fetch_report_keys(data, scopes):
+    """(scope, bill) for every bill in the report, reading only REPORT_KEY_COLUMNS."""
+    month = data.get('month', 'all')
+    year = data.get('year')
+
+    def collect(apply_period):
+        return list(iter_report_scope_rows(data, scopes, REPORT_KEY_COLUMNS, apply_period))
+
+    if month != 'all' and month and year and year != 'all':
+        rows = collect(lambda q: q.eq("month", int(month)).eq("year", int(year)))
+        if rows:
+            print(f"📊 Found {len(rows)} bills with month={month}, year={year}")
+        else:
+            rows = collect(lambda q: q.eq("bill_month", int(month)).eq("bill_year", int(year)))
+            if rows:
+                print(f"📊 Found {len(rows)} bills with bill_month={month}, bill_year={year} (fallback)")
+        return rows
+    return collect(lambda q: q)
+
+def report_entity_name(entity_type, entity_id, stored_name):
+    """Registry name, falling back to the name stored on the bill."""
+    if entity_type in ('school', 'department'):
+        return get_entity_name(entity_type, entity_id) or stored_name
+    return stored_name
+
+def sort_report_keys(scoped_rows):
+    """Sort keys (entity name, scope, id): by name, then in fetch order as before."""
+    keys = []
+    for scope_index, row in scoped_rows:
+        entity_type = row.get('entity_type')
+        stored_name = row.get('entity_name', REPORT_UNKNOWN_NAMES.get(entity_type, 'Unknown'))
+        keys.append((report_entity_name(entity_type, row.get('entity_id'), stored_name) or '', scope_index, row['id']))
+    keys.sort()
+    return keys
+
+def apply_telephone_report_fields(bill, idx):
+    """Fill the report's telephone fields from top-level columns and the notes accounts."""
+    # Initialize defaults from top-level fields
+    bill['billNumber'] = bill.get('bill_number', '')
+    bill['totalAccountCharges'] = float(bill.get('current_charges', 0))
+    bill['previousOutstanding'] = float(bill.get('unsettled_charges', 0))
+    bill['previousPayment'] = 0.0
+    bill['totalCurrentCharges'] = float(bill.get('current_charges', 0)) + float(bill.get('unsettled_charges', 0))
+    bill['amountPaid'] = float(bill.get('amount_paid', 0))
+    bill['phoneNumber'] = bill.get('phone_number', '') or bill.get('meter_number', '')
+    bill['rentalAmount'] = 0.0
+    bill['totalAmount'] = 0.0
+
+    notes = bill.get('notes')
+    if notes and isinstance(notes, str):
+        try:
+            accounts = get_telephone_accounts(bill)
+            if not accounts:
+                return
 
-                        account_number = bill.get('account_number')
-                        acc_data = None
+            account_number = bill.get('account_number')
+            acc_data = None
 
-                        # Try to find by account_number
-                        if account_number and account_number in accounts:
-                            acc_data = accounts[account_number]
-                        else:
-                            # Fallback: use the first account that has a billNumber, or just the first
-                            for acc_key, acc_val in accounts.items():
-                                if acc_val.get('billNumber'):
-                                    acc_data = acc_val
-                                    break
-                            if not acc_data:
-                                acc_data = next(iter(accounts.values()))
-
-                        if acc_data:
-                            bill['billNumber'] = acc_data.get('billNumber', bill['billNumber'])
-                            bill['totalAccountCharges'] = float(acc_data.get('totalAccountCharges', bill['totalAccountCharges']))
-                            bill['previousOutstanding'] = float(acc_data.get('previousOutstanding', bill['previousOutstanding']))
-                            bill['previousPayment'] = float(acc_data.get('previousPayment', bill['previousPayment']))
-                            bill['totalCurrentCharges'] = float(acc_data.get('totalCurrentCharges', bill['totalCurrentCharges']))
-                            bill['amountPaid'] = float(acc_data.get('amountPaid', bill['amountPaid']))
-
-                            phones = acc_data.get('phones', [])
-                            if phones:
-                                bill['phoneNumber'] = phones[0].get('phoneNumber', bill['phoneNumber'])
-                                bill['rentalAmount'] = sum(float(p.get('rentalAmount', 0)) for p in phones)
-                                bill['totalAmount'] = sum(float(p.get('totalAmount', 0)) for p in phones)
-
-                            # Debug: print first few bills to server console
-                            if idx < 5:
-                                print(f"📞 Debug bill {idx+1}: ID={bill.get('id')}, account={account_number}, keys={list(accounts.keys())}, billNumber={bill['billNumber']}, totalAccountCharges={bill['totalAccountCharges']}")
-                        else:
-                            if idx < 5:
-                                print(f"⚠️ Debug bill {idx+1}: No account data found, using defaults")
-                    except Exception as e:
-                        if idx < 5:
-                            print(f"❌ Debug bill {idx+1}: Error parsing notes: {e}")
-                else:
-                    if idx < 5:
-                        print(f"ℹ️ Debug bill {idx+1}: No notes field, using top-level defaults")
-
-        # ====== End of telephone parsing ======
-
-        if selection_type == 'entityType':
-            entity_type_filter = data.get('entity_type', 'all')
-            if entity_type_filter != 'all':
-                bills = [b for b in bills if b.get('entity_type') == entity_type_filter]
-        if selection_type == 'specificEntities':
-            school_ids = [int(sid) for sid in data.get('school_ids', [])]
-            department_ids = [int(did) for did in data.get('department_ids', [])]
-            filtered_bills = []
-            if school_ids:
-                for bill in bills:
-                    if bill['entity_type'] == 'school' and bill['entity_id'] in school_ids:
-                        filtered_bills.append(bill)
-            if department_ids:
-                for bill in bills:
-                    if bill['entity_type'] == 'department' and bill['entity_id'] in department_ids:
-                        filtered_bills.append(bill)
-            if not school_ids and not department_ids:
-                filtered_bills = bills
-            bills = filtered_bills
-            print(f"📊 After specific entity filter: {len(bills)} bills")
-
-        # Build dictionaries for entity name lookup (both int and str keys)
-        school_dict = {}
-        dept_dict = {}
-        try:
-            schools_resp = supabase.table("schools").select("id, name").execute()
-            if schools_resp.data:
-                for school in schools_resp.data:
-                    school_dict[int(school['id'])] = school['name']
-                    school_dict[str(school['id'])] = school['name']
-        except Exception as e:
-            print(f"⚠️ Error fetching schools: {e}")
-        try:
-            depts_resp = supabase.table("departments").select("id, name, unit_name").execute()
-            if depts_resp.data:
-                for dept in depts_resp.data:
-                    name = dept.get('unit_name') or dept.get('name') or 'Unknown Department'
-                    dept_dict[int(dept['id'])] = name
-                    dept_dict[str(dept['id'])] = name
+            # Try to find by account_number
+            if account_number and account_number in accounts:
+                acc_data = accounts[account_number]
+            else:
+                # Fallback: use the first account that has a billNumber, or just the first
+                for acc_key, acc_val in accounts.items():
+                    if acc_val.get('billNumber'):
+                        acc_data = acc_val
+                        break
+                if not acc_data:
+                    acc_data = next(iter(accounts.values()))
+
+            if acc_data:
+                bill['billNumber'] = acc_data.get('billNumber', bill['billNumber'])
+                bill['totalAccountCharges'] = float(acc_data.get('totalAccountCharges', bill['totalAccountCharges']))
+                bill['previousOutstanding'] = float(acc_data.get('previousOutstanding', bill['previousOutstanding']))
+                bill['previousPayment'] = float(acc_data.get('previousPayment', bill['previousPayment']))
+                bill['totalCurrentCharges'] = float(acc_data.get('totalCurrentCharges', bill['totalCurrentCharges']))
+                bill['amountPaid'] = float(acc_data.get('amountPaid', bill['amountPaid']))
+
+                phones = acc_data.get('phones', [])
+                if phones:
+                    bill['phoneNumber'] = phones[0].get('phoneNumber', bill['phoneNumber'])
+                    bill['rentalAmount'] = sum(float(p.get('rentalAmount', 0)) for p in phones)
+                    bill['totalAmount'] = sum(float(p.get('totalAmount', 0)) for p in phones)
+
+                # Debug: print first few bills to server console
+                if idx < 5:
+                    print(f"📞 Debug bill {idx+1}: ID={bill.get('id')}, account={account_number}, keys={list(accounts.keys())}, billNumber={bill['billNumber']}, totalAccountCharges={bill['totalAccountCharges']}")
+            else:
+                if idx < 5:
+                    print(f"⚠️ Debug bill {idx+1}: No account data found, using defaults")
         except Exception as e:
-            print(f"⚠️ Error fetching departments: {e}")
-
-        enriched_bills = []
+            if idx < 5:
+                print(f"❌ Debug bill {idx+1}: Error parsing notes: {e}")
+    else:
+        if idx < 5:
+            print(f"ℹ️ Debug bill {idx+1}: No notes field, using top-level defaults")
+
+def enrich_report_bill(bill, idx):
+    if bill.get('utility_type') == 'telephone':
+        apply_telephone_report_fields(bill, idx)
+    bill_data = dict(bill)
+    entity_type = bill_data['entity_type']
+
+    # Try to get entity name from the registry, fallback to the bill's own entity_name
+    bill_data['entity_name'] = report_entity_name(
+        entity_type, bill_data.get('entity_id'), bill_data.get('entity_name', REPORT_UNKNOWN_NAMES.get(entity_type, 'Unknown')))
+
+    # Ensure telephone fields are present
+    if bill_data['utility_type'] == 'telephone':
+        bill_data['billNumber'] = bill_data.get('billNumber', '')
+        bill_data['totalAccountCharges'] = bill_data.get('totalAccountCharges', 0)
+        bill_data['phoneNumber'] = bill_data.get('phoneNumber', '')
+
+    # Convert numeric fields
+    bill_data['current_charges'] = float(bill_data.get('current_charges') or 0)
+    bill_data['late_charges'] = float(bill_data.get('late_charges') or 0)
+    bill_data['unsettled_charges'] = float(bill_data.get('unsettled_charges') or 0)
+    bill_data['amount_paid'] = float(bill_data.get('amount_paid') or 0)
+    return bill_data
+
+def iter_report_bills(keys):
+    """Enriched bills in key order, fetching full rows REPORT_HYDRATE_CHUNK ids per query."""
+    for start in range(0, len(keys), REPORT_HYDRATE_CHUNK):
+        chunk = keys[start:start + REPORT_HYDRATE_CHUNK]
+        ids = [bill_id for _, _, bill_id in chunk]
+        rows = {row['id']: row for row in iter_table_rows("utility_bills", apply_filters=lambda q: q.in_("id", ids))}
+        for offset, (_, _, bill_id) in enumerate(chunk):
+            row = rows.get(bill_id)
+            # Skip bills deleted since the key pass
+            if row is not None:
+                yield enrich_report_bill(row, start + offset)
+
+def iter_report_ndjson(bills, cache_key, versions):
+    """NDJSON lines for bills; a complete stream small enough to cache is stored as it ends."""
+    lines = []
+    size = 0
+    try:
         for bill in bills:
-            bill_data = dict(bill)
-            entity_id = bill_data.get('entity_id')
-            # Convert to int and str for lookup
-            if entity_id is not None:
-                try:
-                    entity_id_int = int(entity_id)
-                    entity_id_str = str(entity_id)
-                except:
-                    entity_id_int = None
-                    entity_id_str = str(entity_id)
-            else:
-                entity_id_int = None
-                entity_id_str = None
+            line = (app.json.dumps(bill) + '\n').encode('utf-8')
+            if lines is not None:
+                size += len(line)
+                if size > REPORT_CACHE_MAX_BYTES:
+                    lines = None
+                else:
+                    lines.append(line)
+            yield line
+    except Exception as e:
+        print(f"❌ Report stream error: {e}")
+        yield (json.dumps({'error': str(e)}) + '\n').encode('utf-8')
+        return
+    if lines is not None:
+        store_cached_report(cache_key, versions, b''.join(lines))
 
-            # Try to get entity name from dictionaries, fallback to the bill's own entity_name
-            if bill_data['entity_type'] == 'school':
-                bill_data['entity_name'] = school_dict.get(entity_id_int) or school_dict.get(entity_id_str) or bill_data.get('entity_name', 'Unknown School')
-            elif bill_data['entity_type'] == 'department':
-                bill_data['entity_name'] = dept_dict.get(entity_id_int) or dept_dict.get(entity_id_str) or bill_data.get('entity_name', 'Unknown Department')
-            else:
-                bill_data['entity_name'] = bill_data.get('entity_name', 'Unknown')
+def encode_report_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).decode('ascii')
 
-            # Ensure telephone fields are present
-            if bill_data['utility_type'] == 'telephone':
-                bill_data['billNumber'] = bill_data.get('billNumber', '')
-                bill_data['totalAccountCharges'] = bill_data.get('totalAccountCharges', 0)
-                bill_data['phoneNumber'] = bill_data.get('phoneNumber', '')
+def decode_report_cursor(cursor):
+    try:
+        name, scope_index, bill_id = json.loads(base64.urlsafe_b64decode(str(cursor).encode('ascii')))
+        return (str(name), int(scope_index), int(bill_id))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
 
-            # Convert numeric fields
-            bill_data['current_charges'] = float(bill_data.get('current_charges') or 0)
-            bill_data['late_charges'] = float(bill_data.get('late_charges') or 0)
-            bill_data['unsettled_charges'] = float(bill_data.get('unsettled_charges') or 0)
-            bill_data['amount_paid'] = float(bill_data.get('amount_paid') or 0)
+def parse_report_page(data):
+    """Paging options from the request, or None when the whole report is wanted."""
+    if all(data.get(name) is None for name in ('page', 'page_size', 'cursor')):
+        return None
+    try:
+        page = int(data['page']) if data.get('page') is not None else 1
+        page_size = int(data['page_size']) if data.get('page_size') is not None else REPORT_DEFAULT_PAGE_SIZE
+    except (ValueError, TypeError):
+        raise ValueError('page and page_size must be integers')
+    if page < 1 or page_size < 1:
+        raise ValueError('page and page_size must be positive')
+    cursor = decode_report_cursor(data['cursor']) if data.get('cursor') else None
+    return {'page': page, 'page_size': min(page_size, REPORT_MAX_PAGE_SIZE), 'cursor': cursor}
+
+def select_report_page(keys, options):
+    """Slice sorted keys by cursor (keyset) or page number. Returns (keys, page info)."""
+    page_size = options['page_size']
+    if options['cursor'] is not None:
+        start = bisect.bisect_right(keys, options['cursor'])
+    else:
+        start = (options['page'] - 1) * page_size
+    page_keys = keys[start:start + page_size]
+    has_more = start + page_size < len(keys)
+    return page_keys, {
+        'total': len(keys),
+        'page': None if options['cursor'] is not None else options['page'],
+        'page_size': page_size,
+        'has_more': has_more,
+        'next_cursor': encode_report_cursor(page_keys[-1]) if has_more and page_keys else None
+    }
 
-            enriched_bills.append(bill_data)
+@app.route('/api/generate-report', methods=['POST'])
+def generate_report():
+    """
+    Report bills sorted by entity name. Returns the whole array by default; `page` /
+    `page_size` or `cursor` (from a previous page's next_cursor) in the request body return
+    one page, and `Accept: application/x-ndjson` streams bills one per line.
+    """
+    try:
+        print("📊 POST /api/generate-report called")
+        if not supabase:
+            return jsonify({'error': 'Database not connected'}), 500
+        data = request.get_json()
+        print(f"📊 Report request data: {data}")
+        stream = 'application/x-ndjson' in request.headers.get('Accept', '')
+        mimetype = 'application/x-ndjson' if stream else app.json.mimetype
+        cache_key = report_cache_key(data, 'ndjson' if stream else 'json')
+        cached_body = get_cached_report(cache_key)
+        if cached_body is not None:
+            print("📊 Report served from cache")
+            return app.response_class(cached_body, mimetype=mimetype)
+        # Read before querying so a write that races the report invalidates its entry
+        versions = get_write_versions(*REPORT_CACHE_TABLES)
+        try:
+            page_options = parse_report_page(data)
+            scopes = report_entity_scopes(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
 
-        enriched_bills.sort(key=lambda x: x.get('entity_name', ''))
-        print(f"📊 Report generated with {len(enriched_bills)} bills")
-        return jsonify(enriched_bills)
+        def load_entities():
+            # Entity names come from the cached registry (accepts int or str ids)
+            try:
+                get_entity_registry()
+            except Exception as e:
+                print(f"⚠️ Error loading entity registry: {e}")
+
+        # Bills and entity names (schools and departments, read in parallel by the registry)
+        # are independent, so fetch them in parallel. Only the sort keys are read here.
+        scoped_rows = run_concurrently({'bills': lambda: fetch_report_keys(data, scopes), 'entities': load_entities},
+                                       timeout=REPORT_QUERY_TIMEOUT_SECONDS)['bills']
+        keys = sort_report_keys(scoped_rows)
+        del scoped_rows
+        page_info = None
+        if page_options:
+            keys, page_info = select_report_page(keys, page_options)
+
+        if stream:
+            print(f"📊 Streaming report of {len(keys)} bills")
+            return Response(stream_with_context(iter_report_ndjson(iter_report_bills(keys), cache_key, versions)),
+                            mimetype=mimetype)
+
+        bills = list(iter_report_bills(keys))
+        print(f"📊 Report generated with {len(bills)} bills")
+        response = jsonify(dict(page_info, bills=bills) if page_info else bills)
+        store_cached_report(cache_key, versions, response.get_data())
+        return response
     except Exception as e:
         print(f"❌ Generate report error: {e}")
         print(traceback.format_exc())
@@ -2346,6 +3607,407 @@ def delete_sut_office_expense(expense_id):
         print(f"❌ SUT Office expense DELETE error: {e}")
         return jsonify({'error': f'Failed to delete expense: {str(e)}'}), 500
 
+# ============ BILL AGGREGATION ============
+# Shared grouped totals for the dashboard, payment summary, statistics and the monthly
+# rollup. Money is summed as integer cents so totals don't drift with row order. With
+# NumPy (optional, pip install numpy) each chunk of rows is loaded into arrays: every
+# distinct group (utility, or entity + utility + period for the rollup) gets a small int
+# code and each sum is one bincount. Without it the same totals come from a plain loop.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+AGGREGATE_CHUNK_ROWS = 50000
+
+def bill_cents(value):
+    """A money value as integer cents; blanks and unparseable values count as 0."""
+    try:
+        return int(round(float(value or 0) * 100))
+    except (ValueError, TypeError, OverflowError):
+        return 0
+
+def bill_float(value):
+    try:
+        return float(value or 0)
+    except (ValueError, TypeError):
+        return 0.0
+
+def bill_in_segments(bill, segments):
+    """True if the bill's year/month falls in any (year, month_from, month_to) range."""
+    try:
+        bill_month = float(bill.get('month'))
+    except (ValueError, TypeError):
+        return False
+    try:
+        bill_year = float(bill.get('year'))
+    except (ValueError, TypeError):
+        bill_year = None
+    return any((year is None or bill_year == year) and month_from <= bill_month <= month_to
+               for year, month_from, month_to in segments)
+
+def _sum_chunk_python(chunk, group_key, fields, float_fields, segments, state):
+    group_codes, columns = state['codes'], state['columns']
+    for bill in chunk:
+        if segments and not bill_in_segments(bill, segments):
+            continue
+        key = group_key(bill)
+        if key is None:
+            continue
+        code = group_codes.get(key)
+        if code is None:
+            code = group_codes[key] = len(group_codes)
+            for column in columns.values():
+                column.append(0)
+        columns['count'][code] += 1
+        for field in fields:
+            columns[field][code] += bill_cents(bill.get(field))
+        for field in float_fields:
+            columns[field][code] += bill_float(bill.get(field))
+
+def _float_column(chunk, field):
+    """Column as float64 with NaN for missing values, or None if it holds non-numeric text."""
+    try:
+        return np.array([bill.get(field) for bill in chunk], dtype=np.float64)
+    except (ValueError, TypeError):
+        return None
+
+def _cents_column(chunk, field):
+    column = _float_column(chunk, field)
+    if column is None:
+        return np.fromiter((bill_cents(bill.get(field)) for bill in chunk), dtype=np.int64, count=len(chunk))
+    return np.rint(np.nan_to_num(column, nan=0.0, posinf=0.0, neginf=0.0) * 100).astype(np.int64)
+
+def _plain_float_column(chunk, field):
+    column = _float_column(chunk, field)
+    if column is None:
+        return np.fromiter((bill_float(bill.get(field)) for bill in chunk), dtype=np.float64, count=len(chunk))
+    return np.nan_to_num(column, nan=0.0, posinf=0.0, neginf=0.0)
+
+def _accumulate(total, chunk_sums):
+    """Add one chunk's per-code sums into the running array, growing it for new codes."""
+    if total is None:
+        return chunk_sums
+    if len(chunk_sums) > len(total):
+        total = np.concatenate([total, np.zeros(len(chunk_sums) - len(total), dtype=total.dtype)])
+    total[:len(chunk_sums)] += chunk_sums
+    return total
+
+def _sum_chunk_numpy(chunk, group_key, fields, float_fields, segments, state):
+    # Each distinct group gets a small int code (-1 skips the bill), kept across chunks,
+    # so every grouped sum is a single bincount over the combined codes
+    group_codes, columns = state['codes'], state['columns']
+    codes = np.fromiter((-1 if key is None else group_codes.setdefault(key, len(group_codes))
+                         for key in map(group_key, chunk)), dtype=np.int64, count=len(chunk))
+    mask = codes >= 0
+    if segments:
+        years = _float_column(chunk, 'year')
+        months = _float_column(chunk, 'month')
+        if years is None or months is None:
+            in_segments = np.fromiter((bill_in_segments(bill, segments) for bill in chunk), dtype=bool, count=len(chunk))
+        else:
+            in_segments = np.zeros(len(chunk), dtype=bool)
+            for year, month_from, month_to in segments:
+                hit = (months >= month_from) & (months <= month_to)
+                if year is not None:
+                    hit &= years == year
+                in_segments |= hit
+        mask &= in_segments
+    codes = codes[mask]
+    size = len(group_codes)
+    columns['count'] = _accumulate(columns.get('count'), np.bincount(codes, minlength=size))
+    for field in fields:
+        # float64 weights are exact for integer cents up to 2**53
+        sums = np.rint(np.bincount(codes, weights=_cents_column(chunk, field)[mask], minlength=size)).astype(np.int64)
+        columns[field] = _accumulate(columns.get(field), sums)
+    for field in float_fields:
+        columns[field] = _accumulate(columns.get(field), np.bincount(codes, weights=_plain_float_column(chunk, field)[mask], minlength=size))
+
+def group_bill_totals(bills, group_key, fields, segments=None, float_fields=()):
+    """
+    Grouped sums in columnar form: (keys, {'count': [...], field: [...]}) where position i
+    of every list belongs to keys[i]. Bills whose group_key is None are skipped. `fields`
+    are money (summed in cents, returned in currency units), `float_fields` plain
+    quantities such as consumption. `bills` may be any iterable (e.g. iter_table_rows);
+    `segments` optionally keeps only bills inside (year, month_from, month_to) ranges.
+    """
+    if np is not None:
+        sum_chunk = _sum_chunk_numpy
+        state = {'codes': {}, 'columns': {}}
+    else:
+        sum_chunk = _sum_chunk_python
+        state = {'codes': {}, 'columns': {name: [] for name in ('count',) + tuple(fields) + tuple(float_fields)}}
+    bills = iter(bills)
+    while True:
+        chunk = list(itertools.islice(bills, AGGREGATE_CHUNK_ROWS))
+        if not chunk:
+            break
+        sum_chunk(chunk, group_key, fields, float_fields, segments, state)
+    size = len(state['codes'])
+    columns = {}
+    for name in ('count',) + tuple(fields) + tuple(float_fields):
+        column = state['columns'].get(name)
+        # Back to Python numbers once per column, not once per group
+        column = ([0] * size if column is None else column.tolist()) if np is not None else column
+        columns[name] = [value / 100 for value in column] if name in fields else column
+    keys = sorted(state['codes'], key=state['codes'].get)
+    # Groups whose bills all fell outside the segments are dropped
+    present = [i for i, count in enumerate(columns['count']) if count]
+    if len(present) < size:
+        keys = [keys[i] for i in present]
+        columns = {name: [column[i] for i in present] for name, column in columns.items()}
+    return keys, columns
+
+def sum_bills_by_group(bills, group_key, fields, segments=None, float_fields=()):
+    """Totals per group: {group_key(bill): {'count': n, field: total, ...}} (see group_bill_totals)."""
+    keys, columns = group_bill_totals(bills, group_key, fields, segments, float_fields)
+    return {key: {name: column[i] for name, column in columns.items()} for i, key in enumerate(keys)}
+
+def sum_bills_by_utility(bills, fields, segments=None):
+    """Totals per utility_type: {utility_type: {'count': n, field: total, ...}}."""
+    totals = sum_bills_by_group(bills, lambda bill: (bill.get('utility_type'),), fields, segments)
+    return {key[0]: group for key, group in totals.items()}
+
+# ============ MONTHLY ROLLUP ============
+# Per (entity, utility, year, month) totals of utility_bills, so FY summaries and the
+# payment chart read a few hundred rows instead of the bill history. Create the table
+# once in the Supabase SQL editor, then POST /api/rollup/rebuild (or `flask rebuild-rollup`):
+#
+#   create table if not exists bill_monthly_rollup (
+#     id bigint generated always as identity primary key,
+#     entity_type text not null,
+#     entity_id integer not null,
+#     utility_type text not null,
+#     year integer not null,
+#     month integer not null,
+#     bill_count integer not null default 0,
+#     current_total numeric not null default 0,
+#     unsettled_total numeric not null default 0,
+#     paid_total numeric not null default 0,
+#     consumption_total numeric not null default 0,
+#     updated_at timestamptz,
+#     unique (entity_type, entity_id, utility_type, year, month)
+#   );
+#
+# Bill writes re-sum only the keys they touch. A rebuild writes a marker row; readers use
+# the rollup only while it exists, and a failed refresh deletes it so every worker falls
+# back to raw bills until the next rebuild. Bills without a year, entity or utility
+# type are not rolled up: their key columns are not null, and mapping a missing value
+# to 0 or '' would make a refresh overwrite or delete some other key's row.
+ROLLUP_TABLE = 'bill_monthly_rollup'
+ROLLUP_KEY_COLUMNS = ('entity_type', 'entity_id', 'utility_type', 'year', 'month')
+ROLLUP_MARKER = {'entity_type': 'rollup', 'entity_id': 0, 'utility_type': 'rebuilt', 'year': 0, 'month': 0}
+ROLLUP_CHECK_SECONDS = 60
+_rollup_state = {'ready': False, 'checked_at': None}
+_rollup_lock = threading.Lock()
+
+def rollup_key(bill):
+    """(entity_type, entity_id, utility_type, year, month) for a bill, or None if it is not rolled up."""
+    if not bill:
+        return None
+    return normalize_rollup_key(*map(bill.get, ROLLUP_KEY_COLUMNS))
+
+def normalize_rollup_key(entity_type, entity_id, utility_type, year, month):
+    if entity_type in (None, '') or entity_id in (None, '') or utility_type in (None, '') or year in (None, ''):
+        return None
+    try:
+        return (entity_type, int(entity_id), utility_type, int(year), int(month or 0))
+    except (ValueError, TypeError):
+        return None
+
+def sum_rollup_rows(bills):
+    """Aggregate bills into {key: rollup row} with the shared grouped-sum core."""
+    # Group on the raw key values, then normalize each distinct group once with rollup_key
+    raw_keys, columns = group_bill_totals(bills, lambda bill: tuple(map(bill.get, ROLLUP_KEY_COLUMNS)),
+                                          ('current_charges', 'unsettled_charges', 'amount_paid'),
+                                          float_fields=('consumption_m3', 'consumption_kwh'))
+    rows = {}
+    for raw_key, count, current, unsettled, paid, m3, kwh in zip(
+            raw_keys, columns['count'], columns['current_charges'], columns['unsettled_charges'],
+            columns['amount_paid'], columns['consumption_m3'], columns['consumption_kwh']):
+        key = normalize_rollup_key(*raw_key)
+        if key is None:
+            continue
+        row = rows.get(key)
+        if row is None:
+            rows[key] = dict(zip(ROLLUP_KEY_COLUMNS, key), bill_count=count, current_total=current,
+                             unsettled_total=unsettled, paid_total=paid, consumption_total=m3 + kwh)
+        else:
+            # Raw values that normalize to the same key (e.g. '4' and 4)
+            row['bill_count'] += count
+            row['current_total'] += current
+            row['unsettled_total'] += unsettled
+            row['paid_total'] += paid
+            row['consumption_total'] += m3 + kwh
+    return rows
+
+ROLLUP_SOURCE_COLUMNS = ("id, entity_type, entity_id, utility_type, year, month, current_charges, "
+                         "unsettled_charges, amount_paid, consumption_m3, consumption_kwh")
+
+def rollup_ready():
+    """True while the rollup has been rebuilt and no refresh has failed since."""
+    with _rollup_lock:
+        checked_at = _rollup_state['checked_at']
+        if checked_at is None or time.time() - checked_at > ROLLUP_CHECK_SECONDS:
+            try:
+                query = supabase.table(ROLLUP_TABLE).select("bill_count")
+                for column, value in ROLLUP_MARKER.items():
+                    query = query.eq(column, value)
+                _rollup_state['ready'] = bool(query.execute().data)
+            except Exception as e:
+                print(f"⚠️ {ROLLUP_TABLE} unavailable, aggregating raw bills: {e}")
+                _rollup_state['ready'] = False
+            _rollup_state['checked_at'] = time.time()
+        return _rollup_state['ready']
+
+def mark_rollup_stale(reason):
+    """Drop the marker so no worker trusts the rollup until it is rebuilt."""
+    print(f"⚠️ Monthly rollup marked stale ({reason}); run /api/rollup/rebuild")
+    with _rollup_lock:
+        _rollup_state['ready'] = False
+        _rollup_state['checked_at'] = time.time()
+    try:
+        query = supabase.table(ROLLUP_TABLE).delete()
+        for column, value in ROLLUP_MARKER.items():
+            query = query.eq(column, value)
+        query.execute()
+    except Exception as e:
+        print(f"⚠️ Could not clear rollup marker: {e}")
+
+def delete_rollup_row(key):
+    query = supabase.table(ROLLUP_TABLE).delete()
+    for column, value in zip(ROLLUP_KEY_COLUMNS, key):
+        query = query.eq(column, value)
+    query.execute()
+
+def refresh_rollup_keys(keys):
+    """Re-sum the given rollup keys from utility_bills. Never raises."""
+    keys = {key for key in keys if key is not None}
+    if not keys or not rollup_ready():
+        return
+    try:
+        # One bills query per (entity_type, utility_type, year, month) group
+        groups = {}
+        for entity_type, entity_id, utility_type, year, month in keys:
+            groups.setdefault((entity_type, utility_type, year, month), set()).add(entity_id)
+        rows = {}
+        for (entity_type, utility_type, year, month), entity_ids in groups.items():
+            # Consumed before the next group, so the closure sees this iteration's values
+            def apply_filters(q):
+                q = q.eq("entity_type", entity_type).eq("utility_type", utility_type).eq("year", year).in_("entity_id", sorted(entity_ids))
+                return q.eq("month", month) if month else q.is_("month", "null")
+            rows.update(sum_rollup_rows(iter_table_rows("utility_bills", ROLLUP_SOURCE_COLUMNS, apply_filters=apply_filters)))
+        now = datetime.now().isoformat()
+        upserts = [dict(rows[key], updated_at=now) for key in keys if key in rows]
+        if upserts:
+            supabase.table(ROLLUP_TABLE).upsert(upserts, on_conflict=','.join(ROLLUP_KEY_COLUMNS)).execute()
+        for key in keys - rows.keys():
+            delete_rollup_row(key)
+    except Exception as e:
+        mark_rollup_stale(f"refresh of {len(keys)} keys failed: {e}")
+
+def refresh_rollup_for_bills(bills):
+    refresh_rollup_keys(rollup_key(bill) for bill in (bills or []))
+
+def rebuild_monthly_rollup():
+    """Regenerate the whole rollup from utility_bills. Returns counts."""
+    start = time.time()
+    rows = sum_rollup_rows(iter_table_rows("utility_bills", ROLLUP_SOURCE_COLUMNS))
+    marker_key = tuple(ROLLUP_MARKER[column] for column in ROLLUP_KEY_COLUMNS)
+    stale_ids = []
+    for row in iter_table_rows(ROLLUP_TABLE, "id, " + ", ".join(ROLLUP_KEY_COLUMNS)):
+        key = tuple(row[column] for column in ROLLUP_KEY_COLUMNS)
+        if key not in rows and key != marker_key:
+            stale_ids.append(row['id'])
+    now = datetime.now().isoformat()
+    upserts = [dict(row, updated_at=now) for row in rows.values()]
+    for i in range(0, len(upserts), BATCH_UPSERT_CHUNK_SIZE):
+        supabase.table(ROLLUP_TABLE).upsert(upserts[i:i + BATCH_UPSERT_CHUNK_SIZE], on_conflict=','.join(ROLLUP_KEY_COLUMNS)).execute()
+    for i in range(0, len(stale_ids), BATCH_UPSERT_CHUNK_SIZE):
+        supabase.table(ROLLUP_TABLE).delete().in_("id", stale_ids[i:i + BATCH_UPSERT_CHUNK_SIZE]).execute()
+    bill_count = sum(row['bill_count'] for row in rows.values())
+    marker = dict(ROLLUP_MARKER, bill_count=bill_count, current_total=0, unsettled_total=0, paid_total=0,
+                  consumption_total=0, updated_at=now)
+    supabase.table(ROLLUP_TABLE).upsert(marker, on_conflict=','.join(ROLLUP_KEY_COLUMNS)).execute()
+    with _rollup_lock:
+        _rollup_state['ready'] = True
+        _rollup_state['checked_at'] = time.time()
+    print(f"✅ Monthly rollup rebuilt: {len(rows)} rows from {bill_count} bills in {time.time() - start:.1f}s")
+    return {'rows': len(rows), 'bills': bill_count, 'removed': len(stale_ids)}
+
+def rebuild_rollup_after_bulk_write(reason):
+    """Regenerate the rollup after a bulk bill rewrite, or mark it stale if that fails. Never raises."""
+    try:
+        if rollup_ready():
+            rebuild_monthly_rollup()
+    except Exception as e:
+        mark_rollup_stale(f"rebuild after {reason} failed: {e}")
+
+def get_rollup_rows(years):
+    """Rollup rows for the given years, or None when the rollup can't be trusted."""
+    if not rollup_ready():
+        return None
+    try:
+        return list(iter_table_rows(ROLLUP_TABLE, "id, utility_type, year, month, current_total, unsettled_total, paid_total",
+                                    apply_filters=lambda q: q.in_("year", list(years))))
+    except Exception as e:
+        print(f"⚠️ Error reading {ROLLUP_TABLE}, aggregating raw bills: {e}")
+        return None
+
+# ============ FINANCIAL YEAR AGGREGATION ============
+# Dashboard totals are computed in Postgres by this function. Create it once in the
+# Supabase SQL editor; until it exists the dashboard falls back to summing in Python.
+#
+#   create or replace function dashboard_fy_totals(p_start_year int, p_end_year int)
+#   returns table (utility_type text, current_total numeric, unsettled_total numeric, paid_total numeric)
+#   language sql stable as $$
+#     select utility_type::text,
+#            coalesce(sum(current_charges), 0)::numeric,
+#            coalesce(sum(unsettled_charges), 0)::numeric,
+#            coalesce(sum(amount_paid), 0)::numeric
+#     from utility_bills
+#     where (year = p_start_year and month >= 4) or (year = p_end_year and month <= 3)
+#     group by utility_type;
+#   $$;
+#   create index if not exists utility_bills_year_month_idx on utility_bills (year, month);
+FY_TOTALS_RPC = 'dashboard_fy_totals'
+FY_TOTALS_RPC_RETRY_SECONDS = 600
+_fy_totals_rpc_failed_at = None
+
+def get_fy_bill_totals(start_year, end_year):
+    """
+    Sum current, unsettled and paid charges per utility for the April–March
+    financial year. Returns {utility_type: {'current', 'unsettled', 'paid'}}.
+    """
+    global _fy_totals_rpc_failed_at
+    fy_segments = [(start_year, 4, 12), (end_year, 1, 3)]
+    rollup_rows = get_rollup_rows([start_year, end_year])
+    if rollup_rows is not None:
+        totals = sum_bills_by_utility(rollup_rows, ('current_total', 'unsettled_total', 'paid_total'), fy_segments)
+        return {utility_type: {'current': t['current_total'], 'unsettled': t['unsettled_total'], 'paid': t['paid_total']}
+                for utility_type, t in totals.items()}
+    if _fy_totals_rpc_failed_at is None or time.time() - _fy_totals_rpc_failed_at > FY_TOTALS_RPC_RETRY_SECONDS:
+        try:
+            response = supabase.rpc(FY_TOTALS_RPC, {'p_start_year': start_year, 'p_end_year': end_year}).execute()
+            totals = {}
+            for row in (response.data or []):
+                totals[row['utility_type']] = {
+                    'current': float(row.get('current_total') or 0),
+                    'unsettled': float(row.get('unsettled_total') or 0),
+                    'paid': float(row.get('paid_total') or 0)
+                }
+            _fy_totals_rpc_failed_at = None
+            return totals
+        except Exception as e:
+            _fy_totals_rpc_failed_at = time.time()
+            print(f"⚠️ {FY_TOTALS_RPC} RPC unavailable, aggregating in Python: {e}")
+
+    bills = iter_table_rows("utility_bills", "id, year, month, utility_type, current_charges, unsettled_charges, amount_paid",
+                            apply_filters=lambda q: q.in_("year", [start_year, end_year]))
+    totals = sum_bills_by_utility(bills, ('current_charges', 'unsettled_charges', 'amount_paid'), fy_segments)
+    return {utility_type: {'current': t['current_charges'], 'unsettled': t['unsettled_charges'], 'paid': t['amount_paid']}
+            for utility_type, t in totals.items()}
+
 # ============ DASHBOARD DATA ============
 @app.route('/api/dashboard-data')
 def dashboard_data():
@@ -2392,34 +4054,13 @@ def dashboard_data():
         print(f"📈 Current financial year: {current_fy['financial_year']}")
         start_year = current_fy['start_year']
         end_year = current_fy['end_year']
-        query = supabase.table("utility_bills").select("*")
-        response = query.execute()
-        water_total = 0
-        electricity_total = 0
-        telephone_total = 0
-        total_current = 0
-        total_unsettled = 0
-        total_paid = 0
-        if response.data:
-            for bill in response.data:
-                bill_year = bill['year']
-                bill_month = bill['month']
-                if bill_year == start_year and bill_month >= 4:
-                    include_bill = True
-                elif bill_year == end_year and bill_month <= 3:
-                    include_bill = True
-                else:
-                    include_bill = False
-                if include_bill:
-                    if bill['utility_type'] == 'water':
-                        water_total += float(bill['current_charges'] or 0)
-                    elif bill['utility_type'] == 'electricity':
-                        electricity_total += float(bill['current_charges'] or 0)
-                    elif bill['utility_type'] == 'telephone':
-                        telephone_total += float(bill['current_charges'] or 0)
-                    total_current += float(bill['current_charges'] or 0)
-                    total_unsettled += float(bill['unsettled_charges'] or 0)
-                    total_paid += float(bill.get('amount_paid') or 0)
+        fy_totals = get_fy_bill_totals(start_year, end_year)
+        water_total = fy_totals.get('water', {}).get('current', 0)
+        electricity_total = fy_totals.get('electricity', {}).get('current', 0)
+        telephone_total = fy_totals.get('telephone', {}).get('current', 0)
+        total_current = sum(t['current'] for t in fy_totals.values())
+        total_unsettled = sum(t['unsettled'] for t in fy_totals.values())
+        total_paid = sum(t['paid'] for t in fy_totals.values())
         sut_office_used = 0
         try:
             sut_expenses_response = supabase.table("sut_office_expenses").select("*").eq("year", start_year).execute()
@@ -2512,11 +4153,11 @@ def ensure_school_order():
     try:
         if not supabase:
             return jsonify({'error': 'Database not connected'}), 500
-        response = supabase.table("schools").select("id").execute()
-        schools = response.data if response.data else []
+        schools = list(iter_table_rows("schools", "id"))
         updated = 0
         for school in schools:
-            supabase.table("schools").update({"display_order": school['id']}).eq("id", school['id']).execute()
+            supabase.table("schools").update({"display_order": school['id'], "updated_at": datetime.now().isoformat()}).eq("id", school['id']).execute()
+            bump_write_version("schools")
             updated += 1
         return jsonify({
             'success': True,
@@ -2573,6 +4214,8 @@ def create_school():
             "created_at": datetime.now().isoformat()
         }
         response = supabase.table("schools").insert(school_data).execute()
+        invalidate_entity_registry()
+        bump_write_version("schools")
         if hasattr(response, 'data') and response.data:
             return jsonify({
                 'success': True,
@@ -2616,9 +4259,12 @@ def update_school(school_id):
         
         # Remove None values so they don't overwrite existing data
         school_data = {k: v for k, v in school_data.items() if v is not None}
+        school_data["updated_at"] = datetime.now().isoformat()
 
         print(f"📦 Prepared school_data: {school_data}")
         response = supabase.table("schools").update(school_data).eq("id", school_id).execute()
+        invalidate_entity_registry()
+        bump_write_version("schools")
         print(f"✅ Supabase response: {response}")
         if hasattr(response, 'data') and response.data:
             return jsonify({
@@ -2644,6 +4290,8 @@ def delete_school(school_id):
                 'error': 'Cannot delete school because it has utility bills associated with it.'
             }), 400
         response = supabase.table("schools").delete().eq("id", school_id).execute()
+        invalidate_entity_registry()
+        bump_write_version("schools")
         if hasattr(response, 'data') and response.data:
             return jsonify({
                 'success': True,
@@ -2675,14 +4323,14 @@ def ensure_department_order():
             return jsonify({'error': 'Database not connected'}), 500
 
         # Get all department IDs
-        response = supabase.table("departments").select("id").execute()
-        depts = response.data if response.data else []
+        depts = list(iter_table_rows("departments", "id"))
         if not depts:
             return jsonify({'success': True, 'message': 'No departments to update'})
 
         updated = 0
         for dept in depts:
-            supabase.table("departments").update({"display_order": dept['id']}).eq("id", dept['id']).execute()
+            supabase.table("departments").update({"display_order": dept['id'], "updated_at": datetime.now().isoformat()}).eq("id", dept['id']).execute()
+            bump_write_version("departments")
             updated += 1
 
         return jsonify({
@@ -2765,6 +4413,8 @@ def create_department():
             "created_at": datetime.now().isoformat()
         }
         response = supabase.table("departments").insert(department_data).execute()
+        invalidate_entity_registry()
+        bump_write_version("departments")
         if hasattr(response, 'data') and response.data:
             return jsonify({
                 'success': True,
@@ -2828,8 +4478,11 @@ def update_department(department_id):
         
         # Remove None values so they don't overwrite existing data
         department_data = {k: v for k, v in department_data.items() if v is not None}
+        department_data["updated_at"] = datetime.now().isoformat()
         
         response = supabase.table("departments").update(department_data).eq("id", department_id).execute()
+        invalidate_entity_registry()
+        bump_write_version("departments")
         if hasattr(response, 'data') and response.data:
             return jsonify({
                 'success': True,
@@ -2853,6 +4506,8 @@ def delete_department(department_id):
                 'error': 'Cannot delete department because it has utility bills associated with it.'
             }), 400
         response = supabase.table("departments").delete().eq("id", department_id).execute()
+        invalidate_entity_registry()
+        bump_write_version("departments")
         if hasattr(response, 'data') and response.data:
             return jsonify({
                 'success': True,
@@ -2871,15 +4526,9 @@ def create_utility_bill():
         data = request.get_json()
         if not data:
             return jsonify({'error': 'No data provided'}), 400
-        entity_name = ""
-        if data.get('entity_type') == 'school':
-            school_response = supabase.table("schools").select("name").eq("id", data.get('entity_id')).execute()
-            if school_response.data and len(school_response.data) > 0:
-                entity_name = school_response.data[0]['name']
-        elif data.get('entity_type') == 'department':
-            dept_response = supabase.table("departments").select("name").eq("id", data.get('entity_id')).execute()
-            if dept_response.data and len(dept_response.data) > 0:
-                entity_name = dept_response.data[0]['name']
+        entity_name = get_entity_name(data.get('entity_type'), data.get('entity_id'), fetch_missing=True)
+        if not entity_name and data.get('entity_type') in ENTITY_REGISTRY_COLUMNS:
+            return jsonify({'error': f"Unknown {data.get('entity_type')} {data.get('entity_id')}"}), 400
         current_date = datetime.now()
         query = supabase.table("utility_bills").select("*")\
             .eq("utility_type", data.get('utility_type'))\
@@ -2907,8 +4556,11 @@ def create_utility_bill():
                 bill_data["meter_number"] = data.get('meter_number')
             if data.get('notes') is not None:
                 bill_data["notes"] = data.get('notes')
+            bill_data["updated_at"] = datetime.now().isoformat()
             response = supabase.table("utility_bills").update(bill_data).eq("id", bill_id).execute()
+            bump_write_version("utility_bills")
             if response.data:
+                refresh_rollup_for_bills(response.data)
                 return jsonify({
                     'message': 'Utility bill updated successfully',
                     'bill': response.data[0],
@@ -2940,7 +4592,9 @@ def create_utility_bill():
             "created_at": datetime.now().isoformat()
         }
         response = supabase.table("utility_bills").insert(bill_data).execute()
+        bump_write_version("utility_bills")
         if response.data:
+            refresh_rollup_for_bills(response.data)
             return jsonify({
                 'message': 'Utility bill created successfully',
                 'bill': response.data[0]
@@ -2979,9 +4633,12 @@ def update_utility_bill(bill_id):
             bill_data["phone_number"] = data.get('phone_number')
         if data.get('notes') is not None:
             bill_data["notes"] = data.get('notes')
+        bill_data["updated_at"] = datetime.now().isoformat()
         response = supabase.table("utility_bills").update(bill_data).eq("id", bill_id).execute()
+        bump_write_version("utility_bills")
         if response.data:
             print("✅ Utility bill updated successfully")
+            refresh_rollup_for_bills(response.data)
             return jsonify({
                 'success': True,
                 'message': 'Bill updated successfully',
@@ -3007,8 +4664,10 @@ def delete_utility_bill(bill_id):
             print(f"❌ Bill with ID {bill_id} not found")
             return jsonify({'error': 'Bill not found'}), 404
         response = supabase.table("utility_bills").delete().eq("id", bill_id).execute()
+        bump_write_version("utility_bills")
         if response.data:
             print(f"✅ Bill with ID {bill_id} deleted successfully")
+            refresh_rollup_for_bills(response.data)
             return jsonify({
                 'success': True,
                 'message': 'Bill deleted successfully',
@@ -3023,17 +4682,30 @@ def delete_utility_bill(bill_id):
         return jsonify({'error': f'Failed to delete bill: {str(e)}'}), 500
 
 # ============ STATISTICS API ============
+STATISTICS_QUERY_TIMEOUT_SECONDS = float(os.environ.get('STATISTICS_QUERY_TIMEOUT_SECONDS', 20))
+
 @app.route('/api/statistics/overview')
 def overview_statistics():
     try:
         if not supabase:
             return jsonify({'error': 'Database not connected'}), 500
-        dept_response = supabase.table("departments").select("*").execute()
-        departments = dept_response.data if dept_response.data else []
-        school_response = supabase.table("schools").select("*").execute()
-        schools = school_response.data if school_response.data else []
-        bills_response = supabase.table("utility_bills").select("*").execute()
-        bills = bills_response.data if bills_response.data else []
+
+        def count_bills():
+            totals = sum_bills_by_utility(iter_table_rows("utility_bills", "id, utility_type, current_charges"), ('current_charges',))
+            bill_counts = {utility_type: totals.get(utility_type, {}).get('count', 0) for utility_type in ('water', 'electricity', 'telephone')}
+            total_bills = sum(t['count'] for t in totals.values())
+            total_amount = sum(t['current_charges'] for t in totals.values())
+            return bill_counts, total_bills, total_amount
+
+        # The three reads are independent, so issue them in parallel
+        results = run_concurrently({
+            'departments': lambda: list(iter_table_rows("departments", "id, department_name, division_name")),
+            'schools': lambda: list(iter_table_rows("schools", "id, name, cluster_number")),
+            'bills': count_bills
+        }, timeout=STATISTICS_QUERY_TIMEOUT_SECONDS)
+        departments = results['departments']
+        schools = results['schools']
+        bill_counts, total_bills, total_amount = results['bills']
         dept_names = set()
         divisions = set()
         for dept in departments:
@@ -3055,10 +4727,6 @@ def overview_statistics():
                 college_count += 1
             else:
                 other_count += 1
-        water_bills = [b for b in bills if b.get('utility_type') == 'water']
-        electricity_bills = [b for b in bills if b.get('utility_type') == 'electricity']
-        telephone_bills = [b for b in bills if b.get('utility_type') == 'telephone']
-        total_amount = sum(float(b.get('current_charges', 0) or 0) for b in bills)
         return jsonify({
             'departments': {
                 'total_departments': len(dept_names),
@@ -3078,10 +4746,10 @@ def overview_statistics():
                 'unique_clusters': list(clusters)[:10]
             },
             'utility_bills': {
-                'total_bills': len(bills),
-                'water_bills': len(water_bills),
-                'electricity_bills': len(electricity_bills),
-                'telephone_bills': len(telephone_bills),
+                'total_bills': total_bills,
+                'water_bills': bill_counts['water'],
+                'electricity_bills': bill_counts['electricity'],
+                'telephone_bills': bill_counts['telephone'],
                 'total_amount': total_amount
             }
         })